@@ -0,0 +1,902 @@
+"""Behaviour tests for VacuumBot. Run with: python -m unittest test_vacuumbot
+
+Most tests need the openlibrary client (openlibrary.api) and are skipped without it.
+Sweeps run against the mock Open Library of vacuumbench, on a free local port.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import gzip, new, os, shutil, socket, StringIO, tempfile, threading, time, unittest, urllib2
+import simplejson
+
+import vacuumbot
+
+try:
+  import openlibrary.api
+  HAVE_OL = True
+except ImportError:
+  HAVE_OL = False
+
+needs_ol = unittest.skipUnless(HAVE_OL, "openlibrary.api is not installed")
+
+def ol_error(code, reason, body=""):
+  """Returns an OLError like the client raises for an HTTP error response."""
+  return vacuumbot.olapi.OLError(urllib2.HTTPError("/api/save_many", code, reason, {}, StringIO.StringIO(body)))
+
+def fast_limiter():
+  return vacuumbot.RateLimiter(1000.0, 1000.0, 1000.0, 1000.0)
+
+class Client(object):
+  """A stand-in for the OL client, whose save_many fails as fail(records) says."""
+  cookie = None
+
+  def __init__(self, fail=lambda records: None):
+    self.fail = fail
+    self.calls = 0
+    self.saved = []
+
+  def save_many(self, records, comment):
+    self.calls = self.calls + 1
+    error = self.fail(records)
+    if error != None:
+      raise error
+    self.saved.extend(r["key"] for r in records)
+    return [{"key": r["key"], "revision": 2} for r in records]
+
+class QueryFanoutTest(unittest.TestCase):
+  RESULTS = {"a": ["/k/1", "/k/2"], "b": [{"key": "/k/3"}, {"key": "/k/2"}], "c": []}
+
+  def query(self, q):
+    if q == "boom":
+      raise ValueError("boom")
+    return iter(self.RESULTS[q])
+
+  def test_disjoint(self):
+    empty = []
+    keys = list(vacuumbot.QueryFanout(self.query, ["a", "b", "c"], threads=2, empty=empty.append))
+    self.assertEqual(sorted(keys), ["/k/1", "/k/2", "/k/2", "/k/3"])
+    self.assertEqual(empty, ["c"])
+
+  def test_overlap(self):
+    keys = list(vacuumbot.QueryFanout(self.query, ["a", "b"], overlap=True))
+    self.assertEqual(sorted(keys), ["/k/1", "/k/2", "/k/3"])
+
+  def test_error(self):
+    self.assertRaises(ValueError, list, vacuumbot.QueryFanout(self.query, ["a", "boom"]))
+
+class OLBufferTest(unittest.TestCase):
+  def test_flush_timeout(self):
+    go = threading.Event()
+    sent = []
+    def send(message, records):
+      go.wait()
+      sent.append(sorted(records))
+      return {}
+    buf = vacuumbot.OLBuffer(send, maxage=3600, shutdown_timeout=0.5)
+    buf.add("/books/OL1M", {"key": "/books/OL1M"}, "m")
+    start = time.time()
+    self.assertFalse(buf.flush(timeout=0.5))
+    self.assertTrue(time.time() - start < 5)
+    # Records being sent are still pending
+    self.assertEqual(buf.pending_records(), [("m", "/books/OL1M", {"key": "/books/OL1M"})])
+    self.assertEqual(buf.pending_records(sending=False), [])
+    go.set()
+    self.assertTrue(buf.flush(timeout=5))
+    self.assertEqual(buf.pending(), [])
+    self.assertEqual(sent, [["/books/OL1M"]])
+    buf.close()
+
+  def test_retry_stays_pending(self):
+    buf = vacuumbot.OLBuffer(lambda message, records: dict(records), maxage=3600)
+    buf.add("/books/OL1M", {"key": "/books/OL1M"}, "m")
+    self.assertTrue(buf.flush(timeout=5))
+    self.assertEqual(buf.pending(), ["/books/OL1M"])
+    buf.close()
+
+  def test_maxage_under_load(self):
+    sent = []
+    def send(message, records):
+      time.sleep(0.05)
+      sent.append(message)
+      return {}
+    buf = vacuumbot.OLBuffer(send, maxrecords=2, maxage=0.4)
+    buf.add("/books/OL1M", {"key": "/books/OL1M"}, "quiet")
+    # Full batches keep coming faster than they are sent
+    deadline = time.time() + 2
+    n = 0
+    while "quiet" not in sent and time.time() < deadline:
+      for i in range(2):
+        n = n + 1
+        buf.add("/books/OL%dM" % (n + 1), {}, "busy")
+      time.sleep(0.03)
+    self.assertTrue("quiet" in sent)
+    buf.close()
+
+@needs_ol
+class CloseTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.deadletter = os.path.join(self.dir, "deadletter.jsonl")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_in_flight_records_are_not_dead_lettered(self):
+    bot = vacuumbot.VacuumBot(None, None, limiter=fast_limiter(), redirects=":memory:", journal=":memory:",
+                              deadletter=self.deadletter, logdir=self.dir, buffer={"maxage": 3600, "shutdown_timeout": 0.5})
+    go = threading.Event()
+    def fail(records):
+      go.wait()
+    bot.ol = Client(fail)
+    keys = ["/books/OL%dM" % i for i in range(1, 5)]
+    for i, key in enumerate(keys):
+      bot.savebuffer.add(key, {"key": key}, "message " + str(i % 2))
+    bot.close()
+    go.set()
+    time.sleep(0.5)
+    dead = [simplejson.loads(line)["key"] for line in open(self.deadletter)]
+    # One batch was being sent and got saved, the other was never sent
+    self.assertEqual(len(dead), 2)
+    self.assertEqual(sorted(dead + bot.ol.saved), keys)
+
+class NormalizeTest(unittest.TestCase):
+  def test_isbn(self):
+    self.assertEqual(vacuumbot.normalize_isbn("0-306-40615-2"), "9780306406157")
+    self.assertEqual(vacuumbot.normalize_isbn("978-0-306-40615-7"), "9780306406157")
+    self.assertEqual(vacuumbot.normalize_isbn("080442957x"), "9780804429573")
+    self.assertEqual(vacuumbot.normalize_isbn("12345"), None)
+
+  def test_lccn(self):
+    self.assertEqual(vacuumbot.normalize_lccn("n 78-890351"), "n78890351")
+    self.assertEqual(vacuumbot.normalize_lccn("85-2 "), "85000002")
+    self.assertEqual(vacuumbot.normalize_lccn("75-425165//r75"), "75425165")
+    self.assertEqual(vacuumbot.normalize_lccn("http://lccn.loc.gov/2001000002/"), "2001000002")
+    self.assertEqual(vacuumbot.normalize_lccn("not an lccn"), None)
+
+  def test_oclc_and_goodreads(self):
+    self.assertEqual(vacuumbot.normalize_oclc("(OCoLC)ocm00012345"), "12345")
+    self.assertEqual(vacuumbot.normalize_oclc("ocn123456789"), "123456789")
+    self.assertEqual(vacuumbot.normalize_oclc("abc"), None)
+    self.assertEqual(vacuumbot.normalize_goodreads(" 42 "), "42")
+    self.assertEqual(vacuumbot.normalize_goodreads("x42"), None)
+
+  def test_identifiers_of(self):
+    record = {"isbn_10": ["0306406152"], "isbn_13": ["9780306406157"], "lccn": ["n 78-890351"],
+              "identifiers": {"goodreads": ["42"]}}
+    self.assertEqual(vacuumbot.identifiers_of(record),
+                     set([("isbn", "9780306406157"), ("lccn", "n78890351"), ("goodreads", "42")]))
+
+  def test_deduplicate_list(self):
+    values = ["0306406152", "x", "978-0-306-40615-7", "x", "9780804429573"]
+    vacuumbot.DumpCleaner().deduplicate_list(values, vacuumbot.normalize_isbn)
+    self.assertEqual(values, ["0306406152", "x", "x", "9780804429573"])
+    vacuumbot.DumpCleaner().deduplicate_list(values)
+    self.assertEqual(values, ["0306406152", "x", "9780804429573"])
+
+class IdentifierIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.index = vacuumbot.IdentifierIndex(os.path.join(self.dir, "identifiers.db"))
+    self.index.add_many([
+      {"key": "/books/OL1M", "isbn_10": ["0306406152"], "lccn": ["n 78-890351"]},
+      {"key": "/books/OL2M", "isbn_13": ["978-0-306-40615-7"]},
+      {"key": "/books/OL3M", "lccn": ["n78890351"], "oclc_numbers": ["ocm00012345"]},
+    ])
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_lookup(self):
+    self.assertEqual(sorted(self.index.lookup("isbn", "0-306-40615-2")), ["/books/OL1M", "/books/OL2M"])
+    self.assertEqual(self.index.lookup("oclc", "(OCoLC)12345"), ["/books/OL3M"])
+    # Indexing an edition again replaces its identifiers
+    self.index.add_many([{"key": "/books/OL2M"}])
+    self.assertEqual(self.index.lookup("isbn", "9780306406157"), ["/books/OL1M"])
+
+  def test_duplicates(self):
+    self.assertEqual(sorted((s, v, sorted(k)) for s, v, k in self.index.duplicates()),
+                     [("isbn", "9780306406157", ["/books/OL1M", "/books/OL2M"]), ("lccn", "n78890351", ["/books/OL1M", "/books/OL3M"])])
+    outfile = os.path.join(self.dir, "duplicates.txt")
+    self.assertEqual(vacuumbot.write_duplicates(self.index, outfile, "lccn"), 1)
+    scheme, value, keys = open(outfile).read().rstrip("\n").split("\t")
+    self.assertEqual((scheme, value, sorted(keys.split(" "))), ("lccn", "n78890351", ["/books/OL1M", "/books/OL3M"]))
+
+@needs_ol
+class LazyRecordTest(unittest.TestCase):
+  RAW = {"key": "/books/OL1M", "title": "A title", "pagination": "12 p. ;", "authors": [{"key": "/authors/OL1A"}],
+         "notes": {"type": "/type/text", "value": "Some notes"}}
+
+  def test_fields(self):
+    obj = vacuumbot.LazyRecord(dict(self.RAW))
+    self.assertEqual(obj.fields, {})
+    self.assertEqual(obj["authors"], [vacuumbot.olapi.Reference("/authors/OL1A")])
+    self.assertEqual(obj.fields.keys(), ["authors"])
+    obj["title"] = "Another title"
+    del obj["pagination"]
+    self.assertRaises(KeyError, lambda: obj["pagination"])
+    self.assertFalse("pagination" in obj)
+    obj["subtitle"] = "A subtitle"
+    self.assertEqual(sorted(obj.keys()), ["authors", "key", "notes", "subtitle", "title"])
+    self.assertEqual(len(obj), 5)
+
+  def test_marshal(self):
+    raw = dict(self.RAW)
+    obj = vacuumbot.LazyRecord(raw)
+    obj["title"] = "Another title"
+    del obj["pagination"]
+    data = vacuumbot.marshal_record(obj)
+    expected = dict(self.RAW, title="Another title")
+    del expected["pagination"]
+    self.assertEqual(data, expected)
+    # Fields that were not used are passed on as they are
+    self.assertTrue(data["notes"] is raw["notes"])
+
+  def test_unmarshalled_dict(self):
+    obj = vacuumbot.olapi.unmarshal(dict(self.RAW))
+    self.assertEqual(vacuumbot.marshal_record(obj), self.RAW)
+
+class FormatIndexTest(unittest.TestCase):
+  FORMATS = {"Paperback": "Paperback", "paperback.": "Paperback", "Hardcover": "Hardcover", "Mass Market Paperback": "Mass Market Paperback"}
+
+  def test_canonical_variants(self):
+    index = vacuumbot.FormatIndex(self.FORMATS)
+    self.assertEqual(index.lookup("PAPERBACK"), "Paperback")
+    self.assertEqual(index.lookup(" paperback ; "), "Paperback")
+    self.assertEqual(index.lookup("Hardcover by Penguin"), "Hardcover")
+    self.assertEqual(index.lookup("Paperbak"), None)
+
+  def test_fuzzy(self):
+    index = vacuumbot.FormatIndex(self.FORMATS, maxdistance=1)
+    self.assertEqual(index.lookup("Paperbak"), "Paperback")
+    self.assertEqual(index.lookup("Hardcovr"), "Hardcover")
+    self.assertEqual(index.lookup("Papbak"), None)
+    # Values no longer than maxdistance match nothing
+    self.assertEqual(index.lookup("x"), None)
+
+  def test_fuzzy_ties(self):
+    index = vacuumbot.FormatIndex({"abcd": "B", "abce": "A"}, maxdistance=1)
+    self.assertEqual(index.lookup("abcf"), "A")
+
+class RecordCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "records.db")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_store(self):
+    cache = vacuumbot.RecordCache(self.filename)
+    cache.put_many([{"key": "/books/OL1M", "revision": 1, "title": "a"}, {"key": "/books/OL2M", "revision": 3}])
+    cache.put_many([{"key": "/books/OL1M", "revision": 2, "title": "b"}])
+    cache.discard(["/books/OL2M"])
+    # The records are kept across restarts
+    cache = vacuumbot.RecordCache(self.filename)
+    self.assertEqual(cache.get_many(["/books/OL1M", "/books/OL2M"]), {"/books/OL1M": (2, {"key": "/books/OL1M", "revision": 2, "title": "b"})})
+
+  def test_eviction(self):
+    cache = vacuumbot.RecordCache(self.filename, maxbytes=1000)
+    for i in range(20):
+      cache.put_many([{"key": "/books/OL%dM" % i, "revision": 1, "title": os.urandom(100).encode("hex")}])
+      time.sleep(0.005)
+      # The first record keeps being used
+      cache.get_many(["/books/OL0M"])
+      time.sleep(0.005)
+    found = cache.get_many(["/books/OL%dM" % i for i in range(20)])
+    self.assertTrue("/books/OL0M" in found)
+    self.assertTrue("/books/OL19M" in found)
+    self.assertTrue(len(found) < 20)
+    self.assertTrue(cache.size <= 1000)
+
+class PatchTest(unittest.TestCase):
+  def test_diff_record(self):
+    self.assertEqual(vacuumbot.diff_record({"a": 1, "b": 2, "c": 3}, {"a": 1, "b": 4, "d": 5}), {"b": 4, "c": None, "d": 5})
+
+class LogWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_rotation(self):
+    filename = os.path.join(self.dir, "log.tsv")
+    log = vacuumbot.LogWriter(maxbytes=80, compress=True, interval=0.05)
+    lines = []
+    for i in range(4):
+      for j in range(5):
+        lines.append("line %d %d\n" % (i, j))
+        log.write(filename, unicode(lines[-1]))
+      time.sleep(0.2)
+    log.close()
+    rotated = [name for name in os.listdir(self.dir) if name != "log.tsv"]
+    self.assertTrue(len(rotated) >= 2)
+    self.assertTrue(all(name.startswith("log.tsv.") and name.endswith(".gz") for name in rotated))
+    written = "".join(gzip.open(os.path.join(self.dir, name)).read() for name in rotated)
+    if os.path.exists(filename):
+      written = written + open(filename).read()
+    self.assertEqual(sorted(written.splitlines(True)), sorted(lines))
+
+class FakeCleaner:
+  """Rule methods that record the order they are called in."""
+  def __init__(self):
+    self.calls = []
+
+  def replace_format2(self, obj, old, new):
+    self.calls.append("replace_format2")
+    if obj.get("physical_format") == old:
+      obj["physical_format"] = new
+      return obj, "replaced format"
+    return obj, None
+
+  def clean_format(self, obj):
+    self.calls.append("clean_format")
+    if obj["physical_format"] != obj["physical_format"].lower():
+      obj["physical_format"] = obj["physical_format"].lower()
+      return obj
+    return None
+
+  def add_by(self, obj, by):
+    self.calls.append("add_by")
+    obj["by_statement"] = by
+    return obj, "added by"
+
+  def clean_pagination(self, obj):
+    self.calls.append("clean_pagination")
+    return obj, None
+
+class TaskTest(unittest.TestCase):
+  def test_order_and_comment(self):
+    task = vacuumbot.Task(["clean_format", "replace_format2", "add_by", "clean_pagination"])
+    bot = FakeCleaner()
+    obj = {"physical_format": "pb"}
+    comment = task.run(bot, obj, [[], ["pb", "Paperback"], ["someone"], []])
+    self.assertEqual(comment, "replaced format; added by")
+    # clean_pagination has no field to read, and clean_format comes before the rule that wrote physical_format
+    self.assertEqual(bot.calls, ["clean_format", "replace_format2", "add_by"])
+    self.assertEqual(obj, {"physical_format": "Paperback", "by_statement": "someone"})
+
+  def test_later_rules_see_changes(self):
+    task = vacuumbot.Task(["replace_format2", "clean_format"])
+    bot = FakeCleaner()
+    obj = {"physical_format": "pb"}
+    self.assertEqual(task.run(bot, obj, [["pb", "Paperback"], []]), "replaced format; cleaned up physical format")
+    self.assertEqual(obj["physical_format"], "paperback")
+    self.assertEqual(bot.calls, ["replace_format2", "clean_format"])
+
+  def test_skip_empty(self):
+    task = vacuumbot.Task(["add_by"])
+    bot = FakeCleaner()
+    self.assertEqual(task.run(bot, {}, [[""]]), None)
+    self.assertEqual(bot.calls, [])
+
+  def test_shared_by_arguments(self):
+    bot = new.instance(vacuumbot.VacuumBot)
+    bot.tasks = {}
+    first = bot.task([("replace_format2", ["pb", "Paperback"])])
+    second = bot.task([("replace_format2", ["hc", "Hardcover"])])
+    self.assertTrue(first is second)
+    cleaner = FakeCleaner()
+    obj = {"physical_format": "hc"}
+    self.assertEqual(second.run(cleaner, obj, [["hc", "Hardcover"]]), "replaced format")
+    self.assertEqual(obj["physical_format"], "Hardcover")
+
+class RedirectStoreTest(unittest.TestCase):
+  RECORDS = {
+    "/a/1": {"key": "/a/1", "type": {"key": "/type/redirect"}, "location": "/a/2"},
+    "/a/2": {"key": "/a/2", "type": {"key": "/type/redirect"}, "location": "/a/3"},
+    "/a/3": {"key": "/a/3", "type": {"key": "/type/author"}},
+    "/a/4": {"key": "/a/4", "type": {"key": "/type/redirect"}, "location": "/a/5"},
+    "/a/5": {"key": "/a/5", "type": {"key": "/type/redirect"}, "location": "/a/4"},
+    "/a/6": {"key": "/a/6", "type": {"key": "/type/delete"}},
+  }
+
+  def setUp(self):
+    self.store = vacuumbot.RedirectStore(":memory:")
+    self.fetched = []
+
+  def fetch(self, keys):
+    self.fetched.append(sorted(keys))
+    return dict((k, self.RECORDS[k]) for k in keys if k in self.RECORDS)
+
+  def test_chains_and_cycles(self):
+    found = self.store.resolve_many(["/a/1", "/a/4", "/a/6", "/a/7"], self.fetch, undelete=lambda obj: "/a/3")
+    self.assertEqual(found, {"/a/1": "/a/3", "/a/6": "/a/3"})
+    # One fetch per hop, for all keys together
+    self.assertEqual(len(self.fetched), 3)
+    # The chain is stored compressed, the cycle and the missing key are not stored
+    self.assertEqual(self.store.get_many(["/a/1", "/a/2", "/a/3", "/a/4", "/a/5", "/a/7"]),
+                     {"/a/1": "/a/3", "/a/2": "/a/3", "/a/3": "/a/3"})
+
+  def test_stored_targets(self):
+    self.store.resolve_many(["/a/1"], self.fetch)
+    self.fetched = []
+    self.assertEqual(self.store.resolve_many(["/a/2", "/a/3"], self.fetch), {"/a/2": "/a/3", "/a/3": "/a/3"})
+    self.assertEqual(self.fetched, [])
+
+@needs_ol
+class AuthorTest(unittest.TestCase):
+  """Runs update_author_in_edition against the mock Open Library of vacuumbench."""
+  def setUp(self):
+    import vacuumbench
+    self.dir = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    os.chdir(self.dir)
+    records = {
+      "/authors/OL1A": {"key": "/authors/OL1A", "type": {"key": "/type/redirect"}, "location": "/authors/OL2A"},
+      "/authors/OL2A": {"key": "/authors/OL2A", "type": {"key": "/type/redirect"}, "location": "/authors/OL1A"},
+      "/authors/OL3A": {"key": "/authors/OL3A", "type": {"key": "/type/redirect"}, "location": "/authors/OL4A"},
+      "/authors/OL4A": {"key": "/authors/OL4A", "type": {"key": "/type/author"}},
+      "/books/OL1M": {"key": "/books/OL1M", "type": {"key": "/type/edition"}, "authors": [{"key": "/authors/OL1A"}]},
+      "/books/OL2M": {"key": "/books/OL2M", "type": {"key": "/type/edition"}, "authors": [{"key": "/authors/OL3A"}]},
+    }
+    self.server = vacuumbench.MockOpenLibrary(records)
+    self.server.start()
+    with open("errors3.txt", "wb") as f:
+      for key in ["/books/OL1M", "/books/OL2M"]:
+        f.write(simplejson.dumps({"error": "bad_data", "at": {"key": key}}) + "\n")
+    self.bot = vacuumbot.VacuumBot("user", "password", base_url=self.server.url(), limiter=fast_limiter(),
+                                   redirects=":memory:", journal=":memory:", logdir=self.dir)
+
+  def tearDown(self):
+    self.bot.close()
+    self.server.shutdown()
+    self.server.server_close()
+    os.chdir(self.cwd)
+    shutil.rmtree(self.dir)
+
+  def test_unresolved_authors_are_kept(self):
+    self.bot.update_author_in_edition()
+    # A redirect cycle leaves the edition as it was, without saving it
+    self.assertEqual(self.server.records["/books/OL1M"]["authors"], [{"key": "/authors/OL1A"}])
+    self.assertEqual(self.server.records["/books/OL1M"]["revision"], 1)
+    self.assertEqual(self.server.records["/books/OL2M"]["authors"], [{"key": "/authors/OL4A"}])
+
+class JournalTest(unittest.TestCase):
+  def test_progress(self):
+    journal = vacuumbot.Journal(":memory:")
+    self.assertFalse(journal.is_done("s", "p"))
+    self.assertEqual(journal.cursor("s", "p"), 0)
+    journal.advance("s", "p", 200)
+    self.assertEqual(journal.cursor("s", "p"), 200)
+    self.assertFalse(journal.is_done("s", "p"))
+    journal.advance("s", "p", 250, done=True)
+    self.assertTrue(journal.is_done("s", "p"))
+    journal.saved("s", ["/books/OL1M", "/books/OL2M"])
+    self.assertEqual(journal.saved_keys("s", ["/books/OL2M", "/books/OL3M"]), set(["/books/OL2M"]))
+    self.assertEqual(journal.saved_keys("t", ["/books/OL2M"]), set())
+    journal.reset("s")
+    self.assertFalse(journal.is_done("s", "p"))
+    self.assertEqual(journal.saved_keys("s", ["/books/OL2M"]), set())
+
+  def test_empty_queries(self):
+    journal = vacuumbot.Journal(":memory:")
+    journal.mark_empty({"death_date": "1900."})
+    queries = [{"death_date": "1900."}, {"death_date": "1901."}]
+    self.assertEqual(journal.not_empty(queries, 60), [{"death_date": "1901."}])
+    self.assertEqual(journal.not_empty(queries, -1), queries)
+
+class RedirectHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path == "/old":
+      self.send_response(301)
+      self.send_header("Location", "/new")
+      self.send_header("Content-Length", "0")
+      self.end_headers()
+    else:
+      self.send_response(200)
+      self.send_header("Content-Length", "2")
+      self.end_headers()
+      self.wfile.write("ok")
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    self.do_GET()
+
+  def log_message(self, *args):
+    pass
+
+@needs_ol
+class HTTPTransportTest(unittest.TestCase):
+  def setUp(self):
+    self.server = HTTPServer(("127.0.0.1", 0), RedirectHandler)
+    t = threading.Thread(target=self.server.serve_forever)
+    t.daemon = True
+    t.start()
+    self.transport = vacuumbot.HTTPTransport("http://127.0.0.1:" + str(self.server.server_address[1]))
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_follows_get_redirects(self):
+    response = self.transport.request("/old")
+    self.assertEqual(response.read(), "ok")
+    self.assertTrue(self.transport.redirected)
+
+  def test_post_redirect_raises(self):
+    self.assertRaises(vacuumbot.olapi.OLError, self.transport.request, "/old", "POST", "{}")
+
+class CoordinatorTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "shards.db")
+    self.coordinators = []
+
+  def tearDown(self):
+    for c in self.coordinators:
+      c.close()
+    shutil.rmtree(self.dir)
+
+  def coordinator(self, worker, **kw):
+    c = vacuumbot.Coordinator(self.filename, lease=0.3, **kw)
+    c.worker = worker
+    self.coordinators.append(c)
+    return c
+
+  def test_leases(self):
+    c1 = self.coordinator("one")
+    c2 = self.coordinator("two")
+    c1.add("s", ["a", "b"])
+    self.assertEqual(c1.claim("s"), "a")
+    self.assertEqual(c2.claim("s"), "b")
+    # The lease of a live worker is renewed
+    time.sleep(0.6)
+    self.assertEqual(c2.claim("s"), None)
+    # A dead worker's lease runs out and the shard is taken over
+    c1.held.clear()
+    time.sleep(0.6)
+    self.assertEqual(c2.claim("s"), "a")
+    c2.finish("s", "a")
+    c2.finish("s", "b")
+    self.assertEqual(c1.claim("s"), None)
+
+  def test_release(self):
+    c1 = self.coordinator("one")
+    c2 = self.coordinator("two")
+    c1.add("s", ["a"])
+    self.assertEqual(c1.claim("s"), "a")
+    # Only the owner can give a shard back
+    c2.release("s", "a")
+    self.assertEqual(c2.claim("s"), None)
+    c1.release("s", "a", 0.3)
+    self.assertEqual(c2.claim("s"), None)
+    time.sleep(0.5)
+    self.assertEqual(c2.claim("s"), "a")
+
+  def test_finish_after_losing_the_lease(self):
+    c1 = self.coordinator("one")
+    c2 = self.coordinator("two")
+    c1.add("s", ["a"])
+    self.assertEqual(c1.claim("s"), "a")
+    with c1.lock:
+      c1.held.clear()
+    time.sleep(0.6)
+    self.assertEqual(c2.claim("s"), "a")
+    # The first worker comes back, but the shard is no longer its own
+    c1.finish("s", "a")
+    c2.release("s", "a")
+    self.assertEqual(c1.claim("s"), "a")
+
+  def test_restart(self):
+    c = self.coordinator("one")
+    c.add("s", ["a", "b"])
+    c.finish("s", c.claim("s"))
+    self.assertFalse(c.restart("s"))
+    c.finish("s", c.claim("s"))
+    self.assertTrue(c.restart("s"))
+    self.assertFalse(c.restart("s"))
+    c.add("s", ["a"])
+    self.assertEqual(c.claim("s"), "a")
+
+  def test_last_run(self):
+    c = self.coordinator("one")
+    self.assertEqual(c.last_run(), None)
+    c.add("s run 1", ["a"])
+    c.add("s", ["a"])
+    c.add("s run 2", ["a"])
+    self.assertEqual(c.last_run(), "2")
+
+@needs_ol
+class BisectionTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.deadletter = os.path.join(self.dir, "deadletter.jsonl")
+    self.bot = vacuumbot.VacuumBot(None, None, limiter=fast_limiter(), redirects=":memory:", journal=":memory:",
+                                   deadletter=self.deadletter, logdir=self.dir)
+    self.batch = dict(("/books/OL%dM" % i, {"key": "/books/OL%dM" % i}) for i in range(1, 151))
+
+  def tearDown(self):
+    self.bot.close()
+    shutil.rmtree(self.dir)
+
+  def dead_letters(self):
+    if not os.path.exists(self.deadletter):
+      return []
+    return sorted(simplejson.loads(line)["key"] for line in open(self.deadletter))
+
+  def test_bad_record_found(self):
+    bad = set(["/books/OL7M", "/books/OL99M"])
+    self.bot.ol = Client(lambda records: ol_error(400, "Bad Request", '{"error": "bad_data"}')
+                         if bad & set(r["key"] for r in records) else None)
+    self.assertEqual(self.bot._save_batch("test", dict(self.batch)), {})
+    self.assertEqual(self.dead_letters(), sorted(bad))
+    self.assertEqual(sorted(self.bot.ol.saved), sorted(set(self.batch) - bad))
+    # Far fewer calls than one per record
+    self.assertTrue(self.bot.ol.calls < 30)
+
+  def test_named_record(self):
+    def fail(records):
+      if "/books/OL7M" in [r["key"] for r in records]:
+        return ol_error(400, "Bad Request", '{"error": "bad_data", "at": {"key": "/books/OL7M"}}')
+    self.bot.ol = Client(fail)
+    self.assertEqual(self.bot._save_batch("test", dict(self.batch)), {})
+    self.assertEqual(self.bot.ol.calls, 2)
+    self.assertEqual(self.dead_letters(), ["/books/OL7M"])
+
+  def test_call_errors_are_not_bisected(self):
+    self.bot.ol = Client(lambda records: ol_error(403, "Forbidden"))
+    self.assertEqual(self.bot._save_batch("test", dict(self.batch)), self.batch)
+    self.assertEqual(self.bot.ol.calls, 1)
+    self.assertEqual(self.dead_letters(), [])
+
+  def test_single_record_conflict(self):
+    conflicts = []
+    self.bot._conflict = conflicts.append
+    self.bot.ol = Client(lambda records: ol_error(409, "Conflict", '{"error": "conflict"}'))
+    self.assertEqual(self.bot._save_batch("test", {"/books/OL1M": {"key": "/books/OL1M"}}), {})
+    self.assertEqual(conflicts, ["/books/OL1M"])
+    self.assertEqual(self.dead_letters(), [])
+
+@needs_ol
+class SweepTest(unittest.TestCase):
+  """Runs replace_formats_clean_pagination2 against the mock Open Library of vacuumbench."""
+  def setUp(self):
+    import vacuumbench
+    self.dir = tempfile.mkdtemp()
+    records, self.reject, errors = vacuumbench.make_corpus(100)
+    self.server = vacuumbench.MockOpenLibrary(records, self.reject, 0.0, 0.0)
+    self.server.start()
+    self.bots = []
+
+  def tearDown(self):
+    for bot in self.bots:
+      bot.close()
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.dir)
+
+  def bot(self, username="user", **kw):
+    bot = vacuumbot.VacuumBot(username, "password", base_url=self.server.url(), limiter=fast_limiter(), retries=0,
+                              redirects=os.path.join(self.dir, "redirects.db"), journal=os.path.join(self.dir, "journal.db"),
+                              deadletter=os.path.join(self.dir, "deadletter.jsonl"), logdir=self.dir, emptyage=0, **kw)
+    self.bots.append(bot)
+    return bot
+
+  def dirty(self):
+    return set(key for key, record in self.server.records.items() if record.get("physical_format") == "pepperbek")
+
+  def make_dirty(self, keys):
+    for key in keys:
+      self.server._index(key, self.server.records[key], False)
+      self.server.records[key]["physical_format"] = "pepperbek"
+      self.server._index(key, self.server.records[key], True)
+
+  def sweep(self, bot, resume=False):
+    bot.replace_formats_clean_pagination2("pepperbek", "Paperback", resume=resume)
+
+  def test_resume_after_outage(self):
+    bot = self.bot()
+    before = self.dirty()
+    self.assertTrue(len(before - set(self.reject)) > 0)
+    def down(*args):
+      raise socket.error("OL is down")
+    bot.ol.save_many = down
+    self.sweep(bot)
+    # The records are still in the buffer, so the partition is not finished
+    self.assertEqual(set(bot.savebuffer.pending()), before)
+    self.assertEqual(bot.journal.db.execute("SELECT done FROM partitions").fetchall(), [(0,)])
+    del bot.ol.save_many
+    self.sweep(bot, resume=True)
+    self.assertEqual(bot.journal.db.execute("SELECT done FROM partitions").fetchall(), [(1,)])
+    self.assertTrue(self.dirty() <= set(self.reject))
+    # A finished partition is not queried again
+    queried = self.server.calls.get("query", 0)
+    self.sweep(bot, resume=True)
+    self.assertEqual(self.server.calls.get("query", 0), queried)
+
+  def test_shards_start_over(self):
+    coordinator = vacuumbot.Coordinator(os.path.join(self.dir, "shards.db"), lease=5)
+    bot = self.bot(coordinator=coordinator)
+    before = self.dirty()
+    self.sweep(bot)
+    self.assertTrue(self.dirty() <= set(self.reject))
+    clean = sorted(before - self.dirty())[:5]
+    self.make_dirty(clean)
+    # All shards were finished, so the next sweep does them all again
+    self.sweep(bot)
+    self.assertTrue(self.dirty() <= set(self.reject))
+
+  def test_runs(self):
+    filename = os.path.join(self.dir, "shards.db")
+    before = self.dirty()
+    self.sweep(self.bot(coordinator=vacuumbot.Coordinator(filename, lease=5, run="1")))
+    clean = sorted(before - self.dirty())[:5]
+    self.make_dirty(clean)
+    # Joining a finished run does nothing, a new run does the whole sweep
+    self.sweep(self.bot(coordinator=vacuumbot.Coordinator(filename, lease=5, run="1")))
+    self.assertEqual(self.dirty() & set(clean), set(clean))
+    self.sweep(self.bot(coordinator=vacuumbot.Coordinator(filename, lease=5, run="2")))
+    self.assertTrue(self.dirty() <= set(self.reject))
+    self.assertEqual(vacuumbot.Coordinator(filename).last_run(), "2")
+
+  def worker_options(self):
+    return {"username": "user", "password": "password", "base_url": self.server.url(), "limiter": fast_limiter(),
+            "retries": 0, "emptyage": 0, "redirects": os.path.join(self.dir, "redirects.db"),
+            "journal": os.path.join(self.dir, "journal.db"), "deadletter": os.path.join(self.dir, "deadletter.jsonl"),
+            "logdir": self.dir}
+
+  def test_run_workers(self):
+    filename = os.path.join(self.dir, "shards.db")
+    codes = vacuumbot.run_workers(2, filename, "replace_formats_clean_pagination2", ("pepperbek", "Paperback"),
+                                  **self.worker_options())
+    self.assertEqual(codes, [0, 0])
+    self.assertTrue(self.dirty() <= set(self.reject))
+    run = vacuumbot.Coordinator(filename).last_run()
+    self.assertNotEqual(run, None)
+    finished = vacuumbot.Coordinator(filename).db.execute("SELECT count(*), sum(done) FROM shards").fetchone()
+    self.assertEqual(finished[0], finished[1])
+
+  def test_worker_saves_buffer_on_error(self):
+    key = sorted(self.dirty())[0]
+    def fail(bot):
+      bot.ol_save2(key, dict(self.server.records[key], physical_format="Paperback"), "test")
+      raise ValueError("the sweep failed")
+    vacuumbot.VacuumBot.fail = fail
+    try:
+      options = self.worker_options()
+      options["buffer"] = {"maxage": 3600}
+      self.assertRaises(ValueError, vacuumbot._run_worker, os.path.join(self.dir, "shards.db"), "1", "fail", (), options)
+    finally:
+      del vacuumbot.VacuumBot.fail
+    self.assertEqual(self.server.records[key]["physical_format"], "Paperback")
+
+  def test_cli_runs(self):
+    config = os.path.join(self.dir, "config.json")
+    with open(config, "wb") as f:
+      simplejson.dump({"username": "user", "password": "password", "base_url": self.server.url(), "coordinator": "shards.db",
+                       "emptyage": 0, "retries": 0, "limiter": {"reads": 1000, "writes": 1000, "maxreads": 1000, "maxwrites": 1000}}, f)
+    args = ["--config", config, "--dir", self.dir]
+    before = self.dirty()
+    self.assertEqual(vacuumbot.main(args + ["--run", "7", "formats", "pepperbek", "Paperback"]), 0)
+    self.assertTrue(self.dirty() <= set(self.reject))
+    self.assertEqual(vacuumbot.Coordinator(os.path.join(self.dir, "shards.db")).last_run(), "7")
+    # Without --run, the sweep is shared with the other workers of the coordinator
+    self.make_dirty(sorted(before - set(self.reject))[:3])
+    self.assertEqual(vacuumbot.main(args + ["formats", "pepperbek", "Paperback"]), 0)
+    self.assertTrue(self.dirty() <= set(self.reject))
+    self.assertTrue(os.path.exists(os.path.join(self.dir, "vacuumbot-journal.db")))
+
+  def test_record_cache(self):
+    bot = self.bot(cache={"filename": os.path.join(self.dir, "records.db")})
+    keys = sorted(self.dirty())[:10]
+    self.assertEqual(sorted(bot.get_many(keys)), keys)
+    fetched = self.server.calls.get("get_many", 0)
+    # Cached records whose revision is still current are not fetched again
+    self.assertEqual(sorted(bot.get_many(keys)), keys)
+    self.assertEqual(self.server.calls.get("get_many", 0), fetched)
+    self.server.records[keys[0]]["revision"] = 2
+    self.assertEqual(bot.get_many(keys)[keys[0]]["revision"], 2)
+    self.assertEqual(self.server.calls.get("get_many", 0), fetched + 1)
+
+  def test_command_file(self):
+    keys = sorted(self.dirty() - set(self.reject))[:3]
+    filename = os.path.join(self.dir, "commands.txt.gz")
+    with gzip.open(filename, "wb") as f:
+      f.write("# a comment\n")
+      for key in keys:
+        f.write(key + "\treplace_format2\tpepperbek\tPaperback\n")
+      f.write(keys[0] + "\tremove_key\ttitle\n")
+      f.write(keys[1] + "\tno_such_command\n")
+      f.write("/books/OL999999M\tclean_pagination\n")
+    bot = self.bot()
+    bot.vacuum(filename, sort=True, chunksize=2)
+    for key in keys:
+      self.assertEqual(self.server.records[key]["physical_format"], "Paperback")
+      # All commands for a record are saved together
+      self.assertEqual(self.server.records[key]["revision"], 2)
+    self.assertFalse("title" in self.server.records[keys[0]])
+    bot.log.close()
+    errors = open(os.path.join(self.dir, "vacuumbot-errors.txt")).read()
+    self.assertTrue("Unknown command on line 6: no_such_command" in errors)
+    self.assertTrue("/books/OL999999M" in errors)
+
+  def test_dry_run_and_upload(self):
+    prefix = os.path.join(self.dir, "patches")
+    before = self.dirty()
+    bot = self.bot(username=None, dryrun={"prefix": prefix, "maxrecords": 10})
+    self.sweep(bot)
+    bot.close()
+    self.assertEqual(self.dirty(), before)
+    self.assertEqual(self.server.calls.get("save_many", 0), 0)
+    patches = list(vacuumbot.read_patches(prefix))
+    editions = dict((p["key"], p) for p in patches if p["key"].startswith("/books/"))
+    self.assertEqual(set(editions), before)
+    self.assertTrue(all(p["diff"]["physical_format"] == "Paperback" for p in editions.values()))
+    self.assertEqual(len([name for name in os.listdir(self.dir) if name.startswith("patches-")]), (len(patches) + 9) / 10)
+    # A record that changed since the dry run is left alone
+    changed = sorted(before - set(self.reject))[0]
+    self.server.records[changed]["revision"] = 2
+    self.assertEqual(self.bot().upload_patches(prefix), len(patches) - 1)
+    self.assertEqual(self.dirty(), (set(self.reject) & before) | set([changed]))
+
+  def test_cli_dry_run(self):
+    config = os.path.join(self.dir, "config.json")
+    with open(config, "wb") as f:
+      simplejson.dump({"base_url": self.server.url(), "dryrun": {"prefix": "patches"}, "emptyage": 0}, f)
+    before = self.dirty()
+    self.assertEqual(vacuumbot.main(["--config", config, "--dir", self.dir, "formats", "pepperbek", "Paperback"]), 0)
+    self.assertEqual(self.dirty(), before)
+    self.assertEqual(self.server.calls.get("save_many", 0), 0)
+    patched = set(p["key"] for p in vacuumbot.read_patches(os.path.join(self.dir, "patches")))
+    self.assertTrue(before <= patched)
+    # Without a dry run, the sweep needs an account
+    with open(config, "wb") as f:
+      simplejson.dump({"base_url": self.server.url()}, f)
+    self.assertRaises(SystemExit, vacuumbot.main, ["--config", config, "--dir", self.dir, "formats", "pepperbek", "Paperback"])
+
+@needs_ol
+class DumpTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    os.chdir(self.dir)
+    with gzip.open("dump.txt.gz", "wb") as f:
+      for i, (format, pagination) in enumerate([("pepperbek", "12 p. ;"), ("Paperback", "20 p."), ("pb", None)]):
+        record = {"key": "/books/OL%dM" % (i + 1), "type": {"key": "/type/edition"}, "physical_format": format}
+        if pagination != None:
+          record["pagination"] = pagination
+        f.write("\t".join(["/type/edition", record["key"], "1", "2010-01-01", simplejson.dumps(record)]) + "\n")
+      f.write("/type/author\t/authors/OL1A\t1\t2010-01-01\t" + simplejson.dumps({"key": "/authors/OL1A", "physical_format": "pepperbek"}) + "\n")
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.dir)
+
+  def changes(self):
+    lines = gzip.open("changes.txt.gz").read().splitlines()
+    return dict((key, simplejson.loads(data)) for key, comment, data in (line.split("\t") for line in lines))
+
+  def test_process_dump(self):
+    steps = [("replace_format2", ["pepperbek", "Paperback"]), ("clean_pagination", [])]
+    total = vacuumbot.process_dump("dump.txt.gz", "changes.txt.gz", steps, types=["/type/edition"], processes=2, chunksize=1)
+    self.assertEqual(total, [3, 1])
+    changes = self.changes()
+    self.assertEqual(changes.keys(), ["/books/OL1M"])
+    self.assertEqual(changes["/books/OL1M"]["physical_format"], "Paperback")
+    # The workers keep no state: no databases or logs in the working directory
+    self.assertEqual(sorted(os.listdir(".")), ["changes.txt.gz", "dump.txt.gz"])
+
+  def test_formatdict(self):
+    with open("formats.json", "wb") as f:
+      simplejson.dump({"pb": "Paperback"}, f)
+    vacuumbot.process_dump("dump.txt.gz", "changes.txt.gz", [("clean_format", [])], processes=1, formatdict="formats.json")
+    self.assertEqual(dict((k, v["physical_format"]) for k, v in self.changes().items()), {"/books/OL3M": "Paperback"})
+
+  def test_cli(self):
+    os.mkdir("state")
+    with open(os.path.join("state", "formats.json"), "wb") as f:
+      simplejson.dump({"pb": "Paperback"}, f)
+    with open("config.json", "wb") as f:
+      simplejson.dump({"formatdict": "formats.json"}, f)
+    self.assertEqual(vacuumbot.main(["--config", "config.json", "--dir", "state", "clean-dump", "dump.txt.gz", "changes.txt.gz",
+                                     "--types", "/type/edition", "--processes", "1",
+                                     "--step", "replace_format2", "pepperbek", "Paperback", "--step", "clean_format"]), 0)
+    self.assertEqual(dict((k, v["physical_format"]) for k, v in self.changes().items()),
+                     {"/books/OL1M": "Paperback", "/books/OL3M": "Paperback"})
+    # The formatdict is taken from --dir, and nothing else is written there or here
+    self.assertEqual(os.listdir("state"), ["formats.json"])
+    self.assertEqual(sorted(os.listdir(".")), ["changes.txt.gz", "config.json", "dump.txt.gz", "state"])
+    self.assertRaises(SystemExit, vacuumbot.main, ["clean-dump", "dump.txt.gz", "changes.txt.gz", "--step", "no_such_step"])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+"""Benchmarks for VacuumBot, against a local stand-in for the Open Library API.
+
+  Starts a MockOpenLibrary server on localhost with a synthetic corpus of editions,
+  works and authors (with redirect chains, deleted authors and records that OL rejects
+  as bad data), runs the public sweeps against it and reports records per second, API
+  calls per record, p50/p99 batch latency and peak RSS for each of them.
+
+  Results can be kept as a baseline, so later runs show regressions:
+
+    python vacuumbench.py --records 2000 --latency 0.02 --save-baseline
+    python vacuumbench.py --records 2000 --latency 0.02
+  """
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import argparse, fnmatch, gzip, multiprocessing, os, Queue, random, resource, shutil, StringIO, sys, tempfile, threading, time, traceback, urlparse
+import simplejson
+
+import vacuumbot
+
+class MockOpenLibrary(ThreadingMixIn, HTTPServer):
+  """A local server with the parts of the Open Library API that the OpenLibrary client uses.
+
+  Supports login, get, get_many, query, save and save_many on an in-memory corpus, with
+  keep-alive connections and gzipped request and response bodies.
+  Every request waits latency seconds, and fails with a 503 with probability errorrate.
+  save_many rejects batches that contain a key from reject, like OL does with bad data.
+  """
+  daemon_threads = True
+  indexed = ["type", "physical_format", "death_date"]
+
+  def __init__(self, records, reject=(), latency=0.0, errorrate=0.0, port=0):
+    HTTPServer.__init__(self, ("127.0.0.1", port), MockHandler)
+    self.records = records
+    self.reject = set(reject)
+    self.latency = latency
+    self.errorrate = errorrate
+    self.lock = threading.Lock()
+    self.calls = {}
+    self.queried = 0
+    self.index = {}
+    for key, record in records.iteritems():
+      # Like on OL, every record has a revision
+      record.setdefault("revision", 1)
+      self._index(key, record, 1)
+
+  def url(self):
+    return "http://127.0.0.1:" + str(self.server_address[1])
+
+  def start(self):
+    t = threading.Thread(target=self.serve_forever)
+    t.daemon = True
+    t.start()
+
+  def _index(self, key, record, add):
+    for field in self.indexed:
+      value = record.get(field)
+      if isinstance(value, dict):
+        value = value.get("key")
+      if isinstance(value, basestring):
+        keys = self.index.setdefault((field, value), set())
+        if add:
+          keys.add(key)
+        else:
+          keys.discard(key)
+
+  def count(self, call):
+    with self.lock:
+      self.calls[call] = self.calls.get(call, 0) + 1
+
+  def query(self, q):
+    with self.lock:
+      candidates = None
+      for field, value in q.iteritems():
+        if field in self.indexed:
+          found = self.index.get((field, value), set())
+          candidates = found if candidates == None else candidates & found
+      if "key" in q:
+        found = set(k for k in (q["key"] if isinstance(q["key"], list) else [q["key"]]) if k in self.records)
+        candidates = found if candidates == None else candidates & found
+      if candidates == None:
+        candidates = self.records.keys()
+      keys = []
+      for key in sorted(candidates):
+        if "key>" in q and key <= q["key>"]:
+          continue
+        if "key~" in q and not fnmatch.fnmatchcase(key, q["key~"]):
+          continue
+        record = self.records[key]
+        if all(record.get(f) == v for f, v in q.iteritems() if f not in self.indexed and f not in ("key", "key>", "key~", "limit", "offset", "sort") and v != None):
+          keys.append(key)
+      offset = q.get("offset", 0)
+      keys = keys[offset:offset + q.get("limit", 20)]
+      self.queried = self.queried + len(keys)
+      # Fields asked for with None are returned with the keys
+      fields = [f for f, v in q.iteritems() if v == None]
+      return [dict([("key", key)] + [(f, self.records[key].get(f)) for f in fields]) for key in keys]
+
+  def save(self, record):
+    with self.lock:
+      key = record["key"]
+      old = self.records.get(key)
+      if old != None:
+        self._index(key, old, 0)
+        record["revision"] = old.get("revision", 1) + 1
+      self.records[key] = record
+      self._index(key, record, 1)
+    return {"key": key, "revision": record.get("revision", 1)}
+
+class MockHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    pass
+
+  def _reply(self, code, data, headers=None):
+    body = simplejson.dumps(data)
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    if "gzip" in self.headers.get("Accept-Encoding", ""):
+      out = StringIO.StringIO()
+      with gzip.GzipFile(fileobj=out, mode="wb") as f:
+        f.write(body)
+      body = out.getvalue()
+      self.send_header("Content-Encoding", "gzip")
+    self.send_header("Content-Length", str(len(body)))
+    for name, value in (headers or {}).iteritems():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _body(self):
+    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    if self.headers.get("Content-Encoding") == "gzip":
+      body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+    return body
+
+  def _start(self, call):
+    self.server.count(call)
+    time.sleep(self.server.latency)
+    if call != "login" and random.random() < self.server.errorrate:
+      self._reply(503, {"error": "unavailable"})
+      return False
+    return True
+
+  def do_GET(self):
+    path, _, qs = self.path.partition("?")
+    params = urlparse.parse_qs(qs)
+    if path == "/api/get_many":
+      if self._start("get_many"):
+        keys = simplejson.loads(params["keys"][0])
+        records = self.server.records
+        self._reply(200, {"status": "ok", "result": dict((k, records[k]) for k in keys if k in records)})
+    elif path == "/query.json":
+      if self._start("query"):
+        self._reply(200, self.server.query(simplejson.loads(params["query"][0])))
+    elif path.endswith(".json"):
+      if self._start("get"):
+        record = self.server.records.get(path[:-len(".json")])
+        if record == None:
+          self._reply(404, {"error": "notfound"})
+        else:
+          self._reply(200, record)
+    else:
+      self._reply(404, {"error": "notfound"})
+
+  def do_POST(self):
+    if self.path == "/account/login":
+      self._body()
+      if self._start("login"):
+        self._reply(200, {}, {"Set-Cookie": "session=/people/bench%2C2012; Path=/"})
+    elif self.path == "/api/save_many":
+      records = simplejson.loads(self._body())
+      if self._start("save_many"):
+        for record in records:
+          if record["key"] in self.server.reject:
+            self._reply(400, {"error": "bad_data", "message": "Bad data", "at": {"key": record["key"]}})
+            return
+        self._reply(200, [self.server.save(record) for record in records])
+    else:
+      self._reply(404, {"error": "notfound"})
+
+  def do_PUT(self):
+    record = simplejson.loads(self._body())
+    if self._start("save"):
+      if record["key"] in self.server.reject:
+        self._reply(400, {"error": "bad_data", "message": "Bad data", "at": {"key": record["key"]}})
+      else:
+        self._reply(200, self.server.save(record))
+
+def make_corpus(n, seed=1):
+  """Returns a synthetic corpus of about n editions with their works and authors.
+
+  Returns a tuple (records, reject, errors): the records by key, the keys that save_many
+  rejects, and the bad_data errors for editions with outdated author references, as
+  read by update_author_in_edition.
+  """
+  rnd = random.Random(seed)
+  records = {}
+  nauthors = max(10, n / 10)
+  for i in range(nauthors):
+    key = "/authors/OL%dA" % (i + 1)
+    r = rnd.random()
+    if r < 0.15 and i > 2:
+      # Redirect to an earlier author, which may redirect again
+      records[key] = {"key": key, "type": {"key": "/type/redirect"}, "location": "/authors/OL%dA" % rnd.randint(1, i)}
+    elif r < 0.17:
+      records[key] = {"key": key, "type": {"key": "/type/delete"}}
+    else:
+      records[key] = {"key": key, "type": {"key": "/type/author"}, "name": "Author %d" % i}
+      if rnd.random() < 0.3:
+        records[key]["death_date"] = "%d." % rnd.choice(range(0, 10) + range(1900, 1910))
+  nworks = max(5, n / 2)
+  for i in range(nworks):
+    key = "/works/OL%dW" % (i + 1)
+    records[key] = {"key": key, "type": {"key": "/type/work"}, "title": "Work %d" % i}
+    if rnd.random() < 0.5:
+      records[key]["authors"] = [{"type": {"key": "/type/author_role"}, "author": {"key": "/authors/OL%dA" % rnd.randint(1, nauthors)}}]
+  reject = []
+  errors = []
+  for i in range(n):
+    key = "/books/OL%dM" % (i + 1)
+    author = "/authors/OL%dA" % rnd.randint(1, nauthors)
+    records[key] = {"key": key, "type": {"key": "/type/edition"}, "title": "Edition %d" % i,
+                    "physical_format": rnd.choice(["pepperbek", "pepperbek", "Paperback", "Hardcover"]),
+                    "works": [{"key": "/works/OL%dW" % rnd.randint(1, nworks)}],
+                    "authors": [{"key": author}]}
+    if rnd.random() < 0.5:
+      records[key]["pagination"] = "%d p. ;" % rnd.randint(10, 900)
+    if rnd.random() < 0.02:
+      reject.append(key)
+    if records[author]["type"]["key"] != "/type/author":
+      errors.append({"error": "bad_data", "message": "Bad reference", "at": {"key": key, "property": "authors"}})
+  return records, reject, errors
+
+SWEEPS = [
+  ("replace_formats_clean_pagination2", lambda vb: vb.replace_formats_clean_pagination2("pepperbek", "Paperback")),
+  ("replace_split_formats_clean_pagination", lambda vb: vb.replace_split_formats_clean_pagination("pepperbek", "Paperback", "by Foo", "A subtitle", "")),
+  ("clean_author_dates2", lambda vb: vb.clean_author_dates2()),
+  ("update_author_in_edition", lambda vb: vb.update_author_in_edition()),
+]
+
+def percentile(values, p):
+  if len(values) == 0:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def run_sweep(name, sweep, options, results):
+  """Runs one sweep in its own process and puts its measures, or the error it raised, in results."""
+  try:
+    results.put(measure_sweep(name, sweep, options))
+  except BaseException:
+    results.put({"error": traceback.format_exc()})
+
+def measure_sweep(name, sweep, options):
+  """Runs one sweep against a fresh server and corpus, and returns its measures."""
+  records, reject, errors = make_corpus(options.records, options.seed)
+  server = MockOpenLibrary(records, reject, options.latency, options.error_rate)
+  server.start()
+  workdir = tempfile.mkdtemp(prefix="vacuumbench-")
+  here = os.path.dirname(os.path.abspath(__file__))
+  shutil.copy(os.path.join(here, "formatdict.json"), workdir)
+  os.chdir(workdir)
+  with open("errors3.txt", "wb") as f:
+    for error in errors:
+      f.write(simplejson.dumps(error) + "\n")
+  # The bot reports every record; keep the benchmark output readable
+  sys.stdout = open(os.devnull, "w")
+  limiter = vacuumbot.RateLimiter(options.reads, options.writes, options.reads * 4, options.writes * 4)
+  transport = {"gzip_requests": True} if options.transport else None
+  vb = vacuumbot.VacuumBot("bench", "bench", limiter=limiter, base_url=server.url(), transport=transport)
+  latencies = []
+  call = vb._ol_call
+
+  def timed_call(kind, method, *args):
+    start = time.time()
+    try:
+      return call(kind, method, *args)
+    finally:
+      if method in ("get_many", "save_many"):
+        latencies.append(time.time() - start)
+
+  vb._ol_call = timed_call
+  server.calls = {}
+  start = time.time()
+  sweep(vb)
+  vb.close()
+  elapsed = time.time() - start
+  n = len(errors) if name == "update_author_in_edition" else server.queried
+  calls = sum(server.calls.values())
+  shutil.rmtree(workdir, True)
+  return {
+    "records": n,
+    "seconds": round(elapsed, 3),
+    "records_per_s": round(n / max(elapsed, 0.001), 1),
+    "calls_per_record": round(calls / float(max(n, 1)), 3),
+    "calls": server.calls,
+    "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+    "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+  }
+
+def compare(result, base, tolerance):
+  """Returns the names of the measures in result that are worse than base by more than tolerance."""
+  worse = []
+  if result["records_per_s"] < base["records_per_s"] * (1 - tolerance):
+    worse.append("records_per_s")
+  for measure in ["calls_per_record", "p50_ms", "p99_ms", "peak_rss_kb"]:
+    if result[measure] > base[measure] * (1 + tolerance) and result[measure] - base[measure] > 0.001:
+      worse.append(measure)
+  return worse
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark VacuumBot sweeps against a local mock Open Library.")
+  parser.add_argument("--records", type=int, default=1000, help="number of editions in the corpus")
+  parser.add_argument("--latency", type=float, default=0.01, help="seconds the server waits per request")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail with a 503")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--reads", type=float, default=100.0, help="initial reads per second of the rate limiter")
+  parser.add_argument("--writes", type=float, default=50.0, help="initial writes per second of the rate limiter")
+  parser.add_argument("--sweeps", nargs="*", help="sweeps to run (default: all)")
+  parser.add_argument("--transport", action="store_true", help="use the pooled keep-alive HTTPTransport")
+  parser.add_argument("--baseline", default="bench-baseline.json", help="file with the baseline results")
+  parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+  parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative change before reporting a regression")
+  options = parser.parse_args(argv)
+
+  baseline = {}
+  if os.path.exists(options.baseline):
+    baseline = simplejson.load(open(options.baseline))
+  results = {}
+  regressions = 0
+  failures = 0
+  print "%-40s %8s %10s %10s %8s %8s %10s" % ("sweep", "records", "records/s", "calls/rec", "p50 ms", "p99 ms", "peak RSS")
+  for name, sweep in SWEEPS:
+    if options.sweeps and name not in options.sweeps:
+      continue
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run_sweep, args=(name, sweep, options, queue))
+    p.start()
+    result = None
+    while result == None:
+      try:
+        result = queue.get(timeout=1)
+      except Queue.Empty:
+        if not p.is_alive():
+          # It may have put its result just before it exited
+          try:
+            result = queue.get(timeout=1)
+          except Queue.Empty:
+            result = {"error": "the sweep process exited with code " + str(p.exitcode) + "\n"}
+    p.join()
+    if "error" in result:
+      failures = failures + 1
+      print "%-40s FAILED" % name
+      sys.stderr.write(result["error"])
+      continue
+    results[name] = result
+    worse = []
+    if name in baseline:
+      worse = compare(result, baseline[name], options.tolerance)
+      regressions = regressions + len(worse)
+    print "%-40s %8d %10.1f %10.3f %8.1f %8.1f %10d %s" % (name, result["records"], result["records_per_s"],
+      result["calls_per_record"], result["p50_ms"], result["p99_ms"], result["peak_rss_kb"],
+      ("REGRESSION: " + ", ".join(worse)) if worse else "")
+  if options.save_baseline and failures > 0:
+    print "Not saving the baseline, because sweeps failed"
+  elif options.save_baseline:
+    with open(options.baseline, "wb") as f:
+      simplejson.dump(results, f, indent=2, sort_keys=True)
+    print "Saved baseline to", options.baseline
+  return 1 if regressions > 0 or failures > 0 else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -10,50 +10,1800 @@
   This is a work in progress.
   """
 
-from time import localtime, sleep, strftime
-from openlibrary.api import OpenLibrary, OLError, marshal, unmarshal, Text, Reference
-import codecs, re, simplejson, sys
+from time import localtime, sleep, strftime, time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from UserDict import DictMixin
+import codecs, re, sys
+import atexit, signal, threading, Queue
+import collections, glob, gzip, hashlib, heapq, importlib, multiprocessing, os, random, shutil, sqlite3, tempfile
+import httplib, itertools, socket, StringIO, urllib2, urlparse, zlib
+
+class LazyModule(object):
+  """A module that is imported when one of its attributes is first used.
+  
+  The OL client, simplejson and nomenklatura take longer to import than a short run
+  takes to do its work, and some runs (like dump jobs) never need all of them.
+  """
+  def __init__(self, name):
+    self._name = name
+    self._module = None
+  
+  def __getattr__(self, attr):
+    if self._module == None:
+      self._module = importlib.import_module(self._name)
+    return getattr(self._module, attr)
+
+olapi = LazyModule("openlibrary.api")
+simplejson = LazyModule("simplejson")
+nomenklatura = LazyModule("nomenklatura")
+
+# The formats that come with VacuumBot, found next to this file rather than in the working directory
+FORMATDICT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "formatdict.json")
 
-import nomenklatura
-import itertools
-"""
 class NKCache(object):
-"""
-"""Interface to the Nomenklatura reconciliation database with local caching.
+  """Interface to the Nomenklatura reconciliation database with local caching.
   
   Code for this class was adapted from 
   http://schoolofdata.org/handbook/recipes/reconciling-data-with-nomenklatura/
-"""
-"""def __init__(self,dataset,key):
-      self.ds=nomenklatura.Dataset(dataset,api_key=key)
+  
+  All links of the dataset are loaded into a local sqlite store, and loaded again by a
+  background thread once they are maxage seconds old, also during a long run. The
+  Nomenklatura API can only list all links, so each reload is a full one. Lookups are
+  answered from memory only. A key that is not known is queued and None is returned;
+  every interval seconds the background thread looks up the queued keys, one call per
+  key as the API has no batch lookup, and stores the answers, also when there is no
+  match (for negative_ttl seconds, after which the key is looked up again).
+  
+  dataset is a nomenklatura.Dataset, or any object with the same links(), lookup() and
+  NoMatch, like LocalDataset.
+  """
+  def __init__(self, dataset, filename="vacuumbot-formats.db", maxage=7 * 86400, negative_ttl=86400, interval=10):
+    self.ds = dataset
+    self.maxage = maxage
+    self.negative_ttl = negative_ttl
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute("CREATE TABLE IF NOT EXISTS links (key TEXT PRIMARY KEY, value TEXT, checked REAL)")
+    self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value REAL)")
+    self.db.commit()
+    self.lock = threading.Lock()
+    self.misses = set()
+    row = self.db.execute("SELECT value FROM meta WHERE name = 'loaded'").fetchone()
+    self.loaded = row[0] if row != None else 0
+    if time() - self.loaded > self.maxage:
       self.fetch()
-
+    else:
+      self._load()
+    t = threading.Thread(target=self._resolver, args=(interval,))
+    t.daemon = True
+    t.start()
+  
+  @staticmethod
+  def connect(dataset, api_key, **kw):
+    """Returns an NKCache for the Nomenklatura dataset with the given name."""
+    return NKCache(nomenklatura.Dataset(dataset, api_key=api_key), **kw)
+  
   def fetch(self):
-      links=itertools.ifilter(lambda x: x.value: self.ds.links())
-      self.cache=dict(((l.key,l.value["value"]) for l in links))
+    """Loads all links of the dataset into the local store, replacing the links loaded before.
+    
+    Keys that were looked up without a match are kept until their negative_ttl runs out.
+    """
+    now = time()
+    rows = [(l.key, _nk_value(l.value), now) for l in self.ds.links()]
+    with self.lock:
+      self.db.execute("DELETE FROM links WHERE value IS NOT NULL")
+      self.db.executemany("INSERT OR REPLACE INTO links (key, value, checked) VALUES (?, ?, ?)", rows)
+      self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('loaded', ?)", (now,))
+      self.db.commit()
+      self.loaded = now
+    self._load()
+    print_log("Loaded " + str(len(rows)) + " Nomenklatura links, " + str(len(self.cache)) + " cache entries")
+  
+  def _load(self):
+    with self.lock:
+      self.cache = dict((key, (value, checked)) for key, value, checked in self.db.execute("SELECT key, value, checked FROM links"))
+  
+  def lookup(self, key):
+    """Returns the reconciled value for key, or None if there is none (yet)."""
+    entry = self.cache.get(key)
+    if entry == None or (entry[0] == None and time() - entry[1] > self.negative_ttl):
+      with self.lock:
+        self.misses.add(key)
+    if entry == None:
+      return None
+    return entry[0]
+  
+  def resolve(self):
+    """Looks up all queued keys in the dataset and stores the answers."""
+    with self.lock:
+      keys = self.misses
+      self.misses = set()
+    if len(keys) == 0:
+      return
+    rows = []
+    for key in keys:
+      try:
+        rows.append((key, _nk_value(self.ds.lookup(key)), time()))
+      except self.ds.NoMatch:
+        rows.append((key, None, time()))
+      except Exception as e:
+        print_log("Nomenklatura lookup failed for '" + key + "': " + str(e))
+    with self.lock:
+      self.db.executemany("INSERT OR REPLACE INTO links (key, value, checked) VALUES (?, ?, ?)", rows)
+      self.db.commit()
+    for key, value, checked in rows:
+      self.cache[key] = (value, checked)
+  
+  def _resolver(self, interval):
+    while True:
+      sleep(interval)
+      if time() - self.loaded > self.maxage:
+        try:
+          self.fetch()
+        except Exception as e:
+          # Keep the links we have, and try again after another maxage
+          self.loaded = time()
+          print_log("Reloading Nomenklatura links failed: " + str(e))
+      self.resolve()
 
-  def lookup(self,key):
-      if key in self.cache.keys():
-         return self.cache[key]
-      else:
-          try:
-              value=self.ds.lookup(key)
-              return value.value
-          except self.ds.NoMatch:
-              return key
-"""
+def _nk_value(value):
+  """Returns the plain value of a Nomenklatura link or lookup result."""
+  if value == None or isinstance(value, basestring):
+    return value
+  if isinstance(value, dict):
+    return value.get("value")
+  return getattr(value, "value", None)
+
+class LocalDataset(object):
+  """A local stand-in for a nomenklatura.Dataset, for tests and offline runs.
+  
+  Reads a JSON object that maps keys to values (or null for keys without a match).
+  """
+  class NoMatch(Exception):
+    pass
+  
+  class Link(object):
+    def __init__(self, key, value):
+      self.key = key
+      self.value = value
+  
+  def __init__(self, filename):
+    self.links_ = simplejson.load(codecs.open(filename, "rb", "utf-8"))
+  
+  def links(self):
+    return [LocalDataset.Link(key, value) for key, value in self.links_.iteritems()]
+  
+  def lookup(self, key):
+    if self.links_.get(key) == None:
+      raise LocalDataset.NoMatch(key)
+    return self.links_[key]
 
 def print_log(msg):
   timestamp = strftime("%Y-%m-%d_%H:%M:%S", localtime())
   print(unicode("[" + timestamp + "] " + msg).encode("utf-8"))
 
+def open_file(filename, mode="rb"):
+  """Opens a file, through gzip if its name ends in '.gz'."""
+  if filename.endswith(".gz"):
+    return gzip.open(filename, mode)
+  return open(filename, mode)
+
+class LazyRecord(DictMixin):
+  """A record as it came from OL, that unmarshals each field only when it is used.
+  
+  Most cleaners look at only a few fields of a record. The others are never copied:
+  marshal_record takes them straight from the JSON data the record was made from, and
+  only marshals the fields that were changed, or that are lists or dicts and so could
+  have been changed in place.
+  """
+  def __init__(self, raw):
+    self.raw = raw
+    self.fields = {}
+    self.dirty = set()
+    self.deleted = set()
+  
+  def __getitem__(self, key):
+    if key in self.fields:
+      return self.fields[key]
+    if key in self.deleted or key not in self.raw:
+      raise KeyError(key)
+    value = self.fields[key] = olapi.unmarshal(self.raw[key])
+    return value
+  
+  def __setitem__(self, key, value):
+    self.fields[key] = value
+    self.dirty.add(key)
+    self.deleted.discard(key)
+  
+  def __delitem__(self, key):
+    if key not in self:
+      raise KeyError(key)
+    self.fields.pop(key, None)
+    self.dirty.discard(key)
+    self.deleted.add(key)
+  
+  def __contains__(self, key):
+    return key in self.fields or (key in self.raw and key not in self.deleted)
+  
+  def __iter__(self):
+    return iter(self.keys())
+  
+  def __len__(self):
+    return len(self.keys())
+  
+  def keys(self):
+    return [k for k in self.raw if k not in self.deleted] + [k for k in self.fields if k not in self.raw]
+  
+  def marshal(self):
+    data = dict((k, v) for k, v in self.raw.iteritems() if k not in self.deleted)
+    for k, v in self.fields.iteritems():
+      if k in self.dirty or isinstance(v, (list, dict)):
+        data[k] = olapi.marshal(v)
+    return data
+
+def marshal_record(record):
+  """Returns the marshalled JSON data of a record, a LazyRecord or an unmarshalled dict."""
+  if isinstance(record, LazyRecord):
+    return record.marshal()
+  return olapi.marshal(record)
+
+def type_of(obj):
+  """Returns the type key of a record, marshalled or not."""
+  t = obj.get("type")
+  if isinstance(t, dict):
+    return t.get("key")
+  return t
+
+def chunks(iterable, size):
+  """Yields lists of at most size consecutive items from iterable."""
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) >= size:
+      yield chunk
+      chunk = []
+  if len(chunk) > 0:
+    yield chunk
+
+def exit_on_signal():
+  """Makes SIGTERM and SIGHUP exit normally, so exit handlers (like flushing buffers) run."""
+  def handler(signum, frame):
+    sys.exit(128 + signum)
+  for name in ("SIGTERM", "SIGHUP"):
+    if hasattr(signal, name):
+      try:
+        signal.signal(getattr(signal, name), handler)
+      except ValueError:
+        # Not in the main thread
+        pass
+
+def is_transient(error):
+  """Tells if an error from an OL call says the server is busy or unreachable.
+  
+  Such calls may succeed when tried again later. Errors about the request itself,
+  like bad data or a missing record, are not transient.
+  """
+  if isinstance(error, olapi.OLError):
+    return not str(error).startswith(("Bad Request", "Unauthorized", "Forbidden", "Not Found", "Conflict"))
+  return isinstance(error, (socket.error, urllib2.URLError, httplib.HTTPException))
+
+def is_unauthorized(error):
+  """Tells if an OLError says the call needs a login, or a session that is still valid."""
+  return isinstance(error, olapi.OLError) and str(error).startswith(("Unauthorized", "Forbidden"))
+
+def error_data(error):
+  """Returns the JSON body of an OLError as a dict, or an empty dict if it has none."""
+  try:
+    return simplejson.loads(re.sub(r'^[^{]*', "", str(error)))
+  except ValueError:
+    return {}
+
+def is_record_error(error):
+  """Tells if an OLError is about the data of the records that were saved, rather than the whole call.
+  
+  Only then may the other records of a save_many batch be fine.
+  """
+  if not isinstance(error, olapi.OLError):
+    return False
+  data = error_data(error)
+  return is_conflict(error) or data.get("error") == "bad_data" or "at" in data
+
+def is_conflict(error):
+  """Tells if an OLError says the record was changed since the revision that was saved."""
+  return isinstance(error, olapi.OLError) and (str(error).startswith("Conflict") or error_data(error).get("error") == "conflict")
+
+def author_key(author):
+  """Returns the key of an author reference, whether it is a Reference or marshalled."""
+  if isinstance(author, dict):
+    return unicode(author["key"] if "key" in author else author["author"]["key"])
+  return unicode(author)
+
+def format_values(old):
+  """Returns the formats to replace as a tuple: old is one format, or a list or tuple of them.
+  
+  Each format is in it once, so the queries for them never find the same record.
+  """
+  if isinstance(old, basestring):
+    return (old,)
+  return tuple(collections.OrderedDict.fromkeys(old))
+
+def format_name(old):
+  return "', '".join(format_values(old))
+
+def normalize_isbn(value):
+  """Returns an ISBN as 13 digits, converting ISBN-10s. Returns None if value is no ISBN."""
+  digits = re.sub(r"[^0-9Xx]", "", value).upper()
+  if len(digits) == 10 and digits[:9].isdigit():
+    digits = "978" + digits[:9]
+    return digits + str((10 - sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits)) % 10) % 10)
+  if len(digits) == 13 and digits.isdigit():
+    return digits
+  return None
+
+def normalize_lccn(value):
+  """Returns the normalised form of an LCCN (or an LCCN permalink), or None if value is no LCCN.
+  
+  Blanks and anything after a slash are removed, and the serial number after a hyphen
+  is padded with zeros to six digits, as described by the Library of Congress.
+  """
+  value = value.strip().rstrip("/")
+  if "lccn.loc.gov/" in value:
+    value = value.rsplit("/", 1)[-1]
+  value = re.sub(r"\s", "", value).split("/")[0].lower()
+  if "-" in value:
+    prefix, serial = value.split("-", 1)
+    if serial.isdigit():
+      value = prefix + serial.zfill(6)
+  if re.match(r"^[a-z]{0,3}\d{8,10}$", value) == None:
+    return None
+  return value
+
+def normalize_oclc(value):
+  """Returns an OCLC number without prefixes like (OCoLC), ocm or ocn and leading zeros."""
+  value = re.sub(r"^(\(OCoLC\))?(oc[mn]|on)?", "", value.strip()).lstrip("0")
+  return value if value.isdigit() else None
+
+def normalize_goodreads(value):
+  value = value.strip()
+  return value if value.isdigit() else None
+
+# Identifier schemes, with the edition fields they are in and how to normalise them
+IDENTIFIERS = [
+  ("isbn", ["isbn_10", "isbn_13"], normalize_isbn),
+  ("lccn", ["lccn"], normalize_lccn),
+  ("oclc", ["oclc_numbers"], normalize_oclc),
+  ("goodreads", ["identifiers.goodreads"], normalize_goodreads),
+]
+
+def identifiers_of(record):
+  """Returns a set of the normalised (scheme, value) identifiers of an edition, marshalled or not."""
+  ids = set()
+  for scheme, fields, normalize in IDENTIFIERS:
+    for field in fields:
+      if field.startswith("identifiers."):
+        values = (record.get("identifiers") or {}).get(field.split(".", 1)[1]) or []
+      else:
+        values = record.get(field) or []
+      for value in values:
+        if isinstance(value, basestring):
+          value = normalize(value)
+          if value != None:
+            ids.add((scheme, value))
+  return ids
+
+def record_hash(record):
+  """Returns a hash of the content of a marshalled record, to tell if it changed.
+  
+  The timestamps are left out, because they change form when a record is unmarshalled.
+  """
+  content = dict((k, v) for k, v in record.iteritems() if k not in ("created", "last_modified"))
+  return hashlib.sha1(simplejson.dumps(content, sort_keys=True)).digest()
+
+def edit_distance(a, b, limit):
+  """Returns the Levenshtein distance between a and b, or limit + 1 if it is larger than limit."""
+  if abs(len(a) - len(b)) > limit:
+    return limit + 1
+  previous = range(len(b) + 1)
+  for i, ca in enumerate(a):
+    current = [i + 1]
+    for j, cb in enumerate(b):
+      current.append(min(previous[j + 1] + 1, current[j] + 1, previous[j] + (ca != cb)))
+    if min(current) > limit:
+      return limit + 1
+    previous = current
+  return min(previous[-1], limit + 1)
+
+class FormatIndex:
+  """Looks up the normalised value for physical_format values.
+  
+  Built once from a dict of variant spellings to formats, like formatdict.json. Its keys
+  are canonicalised (case folded, punctuation and whitespace collapsed, a trailing
+  'by ...' fragment stripped), so variants that only differ in those find the same entry.
+  Results are memoised per raw value. With maxdistance > 0, a value that is not found is
+  matched to the closest key within that edit distance. Candidates for that come from an
+  index of all keys with up to maxdistance characters deleted, so a lookup only compares
+  a handful of keys instead of all of them.
+  """
+  BYREG = re.compile(r"(^|\s)by\s.*$", re.UNICODE)
+  PUNCTREG = re.compile(r"[\W_]+", re.UNICODE)
+  
+  def __init__(self, formats, maxdistance=0):
+    self.maxdistance = maxdistance
+    self.formats = {}
+    for key in sorted(formats.keys()):
+      self.formats.setdefault(self.canonical(key), formats[key])
+    self.deletions = {}
+    if maxdistance > 0:
+      for key in self.formats:
+        for variant in self._deletions(key):
+          self.deletions.setdefault(variant, []).append(key)
+    self.memo = {}
+  
+  def canonical(self, value):
+    value = self.BYREG.sub("", value.lower())
+    return self.PUNCTREG.sub(" ", value).strip()
+  
+  def _deletions(self, value):
+    variants = set([value])
+    for d in range(self.maxdistance):
+      for v in list(variants):
+        for i in range(len(v)):
+          variants.add(v[:i] + v[i + 1:])
+    return variants
+  
+  def lookup(self, value):
+    """Returns the normalised format for value, or None if there is none."""
+    if value in self.memo:
+      return self.memo[value]
+    key = self.canonical(value)
+    result = self.formats.get(key)
+    if result == None and self.maxdistance > 0 and len(key) > self.maxdistance:
+      best = self.maxdistance + 1
+      for variant in self._deletions(key):
+        for candidate in self.deletions.get(variant, []):
+          d = edit_distance(key, candidate, self.maxdistance)
+          if d < best or (d == best and result != None and self.formats[candidate] < result):
+            best = d
+            result = self.formats[candidate]
+    self.memo[value] = result
+    return result
+  
+  def classify(self, values):
+    """Returns a dict with the normalised format (or None) for every distinct value in values."""
+    return dict((value, self.lookup(value)) for value in set(values))
+
+class LogWriter:
+  """Writes log lines to files from a background thread, in large buffered writes.
+  
+  write() only puts the line in a bounded queue. When the queue is full the line is
+  dropped (and counted in self.dropped), so logging never holds up cleaning. A file
+  that grows past maxbytes is renamed with a timestamp, and gzipped if compress is set.
+  """
+  def __init__(self, maxqueue=100000, maxbytes=None, compress=False, interval=1.0):
+    self.queue = Queue.Queue(maxqueue)
+    self.maxbytes = maxbytes
+    self.compress = compress
+    self.interval = interval
+    self.files = {}
+    self.sizes = {}
+    self.dropped = 0
+    self.closed = False
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+  
+  def write(self, filename, line):
+    """Queues a line (unicode or UTF-8) for the given file."""
+    if isinstance(line, unicode):
+      line = line.encode("utf-8", "replace")
+    try:
+      self.queue.put_nowait((filename, line))
+    except Queue.Full:
+      self.dropped = self.dropped + 1
+  
+  def _run(self):
+    stop = False
+    while not stop:
+      try:
+        items = [self.queue.get(timeout=self.interval)]
+      except Queue.Empty:
+        items = []
+      # Take whatever else is waiting, to write it in one go
+      while len(items) < 10000:
+        try:
+          items.append(self.queue.get_nowait())
+        except Queue.Empty:
+          break
+      lines = {}
+      for item in items:
+        if item == None:
+          stop = True
+        else:
+          lines.setdefault(item[0], []).append(item[1])
+      for filename, chunk in lines.iteritems():
+        self._write(filename, "".join(chunk))
+      for f in self.files.values():
+        f.flush()
+    for f in self.files.values():
+      f.close()
+  
+  def _write(self, filename, data):
+    if filename not in self.files:
+      self.files[filename] = open(filename, "ab", 1 << 20)
+      self.sizes[filename] = os.path.getsize(filename)
+    self.files[filename].write(data)
+    self.sizes[filename] = self.sizes[filename] + len(data)
+    if self.maxbytes != None and self.sizes[filename] >= self.maxbytes:
+      self._rotate(filename)
+  
+  def _rotate(self, filename):
+    self.files.pop(filename).close()
+    rotated = base = filename + "." + strftime("%Y%m%d-%H%M%S", localtime())
+    n = 1
+    while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+      rotated = base + "-" + str(n)
+      n = n + 1
+    os.rename(filename, rotated)
+    if self.compress:
+      with open(rotated, "rb") as src:
+        with gzip.open(rotated + ".gz", "wb") as dst:
+          shutil.copyfileobj(src, dst)
+      os.remove(rotated)
+  
+  def close(self):
+    """Writes everything that is queued and closes the files."""
+    if not self.closed:
+      self.closed = True
+      self.queue.put(None)
+      self.thread.join()
+
+class Metrics:
+  """Counters and latency histograms of a bot.
+  
+  Metrics have a name and optional labels, like inc("vacuumbot_api_calls_total", method="get").
+  They can be served in the Prometheus text format over HTTP, and summarised in one line.
+  """
+  BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+  SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+  
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+  
+  def inc(self, name, n=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + n
+  
+  def observe(self, name, value, buckets=BUCKETS, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      if key not in self.histograms:
+        self.histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+      h = self.histograms[key]
+      for i, bound in enumerate(buckets):
+        if value <= bound:
+          h["counts"][i] = h["counts"][i] + 1
+          break
+      h["sum"] = h["sum"] + value
+      h["count"] = h["count"] + 1
+  
+  def count(self, name, **labels):
+    """Returns the value of a counter, summed over all label values that are not given."""
+    with self.lock:
+      return sum(v for (n, l), v in self.counters.items() if n == name and set(labels.items()) <= set(l))
+  
+  def render(self):
+    """Returns all metrics in the Prometheus text format."""
+    def labelstr(labels, extra=()):
+      labels = list(labels) + list(extra)
+      if len(labels) == 0:
+        return ""
+      return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+    lines = []
+    with self.lock:
+      for (name, labels), value in sorted(self.counters.items()):
+        lines.append(name + labelstr(labels) + " " + str(value))
+      for (name, labels), h in sorted(self.histograms.items()):
+        total = 0
+        for bound, n in zip(h["buckets"], h["counts"]):
+          total = total + n
+          lines.append(name + "_bucket" + labelstr(labels, [("le", bound)]) + " " + str(total))
+        lines.append(name + "_bucket" + labelstr(labels, [("le", "+Inf")]) + " " + str(h["count"]))
+        lines.append(name + "_sum" + labelstr(labels) + " " + repr(h["sum"]))
+        lines.append(name + "_count" + labelstr(labels) + " " + str(h["count"]))
+    return "\n".join(lines) + "\n"
+  
+  def summary(self):
+    """Returns a one-line summary of API calls, flushes and cache hit rates."""
+    parts = []
+    with self.lock:
+      calls = sorted((dict(l)["method"], h) for (n, l), h in self.histograms.items() if n == "vacuumbot_api_seconds")
+    for method, h in calls:
+      parts.append("%s %d (%.0f ms)" % (method, h["count"], 1000 * h["sum"] / max(h["count"], 1)))
+    parts.append("flushed %d in %d batches, %d rejected, %d retries" % (
+      self.count("vacuumbot_flushed_records_total"), self.count("vacuumbot_flushes_total"),
+      self.count("vacuumbot_rejects_total"), self.count("vacuumbot_retries_total")))
+    for cache in ("aucache", "wocache"):
+      hits = self.count("vacuumbot_cache_total", cache=cache, result="hit")
+      total = self.count("vacuumbot_cache_total", cache=cache)
+      if total > 0:
+        parts.append("%s %d%% hits" % (cache, 100 * hits / total))
+    return "; ".join(parts)
+  
+  def serve(self, port, host="127.0.0.1"):
+    """Serves the metrics over HTTP from a background thread, for Prometheus to scrape."""
+    metrics = self
+    
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+      
+      def log_message(self, format, *args):
+        pass
+    
+    server = HTTPServer((host, port), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+  
+  def report_every(self, seconds):
+    """Logs the summary line every so many seconds, from a background thread."""
+    def report():
+      while True:
+        sleep(seconds)
+        print_log(self.summary())
+    t = threading.Thread(target=report)
+    t.daemon = True
+    t.start()
+
+class RateLimiter:
+  """Token buckets for reads from and writes to OL, shared by all threads that use them.
+  
+  Every successful call raises the rate of its bucket a little, up to the maximum rate.
+  A transient failure halves the rate and pauses the bucket, for twice as long after
+  every failure in a row, give or take some jitter so that bots sharing OL do not all
+  come back at once. So the bot speeds up while OL is healthy and backs off when it is
+  busy.
+  """
+  def __init__(self, reads=2.0, writes=0.5, maxreads=20.0, maxwrites=5.0, minrate=0.05, burst=5):
+    """Takes the initial and maximum calls per second for reads and writes."""
+    self.lock = threading.Lock()
+    self.minrate = minrate
+    self.buckets = {}
+    for kind, rate, maxrate in [("read", reads, maxreads), ("write", writes, maxwrites)]:
+      self.buckets[kind] = {"rate": rate, "max": max(rate, maxrate), "burst": burst, "tokens": 1.0,
+                            "last": time(), "pause": 0.0, "until": 0.0}
+  
+  def acquire(self, kind):
+    """Waits until a call of the given kind ("read" or "write") may be made."""
+    while True:
+      with self.lock:
+        b = self.buckets[kind]
+        now = time()
+        if now >= b["until"]:
+          b["tokens"] = min(b["burst"], b["tokens"] + (now - max(b["last"], b["until"])) * b["rate"])
+          b["last"] = now
+          if b["tokens"] >= 1:
+            b["tokens"] = b["tokens"] - 1
+            return
+          wait = (1 - b["tokens"]) / b["rate"]
+        else:
+          wait = b["until"] - now
+      sleep(wait)
+  
+  def success(self, kind):
+    with self.lock:
+      b = self.buckets[kind]
+      b["rate"] = min(b["max"], b["rate"] * 1.02)
+      b["pause"] = 0.0
+  
+  def failure(self, kind):
+    with self.lock:
+      b = self.buckets[kind]
+      b["rate"] = max(self.minrate, b["rate"] / 2)
+      b["pause"] = min(300.0, max(1.0, b["pause"] * 2))
+      b["until"] = time() + b["pause"] * random.uniform(0.5, 1.0)
+      b["tokens"] = 0.0
+  
+  def rate(self, kind):
+    return self.buckets[kind]["rate"]
+
+class HTTPTransport:
+  """A pool of keep-alive connections to OL, to replace the OpenLibrary client's own requests.
+  
+  The client opens a new connection for every call. This keeps up to size connections
+  open and hands each request one that is free, so several threads can make calls at
+  once. Responses are asked for gzipped. With gzip_requests, request bodies bigger than
+  a few kB are gzipped too, which only works with a server that accepts that. The login
+  cookie of the client is sent with every request.
+  """
+  REDIRECTS = (301, 302, 303, 307, 308)
+  
+  def __init__(self, base_url="http://openlibrary.org", size=8, timeout=60, gzip_requests=False):
+    url = urlparse.urlsplit(base_url)
+    self.https = url.scheme == "https"
+    self.host = url.netloc
+    self.origin = url.scheme + "://" + url.netloc
+    self.prefix = url.path.rstrip("/")
+    self.redirected = False
+    self.timeout = timeout
+    self.gzip_requests = gzip_requests
+    self.free = Queue.LifoQueue()
+    self.slots = threading.BoundedSemaphore(size)
+    self.client = None
+  
+  def install(self, client):
+    """Makes an OpenLibrary client send all its requests through this transport."""
+    self.client = client
+    client._request = self.request
+  
+  def _connect(self, https=None, host=None):
+    if https == None:
+      https, host = self.https, self.host
+    if https:
+      conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+    else:
+      conn = httplib.HTTPConnection(host, timeout=self.timeout)
+    conn.connect()
+    # Headers and body go out separately; don't let them wait for each other's ACK
+    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return conn
+  
+  def request(self, path, method="GET", data=None, headers=None):
+    """Makes a request like OpenLibrary._request. Raises an OLError for an HTTP error status.
+    
+    Redirects of GET and HEAD requests are followed, up to 5 times, like the client's own
+    urllib2 requests. A redirect of another request raises an OLError.
+    """
+    headers = dict(headers or {})
+    headers["Accept-Encoding"] = "gzip"
+    if self.client != None and getattr(self.client, "cookie", None):
+      headers["Cookie"] = self.client.cookie
+    if data != None and self.gzip_requests and len(data) > 4096:
+      out = StringIO.StringIO()
+      with gzip.GzipFile(fileobj=out, mode="wb") as f:
+        f.write(data)
+      data = out.getvalue()
+      headers["Content-Encoding"] = "gzip"
+    url = self.origin + self.prefix + path
+    for hops in range(6):
+      status, reason, msg, body = self._fetch(method, url, data, headers)
+      if status not in self.REDIRECTS or method not in ("GET", "HEAD") or not msg.get("Location") or hops == 5:
+        break
+      location = urlparse.urljoin(url, msg["Location"])
+      if not self.redirected:
+        self.redirected = True
+        print_log(url + " redirects to " + location + ", set base_url to that site to save a request per call")
+      url = location
+    if msg.get("Content-Encoding") == "gzip":
+      body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+    if status >= 300:
+      raise olapi.OLError(urllib2.HTTPError(url, status, reason, msg, StringIO.StringIO(body)))
+    response = StringIO.StringIO(body)
+    response.headers = msg
+    response.code = status
+    return response
+  
+  def _fetch(self, method, url, data, headers):
+    """Sends a request to a URL: on a pooled connection if it is on OL, else on a connection of its own."""
+    parts = urlparse.urlsplit(url)
+    path = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+    if parts.scheme + "://" + parts.netloc == self.origin:
+      self.slots.acquire()
+      try:
+        return self._send(method, path, data, headers)
+      finally:
+        self.slots.release()
+    conn = self._connect(parts.scheme == "https", parts.netloc)
+    try:
+      conn.request(method, path, data, headers)
+      response = conn.getresponse()
+      return (response.status, response.reason, response.msg, response.read())
+    finally:
+      conn.close()
+  
+  def _send(self, method, path, data, headers):
+    """Sends a request on a pooled connection, and on a new one if the pooled one was closed."""
+    try:
+      conn, reused = self.free.get_nowait(), True
+    except Queue.Empty:
+      conn, reused = self._connect(), False
+    while True:
+      try:
+        conn.request(method, path, data, headers)
+        response = conn.getresponse()
+        body = response.read()
+      except (socket.error, httplib.HTTPException) as e:
+        conn.close()
+        if not reused or isinstance(e, socket.timeout):
+          raise
+        # The server closed the idle connection: try once more on a new one
+        conn, reused = self._connect(), False
+        continue
+      if response.will_close:
+        conn.close()
+      else:
+        self.free.put(conn)
+      return (response.status, response.reason, response.msg, body)
+
+class Pipeline:
+  """Runs work items through a chain of stages, each with its own pool of worker threads.
+  
+  Stages are connected by bounded queues, so a slow stage makes the stages before it
+  wait instead of piling up work in memory. At most depth items wait between two stages.
+  """
+  DONE = object()
+  
+  def __init__(self, source, stages, depth=2):
+    """Takes an iterable of work items and a list of (function, workers) tuples.
+    
+    Each stage function is called with one item and returns the item for the next stage,
+    or None if there is nothing to pass on. The result of the last stage is discarded.
+    """
+    self.source = source
+    self.stages = stages
+    self.queues = [Queue.Queue(depth) for stage in stages]
+    self.stopped = threading.Event()
+    self.error = None
+  
+  def run(self):
+    """Feeds the source through all stages and waits until everything is processed.
+    
+    If a stage raises an exception, the pipeline stops taking new work and the first
+    exception is raised again here.
+    """
+    threads = []
+    for i, (func, workers) in enumerate(self.stages):
+      left = [workers]
+      lock = threading.Lock()
+      for n in range(workers):
+        t = threading.Thread(target=self._work, args=(i, func, left, lock))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    try:
+      for item in self.source:
+        if self.stopped.is_set():
+          break
+        self.queues[0].put(item)
+    except Exception:
+      self._fail(sys.exc_info())
+    for n in range(self.stages[0][1]):
+      self.queues[0].put(Pipeline.DONE)
+    for t in threads:
+      while t.is_alive():
+        t.join(1)
+    if self.error != None:
+      raise self.error[0], self.error[1], self.error[2]
+  
+  def _fail(self, exc_info):
+    if self.error == None:
+      self.error = exc_info
+      print_log("Pipeline stopped: " + str(exc_info[1]))
+    self.stopped.set()
+  
+  def _work(self, i, func, left, lock):
+    inq = self.queues[i]
+    outq = None
+    if i + 1 < len(self.queues):
+      outq = self.queues[i + 1]
+    while True:
+      item = inq.get()
+      if item is Pipeline.DONE:
+        break
+      if self.stopped.is_set():
+        # Keep draining so upstream workers never block on a full queue
+        continue
+      try:
+        result = func(item)
+      except Exception:
+        self._fail(sys.exc_info())
+        continue
+      if result != None and outq != None:
+        outq.put(result)
+    # The last worker of a stage to finish tells all workers of the next stage to stop
+    with lock:
+      left[0] = left[0] - 1
+      last = left[0] == 0
+    if last and outq != None:
+      for n in range(self.stages[i + 1][1]):
+        outq.put(Pipeline.DONE)
+
 class OLBuffer:
   """Tools to buffer Open Library API interactions.
   
+  A write-behind buffer for records that are saved with save_many. Records are grouped
+  by commit message. A group is sent when it holds maxrecords records or maxbytes bytes
+  of JSON, or when its oldest record has waited maxage seconds. Background flusher
+  threads do the sending, so the bot can keep cleaning in the meantime. When more than
+  maxmemory bytes are waiting to be saved, add() blocks until the flushers catch up.
+  close() waits at most shutdown_timeout seconds for the last records to be saved.
   """
-  def __init__(self):
-    pass
+  def __init__(self, send, maxrecords=100, maxbytes=2000000, maxage=60, maxmemory=50000000, flushers=1,
+               shutdown_timeout=60):
+    """Takes the function that saves a batch of records.
+    
+    send is called as send(message, records), with records a dict of marshalled records
+    by key. It returns a dict of the records that should be tried again later.
+    """
+    self.send = send
+    self.maxrecords = maxrecords
+    self.maxbytes = maxbytes
+    self.maxage = maxage
+    self.maxmemory = maxmemory
+    self.shutdown_timeout = shutdown_timeout
+    self.groups = {}
+    self.batches = {}
+    self.batchid = 0
+    self.sending = set()
+    self.stopped = False
+    self.checked = time()
+    self.memory = 0
+    self.ready = Queue.Queue()
+    self.cond = threading.Condition()
+    self.flushers = []
+    self.closed = False
+    self.start(flushers)
+  
+  def start(self, flushers):
+    """Makes sure at least the given number of flusher threads is running."""
+    while len(self.flushers) < flushers:
+      t = threading.Thread(target=self._flusher)
+      t.daemon = True
+      t.start()
+      self.flushers.append(t)
+  
+  def add(self, key, record, message):
+    """Puts a marshalled record in the buffer, replacing an earlier version with the same key."""
+    size = len(simplejson.dumps(record))
+    with self.cond:
+      while self.memory > 0 and self.memory + size > self.maxmemory:
+        # Backpressure: send the biggest group early and wait for the flushers
+        if len(self.groups) > 0:
+          self._release(max(self.groups, key=lambda m: self.groups[m]["bytes"]))
+        self.cond.wait(1)
+      self._put(key, record, message, size)
+  
+  def _put(self, key, record, message, size, release=True):
+    if message not in self.groups:
+      self.groups[message] = {"records": {}, "sizes": {}, "bytes": 0, "since": time()}
+    group = self.groups[message]
+    if key in group["records"]:
+      group["bytes"] = group["bytes"] - group["sizes"][key]
+      self.memory = self.memory - group["sizes"][key]
+    group["records"][key] = record
+    group["sizes"][key] = size
+    group["bytes"] = group["bytes"] + size
+    self.memory = self.memory + size
+    if release and (len(group["records"]) >= self.maxrecords or group["bytes"] >= self.maxbytes):
+      self._release(message)
+  
+  def _release(self, message):
+    """Moves a group to the queue of batches to send. Call with self.cond held."""
+    group = self.groups.pop(message)
+    self.batchid = self.batchid + 1
+    self.batches[self.batchid] = (message, group["records"])
+    self.ready.put((self.batchid, message, group["records"], group["bytes"]))
+  
+  def _release_old(self):
+    with self.cond:
+      now = time()
+      self.checked = now
+      for message in self.groups.keys():
+        if now - self.groups[message]["since"] >= self.maxage:
+          self._release(message)
+  
+  def _flusher(self):
+    interval = min(1.0, self.maxage / 4.0)
+    while True:
+      # Also when batches keep coming, so that a quiet group still goes out after maxage
+      if time() - self.checked >= interval:
+        self._release_old()
+      try:
+        item = self.ready.get(timeout=interval)
+      except Queue.Empty:
+        continue
+      if item == None:
+        return
+      batchid, message, records, size = item
+      with self.cond:
+        if self.stopped:
+          # close() gave up: the batch is left unsent, with the records that are pending
+          return
+        self.sending.add(batchid)
+      retry = records
+      try:
+        retry = self.send(message, records)
+      except Exception as e:
+        print_log("Flush failed: " + str(e))
+      finally:
+        with self.cond:
+          self.memory = self.memory - size
+          if retry:
+            for key, record in retry.iteritems():
+              # Records added in the meantime are newer. The others wait for the next flush,
+              # rather than being sent again right away while OL is down.
+              if message not in self.groups or key not in self.groups[message]["records"]:
+                self._put(key, record, message, len(simplejson.dumps(record)), release=False)
+          del self.batches[batchid]
+          self.sending.discard(batchid)
+          self.cond.notify_all()
+  
+  def flush(self, message=None, timeout=None):
+    """Sends the group for message, or all groups, and waits until all batches are sent.
+    
+    Records that failed to save stay in the buffer. With a timeout, waits at most that
+    many seconds, and returns False if the batches were not all sent by then.
+    """
+    deadline = time() + timeout if timeout != None else None
+    with self.cond:
+      if message == None:
+        for m in self.groups.keys():
+          self._release(m)
+      elif message in self.groups:
+        self._release(message)
+      # Wait in steps, so that SIGTERM and SIGINT are not held up by a slow OL
+      while len(self.batches) > 0:
+        if deadline != None and time() >= deadline:
+          return False
+        self.cond.wait(1)
+    return True
+  
+  def pending(self):
+    """Returns the keys of all records that are still waiting to be saved."""
+    return [key for message, key, record in self.pending_records()]
+  
+  def pending_records(self, sending=True):
+    """Returns (message, key, record) tuples of the records that are still waiting to be saved, or being sent.
+    
+    With sending False, the records of batches that are being sent right now are left out.
+    """
+    with self.cond:
+      batches = [(message, group["records"]) for message, group in self.groups.items()]
+      batches.extend(batch for batchid, batch in self.batches.items() if sending or batchid not in self.sending)
+      return [(message, key, record) for message, records in batches for key, record in records.iteritems()]
+  
+  def close(self):
+    """Flushes everything and stops the flushers.
+    
+    Waits at most shutdown_timeout seconds, after which the records that were not saved
+    are left in the buffer (see pending_records). Batches that are being sent then may
+    still be saved, but no other batch is sent after that.
+    """
+    if not self.closed:
+      self.closed = True
+      if not self.flush(timeout=self.shutdown_timeout):
+        with self.cond:
+          self.stopped = True
+        print_log("Gave up saving the buffer after " + str(self.shutdown_timeout) + " s")
+        return
+      for t in self.flushers:
+        self.ready.put(None)
+      for t in self.flushers:
+        t.join(self.shutdown_timeout)
+  
+class PatchWriter:
+  """Writes the changes of a dry run to a stream of patch files.
+  
+  Each line of a patch file is a JSON object with the key, the base revision, the diff
+  and the comment of one change. The diff holds only the fields that changed, with null
+  for fields that were removed. Files are gzipped and named prefix-00000.jsonl.gz,
+  prefix-00001.jsonl.gz and so on, with at most maxrecords patches each.
+  """
+  def __init__(self, prefix="vacuumbot-patches", maxrecords=100000):
+    self.prefix = prefix
+    self.maxrecords = maxrecords
+    self.lock = threading.Lock()
+    self.out = None
+    self.files = 0
+    self.records = 0
+    self.bytes = 0
+    self.comments = collections.Counter()
+  
+  def write(self, key, revision, diff, comment):
+    line = simplejson.dumps({"key": key, "revision": revision, "diff": diff, "comment": comment}) + "\n"
+    with self.lock:
+      if self.out == None or self.records % self.maxrecords == 0:
+        if self.out != None:
+          self.out.close()
+        self.out = gzip.open(self.prefix + "-%05d.jsonl.gz" % self.files, "wb")
+        self.files = self.files + 1
+      self.out.write(line)
+      self.records = self.records + 1
+      self.bytes = self.bytes + len(line)
+      self.comments[comment] = self.comments[comment] + 1
+  
+  def close(self):
+    """Closes the current file and logs how many patches were written, per comment."""
+    with self.lock:
+      if self.out == None:
+        return
+      self.out.close()
+      self.out = None
+      print_log("Wrote " + str(self.records) + " patches (" + str(self.bytes) + " bytes) to " + str(self.files) + " files")
+      for comment, n in self.comments.most_common():
+        print_log("  " + str(n) + "\t" + comment)
+
+def diff_record(old, new):
+  """Returns the fields of marshalled record new that differ from old, with None for removed fields."""
+  diff = dict((k, v) for k, v in new.iteritems() if old.get(k) != v)
+  for k in old:
+    if k not in new:
+      diff[k] = None
+  return diff
+
+def read_patches(prefix):
+  """Iterates over the patches in the files written by a PatchWriter with the given prefix."""
+  for filename in sorted(glob.glob(prefix + "-[0-9]*.jsonl.gz")):
+    for line in open_file(filename):
+      yield simplejson.loads(line)
+
+class QueryCursor:
+  """Iterates over all results of an OL query, one page at a time.
+  
+  While the results of one page are processed, the next page is already fetched in the
+  background, so only a few pages are in memory at any time and the first results can be
+  processed as soon as the first page is in. Pages follow each other by key (the next
+  page has a "key>" condition on the last key of the page before), so records that drop
+  out of the query because they were fixed in the meantime do not make the cursor skip
+  other records. by="offset" pages with offsets instead.
+  """
+  def __init__(self, fetch, query, pagesize=1000, by="key"):
+    """Takes a function that runs one query and returns its results, and the query."""
+    self.fetch = fetch
+    self.query = query
+    self.pagesize = pagesize
+    self.by = by
+  
+  def pages(self):
+    q = dict(self.query)
+    q["limit"] = self.pagesize
+    q["sort"] = "key"
+    if self.by == "offset":
+      q.setdefault("offset", 0)
+    while True:
+      page = self.fetch(dict(q))
+      yield page
+      if len(page) < self.pagesize:
+        break
+      if self.by == "offset":
+        q["offset"] = q["offset"] + len(page)
+      else:
+        last = page[-1]
+        q["key>"] = last["key"] if isinstance(last, dict) else last
+  
+  def __iter__(self):
+    pages = Queue.Queue(1)
+    stop = threading.Event()
+    
+    def produce():
+      try:
+        for page in self.pages():
+          while not stop.is_set():
+            try:
+              pages.put((page, None), timeout=1)
+              break
+            except Queue.Full:
+              pass
+          if stop.is_set():
+            return
+        pages.put((None, None))
+      except Exception:
+        pages.put((None, sys.exc_info()))
+    
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+    try:
+      while True:
+        page, error = pages.get()
+        if error != None:
+          raise error[0], error[1], error[2]
+        if page == None:
+          break
+        for r in page:
+          yield r
+    finally:
+      # Also stops the producer when the consumer stops early
+      stop.set()
+
+class QueryFanout:
+  """Runs a family of queries at the same time and merges their results into one stream of keys.
+  
+  Each query is run to its end with query (like VacuumBot.query), by a pool of threads,
+  so all calls still go through the rate limiter. empty is called with every query that
+  had no results. The queries of a sweep are disjoint (one format or death year each),
+  so keys are passed on as they come, in constant memory. With overlap, the queries may
+  find the same records, and each key is yielded once; that keeps all keys in memory.
+  """
+  def __init__(self, query, queries, threads=4, empty=None, overlap=False):
+    self.query = query
+    self.queries = queries
+    self.threads = threads
+    self.empty = empty
+    self.overlap = overlap and len(queries) > 1
+  
+  def __iter__(self):
+    todo = Queue.Queue()
+    for q in self.queries:
+      todo.put(q)
+    results = Queue.Queue(10000)
+    stop = threading.Event()
+    
+    def put(item):
+      while not stop.is_set():
+        try:
+          results.put(item, timeout=1)
+          return True
+        except Queue.Full:
+          pass
+      return False
+    
+    def work():
+      try:
+        while not stop.is_set():
+          try:
+            q = todo.get_nowait()
+          except Queue.Empty:
+            break
+          n = 0
+          for r in self.query(q):
+            n = n + 1
+            if not put((r["key"] if isinstance(r, dict) else r, None)):
+              return
+          if n == 0 and self.empty != None:
+            self.empty(q)
+        put((None, None))
+      except Exception:
+        put((None, sys.exc_info()))
+    
+    threads = min(self.threads, len(self.queries))
+    for i in range(threads):
+      t = threading.Thread(target=work)
+      t.daemon = True
+      t.start()
+    seen = set()
+    try:
+      while threads > 0:
+        key, error = results.get()
+        if error != None:
+          raise error[0], error[1], error[2]
+        if key == None:
+          threads = threads - 1
+        elif not self.overlap:
+          yield key
+        elif key not in seen:
+          seen.add(key)
+          yield key
+    finally:
+      stop.set()
+
+class Rule:
+  """A record transform that can be combined with others in a Task.
+  
+  method names the VacuumBot method that does the transform. It is called with the
+  record and the rule's arguments and returns a tuple (obj, comment), with comment None
+  if nothing changed, or the changed record or None (then comment is used).
+  The rule only runs on records with at least one of the fields it reads, unless it
+  always runs (rules that add fields). A rule that adds nothing when all its arguments
+  are empty strings (like add_by with by "") is left out of tasks in that case.
+  """
+  def __init__(self, method, reads=(), writes=(), always=False, comment=None, skip_empty=False):
+    self.method = method
+    self.reads = reads
+    self.writes = writes
+    self.always = always
+    self.comment = comment
+    self.skip_empty = skip_empty
+
+RULES = {}
+
+def register_rule(method, **kw):
+  """Registers a VacuumBot method as a rule for tasks, see Rule for the keyword arguments."""
+  RULES[method] = Rule(method, **kw)
+
+register_rule("replace_format2", reads=["physical_format"], writes=["physical_format"])
+register_rule("add_by", always=True, writes=["by_statement", "notes"], skip_empty=True)
+register_rule("add_subtitle", always=True, writes=["subtitle", "notes"], skip_empty=True)
+register_rule("add_other_title", always=True, writes=["other_titles"], skip_empty=True)
+register_rule("clean_format", reads=["physical_format"], writes=["physical_format"], comment="cleaned up physical format")
+register_rule("clean_pagination", reads=["pagination"], writes=["pagination"])
+register_rule("clean_death_date", reads=["death_date"], writes=["death_date"], comment="Removed period from death date")
+register_rule("remove_classification_value", reads=["lc_classifications", "dewey_decimal_class", "classifications"],
+              writes=["lc_classifications", "dewey_decimal_class", "classifications"])
+register_rule("_clean_lccn_permalink", reads=["classifications"], writes=["classifications", "lccn"])
+register_rule("_update_author_in_edition", reads=["authors"], writes=["authors"])
+register_rule("clean_identifiers", reads=["isbn_10", "isbn_13", "lccn", "oclc_numbers"], writes=["isbn_10", "isbn_13", "lccn", "oclc_numbers"])
+register_rule("_remove_key", always=True)
+register_rule("_deduplicate_values", always=True)
+
+# Names of commands in command files (see VacuumBot.vacuum) that differ from their rule
+COMMANDS = {
+  "remove_key": "_remove_key",
+  "deduplicate_values": "_deduplicate_values",
+  "clean_lccn_permalink": "_clean_lccn_permalink",
+}
+
+class Task:
+  """A list of rules with their arguments, compiled into one pass per record.
+  
+  Instead of trying every rule on every record, a task indexes its rules by the fields
+  they read. For a record it only runs the rules for the fields the record has, plus
+  the rules for fields that an earlier rule changed, in the order they were given.
+  A task only depends on the methods, so the same one runs with any arguments.
+  """
+  def __init__(self, methods):
+    """Takes a list of method names. Methods that are not registered rules always run."""
+    self.rules = [RULES.get(method) or Rule(method, always=True) for method in methods]
+    self.always = []
+    self.readers = {}
+    for i, rule in enumerate(self.rules):
+      if rule.always:
+        self.always.append(i)
+      for field in rule.reads:
+        self.readers.setdefault(field, []).append(i)
+  
+  def run(self, bot, obj, args):
+    """Runs the rules on obj, each with its list in args as arguments.
+    
+    Returns the combined change comment, or None if nothing changed.
+    """
+    pending = list(self.always)
+    for field, readers in self.readers.iteritems():
+      if field in obj:
+        pending.extend(readers)
+    pending = list(set(pending))
+    heapq.heapify(pending)
+    seen = set(pending)
+    comment = []
+    while len(pending) > 0:
+      i = heapq.heappop(pending)
+      rule = self.rules[i]
+      if rule.skip_empty and all(arg == "" for arg in args[i]):
+        continue
+      result = getattr(bot, rule.method)(obj, *args[i])
+      if isinstance(result, tuple):
+        changed = result[1]
+      else:
+        changed = result != None and rule.comment
+      if not changed:
+        continue
+      comment.append(changed)
+      # Fields written by this rule may now need rules that come later
+      for field in rule.writes:
+        for j in self.readers.get(field, []):
+          if j > i and j not in seen:
+            seen.add(j)
+            heapq.heappush(pending, j)
+    if len(comment) == 0:
+      return None
+    return "; ".join(comment)
+
+class RedirectStore:
+  """Persistent map from author keys to the key of the author they finally redirect to.
+  
+  Kept in a sqlite database, so lookups survive restarts. Chains are stored compressed:
+  when A redirects to B and B to C, both A and B are stored as redirecting to C.
+  Authors that are not redirects are stored as redirecting to themselves.
+  """
+  def __init__(self, filename="vacuumbot-redirects.db"):
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute("CREATE TABLE IF NOT EXISTS redirects (key TEXT PRIMARY KEY, target TEXT NOT NULL)")
+    self.db.commit()
+    self.lock = threading.Lock()
+  
+  def get_many(self, keys):
+    """Returns a dict with the stored targets of those keys that are known."""
+    found = {}
+    with self.lock:
+      for chunk in chunks(keys, 500):
+        rows = self.db.execute("SELECT key, target FROM redirects WHERE key IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+        found.update(rows.fetchall())
+    return found
+  
+  def put_many(self, targets):
+    with self.lock:
+      self.db.executemany("INSERT OR REPLACE INTO redirects (key, target) VALUES (?, ?)", targets.items())
+      self.db.commit()
+  
+  def resolve_many(self, keys, fetch, undelete=None):
+    """Returns a dict with the final author key for each of keys.
+    
+    Unknown keys are followed through their redirects one hop at a time, with one call
+    to fetch (which takes a list of keys and returns a dict of records, like get_many)
+    per hop for all keys together. Deleted authors are passed to undelete, which returns
+    the key to use. Keys that end in a cycle, a missing record or another type are
+    left out of the result and are not stored.
+    """
+    keys = list(set(keys))
+    targets = self.get_many(keys)
+    # For every unresolved key, the keys visited so far; the last one is fetched next
+    paths = dict((key, [key]) for key in keys if key not in targets)
+    found = {}
+    while len(paths) > 0:
+      records = {}
+      for chunk in chunks(list(set(path[-1] for path in paths.values())), 100):
+        records.update(fetch(chunk))
+      for start, path in paths.items():
+        obj = records.get(path[-1])
+        final = None
+        if obj == None:
+          print_log("Author " + path[-1] + " not found, referred to by " + start)
+        elif type_of(obj) == "/type/author":
+          final = path[-1]
+        elif type_of(obj) == "/type/delete" and undelete != None:
+          final = undelete(obj)
+        elif type_of(obj) == "/type/redirect":
+          location = obj["location"]
+          if location in path:
+            print_log("Redirect cycle for author " + start + ": " + " -> ".join(path + [location]))
+          elif location in targets:
+            final = targets[location]
+          elif location in found:
+            final = found[location]
+          else:
+            path.append(location)
+            continue
+        del paths[start]
+        if final != None:
+          # Path compression: every key on the way redirects straight to the final key
+          for key in path:
+            found[key] = final
+          targets[start] = final
+    if len(found) > 0:
+      self.put_many(found)
+    return dict((key, targets[key]) for key in keys if key in targets)
+
+class Journal:
+  """Crash-safe record of the progress of long sweeps, in a sqlite database.
+  
+  A sweep (like "clean_author_dates2") is split in partitions (like one death year).
+  For each partition the journal keeps how many keys were read from its query (the
+  cursor) and whether it is finished, and for each sweep the keys that were confirmed
+  saved. A sweep that is resumed skips finished partitions and saved keys. The journal
+  also remembers which queries had no results, so that they can be skipped for a while.
+  """
+  def __init__(self, filename="vacuumbot-journal.db"):
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS partitions (sweep TEXT, partition TEXT, cursor INTEGER, done INTEGER, PRIMARY KEY (sweep, partition))")
+    self.db.execute("CREATE TABLE IF NOT EXISTS saved (sweep TEXT, key TEXT, PRIMARY KEY (sweep, key))")
+    self.db.execute("CREATE TABLE IF NOT EXISTS empty (query TEXT PRIMARY KEY, checked REAL)")
+    self.db.commit()
+    self.lock = threading.Lock()
+  
+  def reset(self, sweep):
+    """Forgets all progress of a sweep, to start it from scratch."""
+    with self.lock:
+      self.db.execute("DELETE FROM partitions WHERE sweep = ?", (sweep,))
+      self.db.execute("DELETE FROM saved WHERE sweep = ?", (sweep,))
+      self.db.commit()
+  
+  def is_done(self, sweep, partition):
+    with self.lock:
+      row = self.db.execute("SELECT done FROM partitions WHERE sweep = ? AND partition = ?", (sweep, partition)).fetchone()
+    return row != None and row[0] == 1
+  
+  def cursor(self, sweep, partition):
+    with self.lock:
+      row = self.db.execute("SELECT cursor FROM partitions WHERE sweep = ? AND partition = ?", (sweep, partition)).fetchone()
+    return row[0] if row != None else 0
+  
+  def advance(self, sweep, partition, cursor, done=False):
+    with self.lock:
+      self.db.execute("INSERT OR REPLACE INTO partitions (sweep, partition, cursor, done) VALUES (?, ?, ?, ?)",
+                      (sweep, partition, cursor, int(done)))
+      self.db.commit()
+  
+  def saved(self, sweep, keys):
+    """Records that keys were saved."""
+    with self.lock:
+      self.db.executemany("INSERT OR IGNORE INTO saved (sweep, key) VALUES (?, ?)", [(sweep, key) for key in keys])
+      self.db.commit()
+  
+  def saved_keys(self, sweep, keys):
+    """Returns the set of keys (of at most a few hundred) that were saved before."""
+    with self.lock:
+      rows = self.db.execute("SELECT key FROM saved WHERE sweep = ? AND key IN (" + ",".join("?" * len(keys)) + ")", [sweep] + list(keys))
+      return set(row[0] for row in rows)
+  
+  def mark_empty(self, query):
+    """Records that a query had no results."""
+    with self.lock:
+      self.db.execute("INSERT OR REPLACE INTO empty (query, checked) VALUES (?, ?)", (simplejson.dumps(query, sort_keys=True), time()))
+      self.db.commit()
+  
+  def not_empty(self, queries, maxage):
+    """Returns the queries that did not turn out empty in the last maxage seconds."""
+    with self.lock:
+      rows = self.db.execute("SELECT query FROM empty WHERE checked > ?", (time() - maxage,))
+      empty = set(row[0] for row in rows)
+    return [q for q in queries if simplejson.dumps(q, sort_keys=True) not in empty]
+
+class RecordCache:
+  """Local copies of OL records by key and revision, in a sqlite database.
+  
+  Sweeps that go over the same records one after the other can take them from here
+  instead of fetching them again, as long as OL still has the same revision. Records are
+  stored compressed. When they take more than maxbytes, the ones that were used least
+  recently are dropped. With trust, cached records are used without asking OL for their
+  revision, for example to clean records offline.
+  """
+  def __init__(self, filename="vacuumbot-records.db", maxbytes=2 ** 30, trust=False):
+    self.maxbytes = maxbytes
+    self.trust = trust
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, revision INTEGER, data BLOB, size INTEGER, used REAL)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS records_used ON records (used)")
+    self.db.commit()
+    self.lock = threading.Lock()
+    self.size = self.db.execute("SELECT coalesce(sum(size), 0) FROM records").fetchone()[0]
+  
+  def get_many(self, keys):
+    """Returns a dict with the revision and the record of each of keys that is in the cache."""
+    found = {}
+    with self.lock:
+      for chunk in chunks(keys, 500):
+        rows = self.db.execute("SELECT key, revision, data FROM records WHERE key IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+        for key, revision, data in rows:
+          found[key] = (revision, simplejson.loads(zlib.decompress(data)))
+      now = time()
+      self.db.executemany("UPDATE records SET used = ? WHERE key = ?", [(now, key) for key in found])
+      self.db.commit()
+    return found
+  
+  def put_many(self, records):
+    """Stores a list of marshalled records, replacing older revisions."""
+    rows = []
+    now = time()
+    for record in records:
+      data = zlib.compress(simplejson.dumps(record), 1)
+      rows.append((record["key"], record.get("revision"), sqlite3.Binary(data), len(data), now))
+    with self.lock:
+      self._discard([row[0] for row in rows])
+      self.db.executemany("INSERT INTO records (key, revision, data, size, used) VALUES (?, ?, ?, ?, ?)", rows)
+      self.size = self.size + sum(row[3] for row in rows)
+      if self.size > self.maxbytes:
+        self._evict()
+      self.db.commit()
+  
+  def discard(self, keys):
+    with self.lock:
+      self._discard(keys)
+      self.db.commit()
+  
+  def _discard(self, keys):
+    for chunk in chunks(keys, 500):
+      marks = ",".join("?" * len(chunk))
+      self.size = self.size - self.db.execute("SELECT coalesce(sum(size), 0) FROM records WHERE key IN (" + marks + ")", chunk).fetchone()[0]
+      self.db.execute("DELETE FROM records WHERE key IN (" + marks + ")", chunk)
+  
+  def _evict(self):
+    """Drops the least recently used records until the cache is down to 90% of maxbytes."""
+    dropped = []
+    for key, size in self.db.execute("SELECT key, size FROM records ORDER BY used"):
+      if self.size <= self.maxbytes * 0.9:
+        break
+      dropped.append(key)
+      self.size = self.size - size
+    for chunk in chunks(dropped, 500):
+      self.db.execute("DELETE FROM records WHERE key IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+
+class IdentifierIndex:
+  """An index from normalised ISBNs, LCCNs, OCLC numbers and Goodreads IDs to editions, in sqlite.
+  
+  It is filled from a dump (see index_dump) or from the records a VacuumBot fetches. All
+  editions with an identifier are found with one lookup, and duplicates() lists every
+  identifier that more than one edition has, for merge or cleanup sweeps.
+  """
+  def __init__(self, filename="vacuumbot-identifiers.db"):
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS ids (scheme TEXT, value TEXT, key TEXT, PRIMARY KEY (scheme, value, key)) WITHOUT ROWID")
+    self.db.execute("CREATE INDEX IF NOT EXISTS ids_key ON ids (key)")
+    self.db.commit()
+    self.lock = threading.Lock()
+  
+  def add_many(self, records):
+    """Indexes a list of editions, replacing what was indexed for them before."""
+    keys = [record["key"] for record in records]
+    rows = [(scheme, value, record["key"]) for record in records for scheme, value in identifiers_of(record)]
+    with self.lock:
+      for chunk in chunks(keys, 500):
+        self.db.execute("DELETE FROM ids WHERE key IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+      self.db.executemany("INSERT OR IGNORE INTO ids (scheme, value, key) VALUES (?, ?, ?)", rows)
+      self.db.commit()
+  
+  def lookup(self, scheme, value):
+    """Returns the keys of the editions with an identifier, like lookup("isbn", "0-19-852663-6")."""
+    normalize = dict((s, n) for s, fields, n in IDENTIFIERS)[scheme]
+    with self.lock:
+      return [row[0] for row in self.db.execute("SELECT key FROM ids WHERE scheme = ? AND value = ?", (scheme, normalize(value)))]
+  
+  def duplicates(self, scheme=None):
+    """Yields (scheme, value, keys) for every identifier that more than one edition has."""
+    query = "SELECT scheme, value, group_concat(key, ' ') FROM ids"
+    args = ()
+    if scheme != None:
+      query = query + " WHERE scheme = ?"
+      args = (scheme,)
+    with self.lock:
+      rows = self.db.execute(query + " GROUP BY scheme, value HAVING count(*) > 1", args).fetchall()
+    for scheme, value, keys in rows:
+      yield (scheme, value, keys.split(" "))
+
+class Coordinator:
+  """Hands out the shards of a sweep to several workers, through a shared sqlite database.
+  
+  A shard (like one death year, or the OLIDs ending in 3) is leased to one worker at a
+  time. The lease is renewed in the background while the worker holds it; when the worker
+  dies, the lease runs out after lease seconds and the shard goes to another worker.
+  Workers are VacuumBots in other processes, or on other hosts if the database is on
+  a shared filesystem with working locks.
+  
+  Workers share the shards of a run of a sweep. Without a run, a sweep has one set of
+  shards, which starts over when a worker starts the sweep (without resume) after all
+  shards are finished. With a run, like the one run_workers makes, each run has shards of
+  its own: workers that should share a sweep are given the same run, and a new run does
+  the whole sweep again.
+  """
+  def __init__(self, filename="vacuumbot-shards.db", lease=300, digits=1, run=None):
+    """Format sweeps are split in shards by the last digits of the OLIDs (see olid_shards)."""
+    self.lease = lease
+    self.digits = digits
+    self.run = run
+    self.worker = socket.gethostname() + ":" + str(os.getpid())
+    self.db = sqlite3.connect(filename, timeout=60, isolation_level=None, check_same_thread=False)
+    self.db.execute("CREATE TABLE IF NOT EXISTS shards (sweep TEXT, shard TEXT, owner TEXT, expires REAL, done INTEGER, PRIMARY KEY (sweep, shard))")
+    self.lock = threading.Lock()
+    self.held = set()
+    self.stopped = threading.Event()
+    self.renewer = None
+  
+  def add(self, sweep, shards):
+    """Adds shards to a sweep. Shards that the sweep has already are left as they are."""
+    with self.lock:
+      self.db.execute("BEGIN IMMEDIATE")
+      self.db.executemany("INSERT OR IGNORE INTO shards (sweep, shard, owner, expires, done) VALUES (?, ?, NULL, 0, 0)",
+                          [(sweep, shard) for shard in shards])
+      self.db.execute("COMMIT")
+  
+  def reset(self, sweep):
+    """Forgets all shards of a sweep, to run it again from scratch."""
+    with self.lock:
+      self.db.execute("DELETE FROM shards WHERE sweep = ?", (sweep,))
+  
+  def restart(self, sweep):
+    """Forgets the shards of a sweep if they are all finished. Returns True if there were any."""
+    with self.lock:
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        unfinished, total = self.db.execute("SELECT total(done = 0), count(*) FROM shards WHERE sweep = ?", (sweep,)).fetchone()
+        if total > 0 and unfinished == 0:
+          self.db.execute("DELETE FROM shards WHERE sweep = ?", (sweep,))
+      finally:
+        self.db.execute("COMMIT")
+    return total > 0 and unfinished == 0
+  
+  def last_run(self):
+    """Returns the run whose shards were added last, or None if there is none."""
+    with self.lock:
+      row = self.db.execute("SELECT sweep FROM shards WHERE sweep LIKE '% run %' ORDER BY rowid DESC LIMIT 1").fetchone()
+    return row[0].rpartition(" run ")[2] if row != None else None
+  
+  def claim(self, sweep):
+    """Leases an unfinished shard of the sweep that nobody holds. Returns None if there is none."""
+    with self.lock:
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        now = time()
+        row = self.db.execute("SELECT shard, owner FROM shards WHERE sweep = ? AND done = 0 AND expires < ? ORDER BY rowid LIMIT 1",
+                              (sweep, now)).fetchone()
+        if row != None:
+          self.db.execute("UPDATE shards SET owner = ?, expires = ? WHERE sweep = ? AND shard = ?",
+                          (self.worker, now + self.lease, sweep, row[0]))
+      finally:
+        self.db.execute("COMMIT")
+      if row != None and self.renewer == None:
+        self.renewer = threading.Thread(target=self._renewer)
+        self.renewer.daemon = True
+        self.renewer.start()
+    if row == None:
+      return None
+    if row[1] != None:
+      print_log("Taking over shard " + row[0] + " from " + row[1] + ", whose lease ran out")
+    self.held.add((sweep, row[0]))
+    return row[0]
+  
+  def finish(self, sweep, shard):
+    """Marks a shard finished, unless another worker took it over in the meantime."""
+    with self.lock:
+      self.held.discard((sweep, shard))
+      n = self.db.execute("UPDATE shards SET done = 1 WHERE sweep = ? AND shard = ? AND owner = ?",
+                          (sweep, shard, self.worker)).rowcount
+    if n == 0:
+      print_log("Not marking shard " + shard + " finished, another worker took it over")
+  
+  def release(self, sweep, shard, delay=0):
+    """Gives up a lease without finishing the shard, so another worker can take it after delay seconds."""
+    with self.lock:
+      self.held.discard((sweep, shard))
+      self.db.execute("UPDATE shards SET expires = ? WHERE sweep = ? AND shard = ? AND owner = ?",
+                      (time() + delay if delay > 0 else 0, sweep, shard, self.worker))
   
+  def close(self):
+    """Stops renewing leases and closes the database. Shards that are still held go to other workers after the lease time."""
+    self.stopped.set()
+    if self.renewer != None:
+      self.renewer.join()
+    self.db.close()
+  
+  def _renewer(self):
+    while not self.stopped.wait(self.lease / 3.0):
+      with self.lock:
+        for sweep, shard in list(self.held):
+          n = self.db.execute("UPDATE shards SET expires = ? WHERE sweep = ? AND shard = ? AND owner = ?",
+                              (time() + self.lease, sweep, shard, self.worker)).rowcount
+          if n == 0:
+            print_log("Lost the lease on shard " + shard + " to another worker")
+            self.held.discard((sweep, shard))
+
+def olid_shards(prefix, suffix, digits=1):
+  """Splits the keys like prefix + number + suffix into shards by the last digits of the number.
+  
+  Returns key~ patterns: for "/books/OL" and "M", "/books/OL*0M" to "/books/OL*9M" for one
+  digit, "/books/OL*00M" to "/books/OL*99M" for two, and so on, plus the keys with fewer
+  digits than that.
+  """
+  shards = [prefix + "*" + str(i).zfill(digits) + suffix for i in range(10 ** digits)]
+  shards.extend(prefix + str(i) + suffix for i in range(1, 10 ** (digits - 1)))
+  return shards
+
+def run_workers(processes, coordinator, method, args=(), run=None, **kw):
+  """Runs a sweep in several processes that share its shards through a Coordinator.
+  
+  coordinator is the Coordinator's database file. Each process makes its own VacuumBot
+  with the keyword arguments (username and password included), with its own save buffer,
+  and calls the sweep method with args. The workers share a new run of the sweep, unless
+  run names an earlier one to resume (with resume in args), or is "last" for the last
+  one in the database. Workers on other hosts can join in by doing the same with the
+  same run and the database on a shared filesystem. In a dry run, each process writes
+  its own patch files, named after the given prefix and its process id. Returns the
+  exit codes of the processes.
+  """
+  if run == "last":
+    c = Coordinator(coordinator)
+    run = c.last_run()
+    c.close()
+  if run == None:
+    run = strftime("%Y%m%d-%H%M%S", localtime()) + "-" + str(os.getpid())
+  print_log("Running " + method + " as run " + run + " of " + coordinator)
+  workers = [multiprocessing.Process(target=_run_worker, args=(coordinator, run, method, args, kw)) for i in range(processes)]
+  for w in workers:
+    w.start()
+  for w in workers:
+    w.join()
+  return [w.exitcode for w in workers]
+
+def _run_worker(coordinator, run, method, args, kw):
+  if kw.get("dryrun") != None:
+    # Each worker writes its own patch files, which read_patches finds with the same prefix
+    kw["dryrun"] = dict(kw["dryrun"], prefix=kw["dryrun"].get("prefix", "vacuumbot-patches") + "-" + str(os.getpid()))
+  bot = VacuumBot(coordinator=Coordinator(coordinator, run=run), **kw)
+  try:
+    getattr(bot, method)(*args)
+  finally:
+    # Worker processes exit without running atexit, so the save buffer is flushed here
+    bot.close()
+
 class VacuumBot:
   """VacuumBot can help clean up Open Library, just tell it what to do!
   
@@ -62,85 +1812,717 @@ class VacuumBot:
   Naturally, it shows no mercy.
   """
   
-  def __init__(self, username, password):
-    """Takes a username and password of a bot account to establish a connection to OL.
+  def __init__(self, username, password, limiter=None, retries=5, buffer=None, redirects="vacuumbot-redirects.db",
+               journal="vacuumbot-journal.db", base_url="http://openlibrary.org", metrics_port=None, report_every=None,
+               log=None, jsonlog=False, formatdistance=0, formatcache=None, dryrun=None, coordinator=None,
+               deadletter="vacuumbot-deadletter.jsonl", queriers=4, emptyage=7 * 86400, transport=None,
+               cache=None, identifiers=None, formatdict=None, logdir="", cookiefile=None, cookieage=7 * 86400):
+    """Takes a username and password of a bot account to log in to OL with.
+    
+    The bot logs in on its first call to OL, not before. With a cookiefile, the session
+    of the last login is reused for cookieage seconds, so short runs don't log in again.
     
+    All calls to OL wait for limiter, a RateLimiter that may be shared with other bots.
+    Calls that fail because OL is busy are tried again up to retries times.
+    buffer is a dict of keyword arguments for the OLBuffer that ol_save2 uses.
+    redirects is the file for the RedirectStore, which remembers where authors redirect to.
+    journal is the file for the Journal, which lets sweeps resume after a crash.
+    Without a username the bot works offline, for example to clean records from a dump.
+    base_url is the Open Library site to clean, for example a local test server.
+    The bot's Metrics are served on metrics_port, if given, and summarised in the log
+    every report_every seconds, if given.
+    log is a dict of keyword arguments for the LogWriter that writes the log files.
+    With jsonlog, flog also writes each line as JSON to 'vacuumbot-log.jsonl'.
+    Formats that are not in formatdict are matched to one within formatdistance edits,
+    or else looked up in formatcache, an NKCache, if given.
+    dryrun is a dict of keyword arguments for a PatchWriter. If given, nothing is saved to
+    OL: every save is written to the patch files instead, to be reviewed and uploaded later
+    with upload_patches.
+    With a coordinator, a Coordinator shared with other workers, the bot only runs the
+    shards of a sweep that it can claim (see run_workers). The bot closes it when it is closed.
+    Records that OL rejects are written to the deadletter file.
+    Sweeps run the queries of a partition with queriers threads (see fan_out), and skip
+    queries that had no results in the last emptyage seconds.
+    transport is a dict of keyword arguments for an HTTPTransport. If given, the OL client
+    makes its calls through that pool of connections.
+    cache is a dict of keyword arguments for a RecordCache. If given, records are fetched
+    through it (see get_many).
+    identifiers is the file of an IdentifierIndex. If given, every edition the bot fetches
+    is indexed in it.
+    formatdict is the JSON file of format spellings, by default the one next to this file.
+    The log files are written to the directory logdir.
     """
-    self.ol = OpenLibrary()
-    self.ol.login(username, password)
+    self.metrics = Metrics()
+    if metrics_port != None:
+      self.metrics.serve(metrics_port)
+    if report_every != None:
+      self.metrics.report_every(report_every)
+    self.limiter = limiter or RateLimiter()
+    self.retries = retries
+    self.base_url = base_url
+    self.ol = olapi.OpenLibrary(base_url)
+    if transport != None:
+      HTTPTransport(base_url, **transport).install(self.ol)
+    self.credentials = (username, password) if username != None else None
+    self.cookiefile = cookiefile
+    self.cookieage = cookieage
+    self.session = None
+    self.loginlock = threading.Lock()
     self.pagreg = re.compile(r"[^\s]\s+[:;]$")
     self.emptypagreg = re.compile(r"[,.:;]+$")
-    self.formatdict = simplejson.load(codecs.open("formatdict.json", "rb", "utf-8"))
+    self.formatdict = simplejson.load(codecs.open(formatdict or FORMATDICT, "rb", "utf-8"))
+    self.formatindex = FormatIndex(self.formatdict, formatdistance)
     self.enc2 = codecs.getencoder("ascii")
-    self.savebuffer = {}
+    self.savebuffer = OLBuffer(self._save_batch, **(buffer or {}))
     self.badrecords = []
     self.aucache = {}
+    self.tasks = {}
+    self.redirects = RedirectStore(redirects)
+    self.journal = Journal(journal)
+    self.sweepname = None
+    self.finished = True
     self.wocache = {}
-    #self.formatcache = NKCache("ol_books_formats", api_key = "cfdeaeda-4a22-4ae7-a2bf-1634da98fa1b")
-    self.logfile = codecs.EncodedFile(open("vacuumbot-log.tsv", "ab"), "unicode_internal", "utf-8", "replace")
+    self.formatcache = formatcache
+    self.patches = PatchWriter(**dryrun) if dryrun != None else None
+    self.snapshots = collections.OrderedDict()
+    self.fetched = collections.OrderedDict()
+    self.recleaners = {}
+    self.conflicts = []
+    self.context = threading.local()
+    self.snaplock = threading.Lock()
+    self.coordinator = coordinator
+    self.deadletter = deadletter
+    self.deadlock = threading.Lock()
+    self.queriers = queriers
+    self.emptyage = emptyage
+    self.cache = RecordCache(**cache) if cache != None else None
+    self.revcheck = True
+    self.identifiers = IdentifierIndex(identifiers) if identifiers != None else None
+    self.log = LogWriter(**(log or {}))
+    self.logdir = logdir
+    self.jsonlog = jsonlog
+    self.closed = False
+    atexit.register(self.close)
+    exit_on_signal()
   
   def enc(self, str):
     return self.enc2(str, "backslashreplace")[0]
   
+  def logfile(self, name):
+    """Returns the path of the log file with the given name, in logdir."""
+    return os.path.join(self.logdir, name)
+  
   def flog(self, key, operation, message):
     """Log to file 'vacuumbot-log.tsv'. Lines are time, key, operation and message, tab-separated.
+    
+    With jsonlog, the same is written as a JSON object per line to 'vacuumbot-log.jsonl'.
     """
-    self.logfile.write(unicode(strftime("%Y-%m-%d_%H:%M:%S", localtime()) + "\t" + key + "\t" + operation + "\t" + message + "\n"))
+    timestamp = strftime("%Y-%m-%d_%H:%M:%S", localtime())
+    self.log.write(self.logfile("vacuumbot-log.tsv"), unicode(timestamp + "\t" + key + "\t" + operation + "\t" + message + "\n"))
+    if self.jsonlog:
+      self.log.write(self.logfile("vacuumbot-log.jsonl"), simplejson.dumps({"time": timestamp, "key": key, "operation": operation, "message": message}) + "\n")
   
   def save_error(self, key, message):
-    errorfile = codecs.EncodedFile(open("vacuumbot-errors.txt", "ab"), "unicode_internal", "utf-8", "replace")
-    errorfile.write(unicode("[" + strftime("%Y-%m-%d_%H:%M:%S", localtime()) + "] Could not save record for: " + key + ", error was: " + message + "\n"))
-    errorfile.close()
+    self.log.write(self.logfile("vacuumbot-errors.txt"), unicode("[" + strftime("%Y-%m-%d_%H:%M:%S", localtime()) + "] Could not save record for: " + key + ", error was: " + message + "\n"))
+  
+  def _ol_call(self, kind, method, *args):
+    """Calls a method of the OL client as soon as the rate limiter allows it.
+    
+    kind is "read" or "write". Transient failures make the limiter back off and are
+    tried again; other errors are raised right away. The first call logs in.
+    """
+    if self.credentials != None and self.session == None and method != "login":
+      self._login()
+    tries = 0
+    while True:
+      self.limiter.acquire(kind)
+      start = time()
+      try:
+        result = getattr(self.ol, method)(*args)
+      except Exception as e:
+        self.metrics.observe("vacuumbot_api_seconds", time() - start, method=method)
+        self.metrics.inc("vacuumbot_api_errors_total", method=method)
+        if self.session == "cookiefile" and method != "login" and is_unauthorized(e):
+          # The stored session has expired: log in again, once
+          self._login(fresh=True)
+          continue
+        if not is_transient(e) or tries >= self.retries:
+          raise
+        self.limiter.failure(kind)
+        self.metrics.inc("vacuumbot_retries_total", method=method)
+        tries = tries + 1
+        print_log(method + " failed (" + str(e) + "), retrying at " + str(round(self.limiter.rate(kind), 2)) + " calls/s")
+        continue
+      self.metrics.observe("vacuumbot_api_seconds", time() - start, method=method)
+      self.limiter.success(kind)
+      return result
+  
+  def _login(self, fresh=False):
+    """Logs in to OL, or takes the session from the cookiefile.
+    
+    The stored session is used if it is for the same account and site, and less than
+    cookieage seconds old. A new session is stored there. With fresh, the stored
+    session is not used, because OL turned it down.
+    """
+    with self.loginlock:
+      if self.session == "login" or (self.session == "cookiefile" and not fresh):
+        return
+      username, password = self.credentials
+      if not fresh and self.cookiefile != None and os.path.exists(self.cookiefile) and \
+         time() - os.path.getmtime(self.cookiefile) < self.cookieage:
+        with open(self.cookiefile, "rb") as f:
+          stored = simplejson.load(f)
+        if stored.get("username") == username and stored.get("base_url") == self.base_url:
+          self.ol.cookie = stored["cookie"].encode("utf-8")
+          self.session = "cookiefile"
+          return
+      self._ol_call("read", "login", username, password)
+      self.session = "login"
+      if self.cookiefile != None and getattr(self.ol, "cookie", None):
+        # The cookie is as good as the password, so only the bot's user may read it
+        with os.fdopen(os.open(self.cookiefile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "wb") as f:
+          simplejson.dump({"username": username, "base_url": self.base_url, "cookie": self.ol.cookie}, f)
+      print_log("Logged in to " + self.base_url + " as " + username)
+  
+  def query(self, query, pagesize=1000):
+    """Queries OL. If the query's limit is False, returns an iterator over all results.
+    
+    The complete result is then fetched in pages of pagesize by a QueryCursor, each
+    page through the rate limiter.
+    """
+    if "limit" in query and query["limit"] == False:
+      return QueryCursor(lambda q: self._ol_call("read", "query", q), query, pagesize)
+    return self._ol_call("read", "query", query)
+  
+  def _snapshot(self, key, record):
+    """Remembers the hash and revision of a marshalled record as it was fetched.
+    
+    In a dry run the record itself is kept too, to diff against.
+    """
+    with self.snaplock:
+      self.fetched[key] = (record_hash(record), record.get("revision"))
+      if len(self.fetched) > 100000:
+        self.fetched.popitem(last=False)
+      if self.patches != None:
+        self.snapshots[key] = simplejson.dumps(record)
+        if len(self.snapshots) > 10000:
+          self.snapshots.popitem(last=False)
   
-  def query(self, query):
-    return self.ol.query(query)
+  def _unchanged(self, key, record):
+    """Tells if a marshalled record is the same as when it was fetched, so saving it would do nothing.
+    
+    Otherwise, makes sure the record carries the revision it was fetched at, so OL can
+    tell if someone else changed it in the meantime.
+    """
+    with self.snaplock:
+      fetched = self.fetched.pop(key, None)
+    if fetched == None:
+      return False
+    if fetched[0] == record_hash(record):
+      self.metrics.inc("vacuumbot_noop_saves_total")
+      return True
+    if fetched[1] != None and "revision" not in record:
+      record["revision"] = fetched[1]
+    return False
+  
+  def _write_patch(self, key, record, message):
+    """Writes a save to the patch files, as a diff against the snapshot of the record."""
+    with self.snaplock:
+      old = self.snapshots.pop(key, None)
+    old = simplejson.loads(old) if old != None else {}
+    self.patches.write(key, old.get("revision", record.get("revision")), diff_record(old, record), message)
+    if self.sweepname != None:
+      self.journal.saved(self.sweepname, [key])
+    self.flog(key, "dry run", message)
+  
+  def fan_out(self, queries):
+    """Returns an iterator over the keys that a list of disjoint queries with limit False find.
+    
+    The queries run at the same time on self.queriers threads. Queries that had no results
+    in the last self.emptyage seconds are skipped, and new empty ones are remembered in
+    the journal.
+    """
+    todo = self.journal.not_empty(queries, self.emptyage)
+    if len(todo) < len(queries):
+      print_log("Skipping " + str(len(queries) - len(todo)) + " of " + str(len(queries)) + " queries, they had no results before")
+    return QueryFanout(self.query, todo, self.queriers, self.journal.mark_empty)
   
   def ol_save(self, key, record, message):
+    record = marshal_record(record)
+    if self._unchanged(key, record):
+      self.flog(key, "no-op save skipped", message)
+      return
+    if self.patches != None:
+      return self._write_patch(key, record, message)
     try:
-      self.ol.save(key, record, self.enc(message))
+      result = self._ol_call("write", "save", key, record, self.enc(message))
+      self._cache_saved([record], result)
+      if self.sweepname != None:
+        self.journal.saved(self.sweepname, [key])
       self.flog(key, "direct save", message)
       print_log("Saved "+key+": "+message)
-    except OLError as e:
+    except olapi.OLError as e:
+      if is_conflict(e):
+        self._conflict(key)
+        return
       self.save_error(key, str(e))
       print_log("Save failed: "+str(e))
   
   def ol_save2(self, key, record, message):
-    if message != None:
-      record = marshal(record)
-      if message in self.savebuffer.keys():
-        self.savebuffer[message][key] = record
-        if len(self.savebuffer[message]) >= 100:
-          self.flush(message)
-      else:
-        self.savebuffer[message] = {}
-        self.savebuffer[message][key] = record
+    if message == None:
+      raise Exception("Message for saving is missing!")
+    record = marshal_record(record)
+    if self._unchanged(key, record):
+      self.flog(key, "no-op save skipped", message)
+    elif self.patches != None:
+      self._write_patch(key, record, message)
+    else:
+      cleaner = getattr(self.context, "clean", None)
+      if cleaner != None:
+        self.recleaners[key] = cleaner
+      self.savebuffer.add(key, record, message)
       self.flog(key, "buffer save", message)
+  
+  def _conflict(self, key):
+    """Queues a record that someone else changed before it was saved, to be fetched and cleaned again."""
+    if key in self.recleaners:
+      self.metrics.inc("vacuumbot_conflicts_total")
+      self.conflicts.append(key)
     else:
-      raise Exception("Message for saving is missing!")
+      self.save_error(key, "Edit conflict: the record was changed by someone else, it was not saved")
+  
+  def _reclean(self, keys):
+    """Fetches records that had an edit conflict again and cleans them with the same cleaner."""
+    for chunk in chunks(keys, 100):
+      records = self._ol_call("read", "get_many", chunk)
+      if self.cache != None:
+        self.cache.put_many(records.values())
+      for key in chunk:
+        cleaner = self.recleaners.pop(key, None)
+        if cleaner == None or key not in records:
+          continue
+        clean, raw = cleaner
+        self._snapshot(key, records[key])
+        self.context.clean = cleaner
+        try:
+          clean(records[key] if raw else LazyRecord(records[key]))
+        finally:
+          self.context.clean = None
   
   def flush(self, buffer_name):
+    self.savebuffer.flush(buffer_name)
+  
+  def _save_batch(self, buffer_name, batch):
+    """Saves a dict of records with save_many, using buffer_name as the comment.
+    
+    If OL rejects the data of a record, the record it names is set aside and the rest is
+    saved again. If it does not say which record is bad, the batch is split in halves
+    until the bad records are found, so the good ones are still saved in few calls.
+    Rejected records go to the dead letter file (see replay_dead_letters) and records
+    with an edit conflict are cleaned again. Records that could not be saved because OL
+    is busy, or because of an error about the call as a whole (like a lost login), are
+    returned, to go back into the save buffer and be saved with the next flush.
+    """
     try:
-      if len(self.savebuffer[buffer_name]) > 0:
-        self.ol.save_many(self.savebuffer[buffer_name].values(), self.enc(buffer_name))
-        for key in self.savebuffer[buffer_name].keys():
-          self.flog(key, "buffer flush", buffer_name)
-        print_log("Flushed buffer ("+str(len(self.savebuffer[buffer_name]))+" records): "+buffer_name)
-        self.savebuffer[buffer_name] = {}
-        sleep(1)
-    except OLError as e:
-      # Try to remove rejected record from buffer
-      err_mess = simplejson.loads(re.sub(r'^[^{]*', "", str(e)))
-      if err_mess["error"] == "bad_data":
-        k = err_mess["at"]["key"]
-        del self.savebuffer[buffer_name][k]
-        self.save_error(k, "Multisave failed: "+str(e)+"; removed record from buffer")
-      else:
-        k = self.savebuffer[buffer_name].keys()[0]
-        self.save_error(k, "Multisave failed: "+str(e))
+      result = self._ol_call("write", "save_many", batch.values(), self.enc(buffer_name))
+    except Exception as e:
+      if not is_record_error(e):
+        self.save_error(batch.keys()[0], "Multisave failed: " + str(e) + "; " + str(len(batch)) + " records stay in the buffer")
+        return batch
+      err_mess = error_data(e)
+      k = err_mess.get("at", {}).get("key")
+      if k in batch:
+        # OL says which record is wrong: set it aside and save the rest
+        record = batch.pop(k)
+        if is_conflict(e):
+          self._conflict(k)
+        else:
+          self._dead_letter(k, record, buffer_name, e)
+        return self._save_batch(buffer_name, batch) if len(batch) > 0 else {}
+      if len(batch) == 1:
+        k, record = batch.items()[0]
+        if is_conflict(e):
+          self._conflict(k)
+        else:
+          self._dead_letter(k, record, buffer_name, e)
+        return {}
+      self.metrics.inc("vacuumbot_bisections_total")
+      keys = batch.keys()
+      retry = self._save_batch(buffer_name, dict((k, batch[k]) for k in keys[:len(keys) / 2]))
+      retry.update(self._save_batch(buffer_name, dict((k, batch[k]) for k in keys[len(keys) / 2:])))
+      return retry
+    self._cache_saved(batch.values(), result)
+    for key in batch.keys():
+      self.recleaners.pop(key, None)
+      self.flog(key, "buffer flush", buffer_name)
+    if self.sweepname != None:
+      self.journal.saved(self.sweepname, batch.keys())
+    self.metrics.inc("vacuumbot_flushes_total")
+    self.metrics.inc("vacuumbot_flushed_records_total", len(batch))
+    self.metrics.observe("vacuumbot_flush_records", len(batch), Metrics.SIZE_BUCKETS)
+    print_log("Flushed buffer ("+str(len(batch))+" records): "+buffer_name)
+    return {}
+  
+  def _dead_letter(self, key, record, message, error):
+    """Writes a record that OL rejected to the dead letter file, with its comment and the error."""
+    key = key or record.get("key")
+    self.metrics.inc("vacuumbot_rejects_total")
+    self.save_error(key, "Multisave failed: " + str(error) + "; moved record to " + self.deadletter)
+    line = simplejson.dumps({"key": key, "comment": message, "error": str(error), "record": record}) + "\n"
+    with self.deadlock:
+      with open_file(self.deadletter, "ab") as f:
+        f.write(line)
+  
+  def replay_dead_letters(self, filename=None):
+    """Tries to save the records in a dead letter file again, for example after fixing a cleaner.
+    
+    The file is renamed first, so records that are rejected again end up in a new dead
+    letter file. Returns the number of records that were tried.
+    """
+    filename = filename or self.deadletter
+    replayed = filename + "." + strftime("%Y%m%d-%H%M%S", localtime())
+    with self.deadlock:
+      os.rename(filename, replayed)
+    n = 0
+    for line in open_file(replayed):
+      letter = simplejson.loads(line)
+      self.savebuffer.add(letter["key"], letter["record"], letter["comment"])
+      self.flog(letter["key"], "dead letter replay", letter["comment"])
+      n = n + 1
+    self.flush_all()
+    print_log("Replayed " + str(n) + " records from " + replayed)
+    return n
   
   def flush_all(self):
-    for m in self.savebuffer.keys():
-      self.flush(m)
+    """Saves everything in the save buffer, cleaning records that had an edit conflict again.
+    
+    A record that keeps conflicting is given up after three tries. Returns True if
+    everything was saved, False if records were given up or are still in the buffer
+    because OL could not be reached.
+    """
+    self.savebuffer.flush()
+    for attempt in range(3):
+      if len(self.conflicts) == 0:
+        break
+      keys, self.conflicts = self.conflicts, []
+      print_log("Cleaning " + str(len(keys)) + " records again after edit conflicts")
+      self._reclean(keys)
+      self.savebuffer.flush()
+    given_up = self.conflicts
+    for key in given_up:
+      self.recleaners.pop(key, None)
+      self.save_error(key, "Edit conflict: the record kept changing, it was not saved")
+    self.conflicts = []
+    return len(given_up) == 0 and len(self.savebuffer.pending()) == 0
+  
+  def close(self):
+    """Saves everything left in the save buffer. Called automatically on exit.
+    
+    Records that could not be saved in time go to the dead letter file. Records that were
+    still being sent may have been saved, so they are only listed in the error log.
+    """
+    if self.closed:
+      return
+    self.closed = True
+    self.savebuffer.close()
+    if self.patches != None:
+      self.patches.close()
+    if self.coordinator != None:
+      self.coordinator.close()
+    unsent = self.savebuffer.pending_records(sending=False)
+    for message, key, record in unsent:
+      self._dead_letter(key, record, message, "Record was still in the save buffer at shutdown")
+    unsent = set(key for message, key, record in unsent)
+    for key in self.savebuffer.pending():
+      if key not in unsent:
+        self.save_error(key, "Record was still being saved at shutdown, it may or may not have been saved")
+    self.log.close()
+    if self.log.dropped > 0:
+      print_log("Dropped " + str(self.log.dropped) + " log lines, because logging could not keep up")
+  
+  def _partition(self, sweep, partition, keys, process, resume=False):
+    """Runs process over the keys of one partition of a sweep, keeping track in the journal.
+    
+    keys is a function that returns the keys of the partition, so that it is not even
+    queried when resume is set and the partition was finished before. When resuming,
+    keys that were saved before are left out without going to OL. The partition is only
+    marked finished when all its records were saved; if some are still in the save buffer
+    after an outage, it is run again on resume. Returns False if the partition was skipped
+    or left unfinished. Dry runs are journaled separately from real runs.
+    """
+    sweep = self._sweep_name(sweep)
+    self.finished = False
+    if resume and self.journal.is_done(sweep, partition):
+      print_log("Skipping " + partition + ", it was finished before")
+      self.finished = True
+      return False
+    cursor = [self.journal.cursor(sweep, partition) if resume else 0]
+    if cursor[0] > 0:
+      # The query is run again from the start: records that were fixed drop out of it anyway
+      print_log("Resuming " + partition + ", " + str(cursor[0]) + " keys were read before")
+    
+    def journal_keys():
+      n = 0
+      for chunk in chunks(keys(), 100):
+        n = n + len(chunk)
+        if resume:
+          saved = self.journal.saved_keys(sweep, chunk)
+          chunk = [key for key in chunk if key not in saved]
+        for key in chunk:
+          yield key
+        if n > cursor[0]:
+          cursor[0] = n
+          self.journal.advance(sweep, partition, n)
+    
+    self.sweepname = sweep
+    try:
+      process(journal_keys())
+      finished = self.flush_all()
+    finally:
+      self.sweepname = None
+    if not finished:
+      print_log("Not all records of " + partition + " were saved, it is left unfinished")
+    self.journal.advance(sweep, partition, cursor[0], done=finished)
+    self.finished = finished
+    return finished
+  
+  def _sweep_name(self, sweep):
+    if self.coordinator != None and self.coordinator.run != None:
+      sweep = sweep + " run " + self.coordinator.run
+    if self.patches != None:
+      return "dryrun:" + sweep
+    return sweep
+  
+  def _start_sweep(self, sweep, resume):
+    if resume:
+      return
+    sweep = self._sweep_name(sweep)
+    if self.coordinator == None:
+      self.journal.reset(sweep)
+    elif self.coordinator.run == None and self.coordinator.restart(sweep):
+      # Other workers may be running the sweep already, so it is only started over once it was finished
+      print_log("Starting " + sweep + " over, all its shards were finished")
+      self.journal.reset(sweep)
+  
+  def _shards(self, sweep, shards):
+    """Yields the shards of a sweep that this bot should run.
+    
+    Without a coordinator, these are all shards. With one, shards are claimed one at a
+    time, and marked finished when the next one is asked for. A shard that raised an
+    error is given back, for another worker to try. A shard whose records could not all
+    be saved is given back after the lease time, to try again when OL may be back.
+    """
+    if self.coordinator == None:
+      for shard in shards:
+        yield shard
+      return
+    sweep = self._sweep_name(sweep)
+    self.coordinator.add(sweep, shards)
+    while True:
+      shard = self.coordinator.claim(sweep)
+      if shard == None:
+        return
+      print_log("Claimed shard " + shard + " of " + sweep)
+      try:
+        yield shard
+      except:
+        self.coordinator.release(sweep, shard)
+        raise
+      if self.finished:
+        self.coordinator.finish(sweep, shard)
+      else:
+        self.coordinator.release(sweep, shard, self.coordinator.lease)
+  
+  def _format_partitions(self, sweep, old, process, resume):
+    """Runs process over the keys of all Editions with format old, one partition per shard.
+    
+    old is one format or a tuple of formats, which are queried at the same time (see fan_out).
+    With a coordinator, the Editions are split in shards by their OLIDs (see olid_shards).
+    """
+    queries = [{"type":"/type/edition", "physical_format": value, "limit": False} for value in format_values(old)]
+    shards = olid_shards("/books/OL", "M", self.coordinator.digits) if self.coordinator != None else [None]
+    for shard in self._shards(sweep, shards):
+      qs = [dict(q, **{"key~": shard}) for q in queries] if shard != None else queries
+      self._partition(sweep, "format " + format_name(old) + (" " + shard if shard != None else ""), lambda: self.fan_out(qs), process, resume)
+  
+  def _sweep(self, keys, clean, raw=False, prefetch=False, fetchers=1, cleaners=1, writers=1, depth=2):
+    """Calls clean on the full record of every key, overlapping fetching, cleaning and saving.
+    
+    Keys are fetched with get_many in batches of 100 by a pool of fetchers, while a pool of
+    cleaners works on the previous batches and writers (the flushers of the save buffer) save
+    full buffers with save_many. clean is called with each record (a LazyRecord, unless raw is
+    True) and is expected to save through ol_save2. At most depth batches wait between two
+    stages, which bounds memory use. With prefetch, the fetchers also get the Works and
+    authors of each batch that _update_author_in_edition needs (see _prefetch).
+    """
+    def fetch(batch):
+      print_log("Getting full records")
+      records = self.get_many(batch).values()
+      for obj in records:
+        self._snapshot(obj["key"], obj)
+      if not raw:
+        records = [LazyRecord(obj) for obj in records]
+      if prefetch:
+        self._prefetch(records)
+      return records
+    
+    def cleanbatch(records):
+      self.context.clean = (clean, raw)
+      for obj in records:
+        clean(obj)
+    
+    self.savebuffer.start(writers)
+    try:
+      Pipeline(chunks(keys, 100), [(fetch, fetchers), (cleanbatch, cleaners)], depth).run()
+    finally:
+      self.flush_all()
+  
+  def _prefetch(self, records):
+    """Gets everything _update_author_in_edition needs for a batch of Edition records.
+    
+    The first Works of the Editions with authors that are not in self.wocache yet are
+    fetched with one get_many. Then the authors of the Editions whose Work has no
+    authors are resolved together. Cleaning the batch then needs no calls to OL.
+    The wocache hits and misses are counted where the cache is used, in
+    _update_author_in_edition, so each Edition counts once.
+    """
+    works = set()
+    for obj in records:
+      if "authors" in obj.keys() and len(obj["authors"]) > 0 and "works" in obj.keys() and len(obj["works"]) > 0:
+        if obj["works"][0] not in self.wocache:
+          works.add(obj["works"][0])
+    for chunk in chunks(list(works), 100):
+      for wID, work in self.get_many(chunk).iteritems():
+        self.wocache[wID] = "authors" in work.keys() and len(work["authors"]) > 0
+    authors = set()
+    for obj in records:
+      if "authors" in obj.keys() and len(obj["authors"]) > 0:
+        if "works" not in obj.keys() or len(obj["works"]) == 0 or not self.wocache.get(obj["works"][0], False):
+          authors.update(obj["authors"])
+    if len(authors) > 0:
+      self.resolve_authors(list(authors))
+  
+  def task(self, steps):
+    """Returns the compiled Task for the methods of a list of (method, args) steps.
+    
+    Tasks are kept by their methods only, as the arguments may differ for every record
+    (as in a command file). At most 1000 are kept.
+    """
+    methods = tuple(method for method, args in steps)
+    if methods not in self.tasks:
+      if len(self.tasks) >= 1000:
+        self.tasks.clear()
+      self.tasks[methods] = Task(methods)
+    return self.tasks[methods]
+  
+  def clean_record(self, obj, steps):
+    """Runs a list of cleaners on an unmarshalled record, in one pass.
+    
+    steps is a list of (method, args) tuples, like [("replace_format2", ["pepperbek", "Paperback"])],
+    see Task. Returns the combined change comment, or None if the record did not change.
+    """
+    return self.task(steps).run(self, obj, [args for method, args in steps])
+  
+  def save_dump_changes(self, filename):
+    """Saves the changed records written by process_dump, in save_many batches."""
+    n = 0
+    for line in open_file(filename):
+      key, comment, data = line.rstrip("\n").split("\t", 2)
+      self.ol_save2(key, LazyRecord(simplejson.loads(data)), comment.decode("utf-8"))
+      n = n + 1
+    self.flush_all()
+    print_log("Saved " + str(n) + " records from " + filename)
+  
+  def upload_patches(self, prefix, writers=1):
+    """Saves the patches of a dry run, written with the given prefix, through the save buffer.
+    
+    The current records are fetched in batches of 100 with get_many. A patch is only
+    applied if the record is still at its base revision; otherwise it is logged as
+    a conflict and left out. Returns the number of patches that were applied.
+    """
+    self.savebuffer.start(writers)
+    n = 0
+    for batch in chunks(read_patches(prefix), 100):
+      current = self._ol_call("read", "get_many", [patch["key"] for patch in batch])
+      for patch in batch:
+        obj = current.get(patch["key"])
+        if obj == None or obj.get("revision") != patch["revision"]:
+          self.save_error(patch["key"], "Patch conflict: record is no longer at revision " + str(patch["revision"]))
+          continue
+        for field, value in patch["diff"].iteritems():
+          if value == None:
+            obj.pop(field, None)
+          else:
+            obj[field] = value
+        self.savebuffer.add(patch["key"], obj, patch["comment"])
+        self.flog(patch["key"], "patch upload", patch["comment"])
+        n = n + 1
+    self.flush_all()
+    print_log("Uploaded " + str(n) + " patches from " + prefix)
+    return n
+  
+  def get_many(self, keys):
+    """Returns a dict of the marshalled records for keys, like get_many of the OL client.
+    
+    With a RecordCache, cached records are used if OL still has the same revision, which
+    is checked with one query for all of them (or not at all if the cache is trusted).
+    The other records are fetched and put in the cache.
+    """
+    if self.cache == None:
+      return self._index(self._ol_call("read", "get_many", keys))
+    found = {}
+    cached = self.cache.get_many(keys) if self.revcheck or self.cache.trust else {}
+    if len(cached) > 0:
+      if self.cache.trust:
+        current = dict((key, revision) for key, (revision, record) in cached.iteritems())
+      else:
+        current = self._revisions(cached.keys())
+      for key, (revision, record) in cached.iteritems():
+        if revision != None and current.get(key) == revision:
+          found[key] = record
+    self.metrics.inc("vacuumbot_cache_total", len(found), cache="records", result="hit")
+    missing = [key for key in keys if key not in found]
+    if len(missing) > 0:
+      self.metrics.inc("vacuumbot_cache_total", len(missing), cache="records", result="miss")
+      fetched = self._ol_call("read", "get_many", missing)
+      self.cache.put_many(fetched.values())
+      found.update(fetched)
+    return self._index(found)
+  
+  def _index(self, records):
+    """Adds the editions among a dict of fetched records to the IdentifierIndex, if there is one."""
+    if self.identifiers != None:
+      self.identifiers.add_many([r for r in records.values() if type_of(r) == "/type/edition"])
+    return records
+  
+  def _revisions(self, keys):
+    """Returns the current revision of each of keys, with one query."""
+    try:
+      results = self._ol_call("read", "query", {"key": list(keys), "revision": None, "limit": len(keys)})
+    except olapi.OLError as e:
+      # Without a way to check them, cached records can't be used
+      print_log("Could not check revisions (" + str(e) + "), fetching all records from now on")
+      self.revcheck = False
+      return {}
+    return dict((r["key"], r.get("revision")) for r in results if isinstance(r, dict))
+  
+  def _cache_saved(self, records, result):
+    """Updates the RecordCache with saved records and the revisions OL gave them."""
+    if self.cache == None:
+      return
+    try:
+      result = simplejson.loads(result) if isinstance(result, basestring) else result
+      if isinstance(result, dict):
+        result = [result]
+      revisions = dict((r["key"], r["revision"]) for r in result)
+    except (ValueError, TypeError, KeyError):
+      revisions = {}
+    saved = []
+    for record in records:
+      if record["key"] in revisions:
+        saved.append(dict(record, revision=revisions[record["key"]]))
+    self.cache.discard([record["key"] for record in records if record["key"] not in revisions])
+    self.cache.put_many(saved)
   
   def ol_get(self, key, v=None):
     """Gets a record from OL and catches OLErrors.
@@ -148,52 +2530,59 @@ class VacuumBot:
     Make sure you check for None when you process this function's result.
     """
     try:
-      return self.ol.get(key, v)
-    except OLError as e:
+      if self.cache != None and v == None:
+        records = self.get_many([key])
+        if key not in records:
+          self.save_error(key, "Not found")
+          return None
+        self._snapshot(key, records[key])
+        return olapi.unmarshal(records[key])
+      obj = self._ol_call("read", "get", key, v)
+      if v == None:
+        self._snapshot(key, olapi.marshal(obj))
+      return obj
+    except olapi.OLError as e:
       self.save_error(key, str(e))
       print_log("Get failed: "+str(e))
   
-  def clean_author_dates(self):
-    for year in range(1900, 2013):
-      authors = self.query({"type": "/type/author", "death_date": str(year)+".", "limit": False})
-      print_log("Getting authors with death date '" + str(year) + "'...")
+  def clean_author_dates(self, resume=False):
+    """Removes the period after death dates from 1900 to 2012, one author at a time.
+    
+    With resume, years that were finished and authors that were saved before are skipped.
+    """
+    self._start_sweep("clean_author_dates", resume)
+    
+    def process(authors):
       for author in authors:
         obj = self.ol_get(author)
         self.clean_author(obj)
-        sleep(2)
-          
-      done = codecs.EncodedFile(open("cleanauthors-done.txt", "ab"), "unicode_internal", "utf-8", "replace")
-      done.write("Death date '" + str(year) + ".' updated to '" + str(year) + "'\n")
-      done.close()
     
-  def clean_author_dates2(self):
-    for year in range(0,1000):
+    self._author_dates("clean_author_dates", 1900, 2012, process, resume)
+  
+  def clean_author_dates2(self, resume=False, fetchers=1, cleaners=1, writers=1, depth=2):
+    """Removes the period after death dates from 0 to 999, in batches.
+    
+    With resume, years that were finished and authors that were saved before are skipped.
+    """
+    self._start_sweep("clean_author_dates2", resume)
+    process = lambda authors: self._sweep(authors, self.clean_author2, raw=True, fetchers=fetchers, cleaners=cleaners, writers=writers, depth=depth)
+    self._author_dates("clean_author_dates2", 0, 999, process, resume)
+  
+  def _author_dates(self, sweep, first, last, process, resume, years=10):
+    """Runs process over the authors with death dates from first to last followed by a period.
+    
+    The years are taken in partitions (and shards) of the given number of years. The
+    queries for the years of a partition run at the same time (see fan_out).
+    """
+    blocks = [str(y) + "-" + str(min(y + years - 1, last)) for y in range(first, last + 1, years)]
+    for block in self._shards(sweep, blocks):
+      start, end = [int(y) for y in block.split("-")]
       # Get keys of all authors with death date <x>
-      authors = self.query({"type": "/type/author", "death_date": str(year)+".", "limit": False})
-      print_log("Getting authors with death date '" + str(year) + "'...")
-      list = []
-      for author in authors:
-        # Feed authors to buffer list
-        list.append(author)
-        if len(list) > 99:
-          # Process these few authors before continuing feeding
-          # Get records
-          print_log("Getting full records")
-          
-          records = self.ol.get_many(list)
-          for obj in records.itervalues():
-            self.clean_author2(obj)
-          list = []
-          
-      if len(list) > 0:
-        records = self.ol.get_many(list)
-        for obj in records.itervalues():
-          self.clean_author2(obj)
-      self.flush_all()
-      done = codecs.EncodedFile(open("cleanauthors-done.txt", "ab"), "unicode_internal", "utf-8", "replace")
-      done.write(unicode("Death date '" + str(year) + ".' updated to '" + str(year) + "'\n"))
-      done.close()
-      sleep(0.5)
+      queries = [{"type": "/type/author", "death_date": str(year)+".", "limit": False} for year in range(start, end + 1)]
+      print_log("Getting authors with death dates '" + str(start) + ".' to '" + str(end) + ".'...")
+      if self._partition(sweep, "years " + block, lambda: self.fan_out(queries), process, resume):
+        for year in range(start, end + 1):
+          self.log.write(self.logfile("cleanauthors-done.txt"), "Death date '" + str(year) + ".' updated to '" + str(year) + "'\n")
   
   def clean_author(self, obj):
     """Clean author records. For example removes the period after the death date.
@@ -262,12 +2651,15 @@ class VacuumBot:
                 if auID in aucache.keys():
                   # already looked up and stored in cache
                   newau.append(aucache[auID])
-                  print "new ID found in cache"
+                  self.metrics.inc("vacuumbot_cache_total", cache="aucache", result="hit")
                 else:
                   # lookup author's new ID
                   newID = self.find_new_author(auID)
                   aucache[auID] = newID
                   newau.append(newID)
+              if [unicode(a) for a in newau] == [author_key(a) for a in obj["authors"]]:
+                print "No new author found for", olid
+                continue
               obj["authors"] = newau
               self.ol_save(olid, obj, "Updated author in Edition (author was merged but not updated here)")
         except:
@@ -275,34 +2667,51 @@ class VacuumBot:
   
   
   def find_new_author(self, olid):
-    obj = self.ol_get(olid)
-    print "downloaded", olid
-    if obj["type"] == "/type/author":
-      return obj["key"]
-    elif obj["type"] == "/type/redirect":
-      return self.find_new_author(obj["location"])
-    elif obj["type"] == "/type/delete":
-      # author was deleted, undelete
-      obj["type"] = "/type/author"
-      self.ol_save(obj["key"], obj, "Undeleted record, because other records still referred to it")
-      return obj["key"]
+    """Returns a reference to the author olid redirects to, or olid if that is not known."""
+    return olapi.Reference(self.resolve_authors([olid]).get(olid, olid))
+  
+  def resolve_authors(self, keys):
+    """Returns a dict with the key of the author each of keys (finally) redirects to.
+    
+    Looks in self.aucache first, then in the redirect store, and only goes to OL for
+    authors it has never seen: with one get_many per redirect hop for all of them.
+    Deleted authors are undeleted, because other records still refer to them.
+    """
+    found = {}
+    unknown = []
+    for key in keys:
+      if key in self.aucache:
+        found[key] = self.aucache[key]
+        self.metrics.inc("vacuumbot_cache_total", cache="aucache", result="hit")
+      else:
+        unknown.append(key)
+        self.metrics.inc("vacuumbot_cache_total", cache="aucache", result="miss")
+    if len(unknown) > 0:
+      fetch = lambda chunk: self._ol_call("read", "get_many", chunk)
+      resolved = self.redirects.resolve_many(unknown, fetch, self._undelete_author)
+      self.aucache.update(resolved)
+      found.update(resolved)
+    return found
+  
+  def _undelete_author(self, obj):
+    obj = olapi.unmarshal(obj)
+    obj["type"] = olapi.Reference("/type/author")
+    self.ol_save(obj["key"], obj, "Undeleted record, because other records still referred to it")
+    return obj["key"]
 
   def clean_physical_object(self, obj):
-    """Cleans up physical aspects of the given Edition object, such as format and pagination. Returns the cleaned obj.
+    """Cleans up physical aspects of the given Edition object, such as format and pagination.
     
     Physical format: calls self.clean_format(obj).
     Pagination: calls self.clean_pagination(obj).
-    """
-    obj1 = self.clean_format(obj)
-    if obj1 != None:
-      obj2 = self.clean_pagination(obj1)
-    else:
-      obj2 = self.clean_pagination(obj)
     
-    if obj2 != None:
-      return obj2
-    else:
+    Returns the cleaned obj, or None if nothing changed.
+    """
+    formatted = self.clean_format(obj) != None
+    paginated = self.clean_pagination(obj)[1] != None
+    if formatted or paginated:
       return obj
+    return None
   
   def clean_format(self, obj):
     """Cleans up the obj's physical_format field, removing it from obj if necessary.
@@ -319,227 +2728,127 @@ class VacuumBot:
       else:
         # Check if there is a better format
         v = self._check_format(obj["physical_format"])
-        if v != "":
+        if v is False:
+          return None
+        elif v != "":
           # Use new value
           obj["physical_format"] = v
           return obj
-        elif v == "":
+        else:
           # New value would leave empty field -> remove field
           del obj["physical_format"]
           return obj
-        else:
-          return None
         
     else:
       return None
   
   def _check_format(self, format):
-    # if format matches punctuation regular expression, create normalized format string before lookup
-    checkstr = re.sub(r"", "", format)
-    # and look up replacement format in dictionary
-    if checkstr in self.formatdict.keys() and self.formatdict[checkstr] != format:
-      return self.formatdict[checkstr]
+    # look up the replacement format in the normalisation index
+    new = self.formatindex.lookup(format)
+    if new == None and self.formatcache != None:
+      new = self.formatcache.lookup(format)
+    if new != None and new != format:
+      return new
     else:
       # if there is no new value or new is same as original, don't update.
       return False
   
-  def replace_formats(self, old, new):
+  def replace_formats(self, old, new, resume=False):
     """Replaces the old value in physical format fields by the new value.
     
     This method tries to process all records with old as format value, which are potentially millions of records.
+    old may also be a list of formats.
+    With resume, records that were saved by an earlier run are skipped.
     """
-    print_log("Getting records with format '"+old+"'...")
-    olids = self.ol.query({"type":"/type/edition", "physical_format": old, "limit": False})
-    for r in olids:
-      print "Improving", r
-      self.replace_format(r, old, new)
-      sleep(4)
+    sweep = "replace_formats " + format_name(old) + " -> " + new
+    self._start_sweep(sweep, resume)
+    print_log("Getting records with format '"+format_name(old)+"'...")
+    
+    def process(olids):
+      for r in olids:
+        print "Improving", r
+        self.replace_format(r, old, new)
+    
+    self._format_partitions(sweep, old, process, resume)
   
-  def replace_formats_clean_pagination(self, old, new):
+  def replace_formats_clean_pagination(self, old, new, resume=False):
     """Replaces the old value in physical format fields by the new value.
     
     This method tries to process all records with old as format value, which are potentially millions of records.
+    old may also be a list of formats.
+    With resume, records that were saved by an earlier run are skipped.
     """
-    print_log("Getting records with format '"+old+"'...")
-    olids = self.ol.query({"type":"/type/edition", "physical_format": old, "limit": False})
-    for olid in olids:
-      gotit = False
-      tries = 0
-      while (not gotit and tries <= 5):
+    sweep = "replace_formats_clean_pagination " + format_name(old) + " -> " + new
+    self._start_sweep(sweep, resume)
+    print_log("Getting records with format '"+format_name(old)+"'...")
+    
+    def process(olids):
+      for olid in olids:
+        # ol_get already retries while OL is busy
         obj = self.ol_get(olid)
-        if obj:
-          gotit = True
+        if not obj:
+          raise Exception("timeout")
+        
+        print "Improving", olid
+        comment = self.clean_record(obj, [("replace_format2", [old, new]), ("clean_pagination", [])])
+        
+        # Something changed if there is a comment
+        if comment != None:
+          self.ol_save(obj["key"], obj, comment)
+          print_log(comment)
         else:
-          sleep(10)
-          tries = tries + 1
-      
-      if not gotit:
-        raise Exception("timeout")
-      
-      comment = []
-      print "Improving", olid
-      # Step 1: replace format
-      result1 = self.replace_format2(obj, old, new)
-      if result1:
-        comment.append("Updated format '"+old+"' to '"+new+"'")
-      else:
-        result1 = obj
-      
-      # Step 2: Use Step 1 output
-      result2 = self.clean_pagination(result1)
-      if result2:
-        comment.append("cleaned up pagination")
-      else:
-        result2 = result1
-      
-      # Something changed if comment is not empty
-      if len(comment) != 0:
-        self.ol_save(obj["key"], result2, "; ".join(comment))
-        print_log("; ".join(comment))
-      else:
-        print_log("Did nothing, really.")
-      sleep(3)
+          print_log("Did nothing, really.")
+    
+    self._format_partitions(sweep, old, process, resume)
 
-  def replace_split_formats_clean_pagination(self, old, new, by, sub, ot):
+  def replace_split_formats_clean_pagination(self, old, new, by, sub, ot, resume=False, fetchers=1, cleaners=1, writers=1, depth=2):
     """Replaces the old value in physical format fields by the new value and puts the by statement in the correct place.
     
-    This method tries to process 1000 records with old as format value, which are potentially millions of records.
-    """
-    print_log("Getting records with format '"+old+"'...")
-    olids = self.ol.query({"type":"/type/edition", "physical_format": old, "limit": 1000})
-    list = []
-    for olid in olids:
-      # Feed authors to buffer list
-      list.append(olid)
-      if len(list) > 99:
-        # Process these few authors before continuing feeding
-        # Get records
-        print_log("Getting full records")
-        records = self.ol.get_many(list)
-        for obj in records.itervalues():
-          obj = unmarshal(obj)
-          self._replace_split_formats_clean_pagination(obj, old, new, by, sub, ot)
-        list = []
-        
-    if len(list) > 0:
-      records = self.ol.get_many(list)
-      for obj in records.itervalues():
-        obj = unmarshal(obj)
-        self._replace_split_formats_clean_pagination(obj, old, new, by, sub, ot)
-    self.flush_all()
-
+    This method tries to process all records with old as format value, which are potentially millions of records.
+    old may also be a list of formats.
+    With resume, records that were saved by an earlier run are skipped.
+    """
+    sweep = "replace_split_formats_clean_pagination " + format_name(old) + " -> " + new
+    self._start_sweep(sweep, resume)
+    print_log("Getting records with format '"+format_name(old)+"'...")
+    clean = lambda obj: self._replace_split_formats_clean_pagination(obj, old, new, by, sub, ot)
+    process = lambda olids: self._sweep(olids, clean, prefetch=True, fetchers=fetchers, cleaners=cleaners, writers=writers, depth=depth)
+    self._format_partitions(sweep, old, process, resume)
     
-  def replace_formats_clean_pagination2(self, old, new):
+  def replace_formats_clean_pagination2(self, old, new, resume=False, fetchers=1, cleaners=1, writers=1, depth=2):
     """Replaces the old value in physical format fields by the new value.
     
     This method tries to process all records with old as format value, which are potentially millions of records.
+    old may also be a list of formats.
+    Fetching, cleaning and saving overlap; the number of worker threads per stage and the
+    number of batches waiting between stages can be set with the keyword arguments.
+    With resume, records that were saved by an earlier run are skipped.
     """
-    print_log("Getting records with format '"+old+"'...")
-    olids = self.ol.query({"type":"/type/edition", "physical_format": old, "limit": 1000})
-    list = []
-    for olid in olids:
-      # Feed authors to buffer list
-      list.append(olid)
-      if len(list) > 99:
-        # Process these few authors before continuing feeding
-        # Get records
-        print_log("Getting full records")
-        records = self.ol.get_many(list)
-        for obj in records.itervalues():
-          obj = unmarshal(obj)
-          self._replace_formats_clean_pagination(obj, old, new)
-        list = []
-        
-    if len(list) > 0:
-      records = self.ol.get_many(list)
-      for obj in records.itervalues():
-        obj = unmarshal(obj)
-        self._replace_formats_clean_pagination(obj, old, new)
-    self.flush_all()
-    
+    sweep = "replace_formats_clean_pagination2 " + format_name(old) + " -> " + new
+    self._start_sweep(sweep, resume)
+    print_log("Getting records with format '"+format_name(old)+"'...")
+    clean = lambda obj: self._replace_formats_clean_pagination(obj, old, new)
+    process = lambda olids: self._sweep(olids, clean, prefetch=True, fetchers=fetchers, cleaners=cleaners, writers=writers, depth=depth)
+    self._format_partitions(sweep, old, process, resume)
   
   def _replace_formats_clean_pagination(self, obj, old, new):
-    comment = []
-    # Step 1: replace format
-    result1 = self.replace_format2(obj, old, new)
-    if result1[1]:
-      comment.append(result1[1])
-
-    # Step 2: Use Step 1 output
-    result2 = self.clean_pagination(result1[0])
-    if result2[1]:
-      comment.append(result2[1])
-    
-    # Step 3: use Step 2 output
-    result3 = self._update_author_in_edition(result2[0])
-    if result3[1]:
-      comment.append(result3[1])
-
-    # Something changed if comment is not empty
-    if len(comment) != 0:
-      self.ol_save2(obj["key"], result3[0], "; ".join(comment))
-
-  def _replace_split_formats_clean_pagination(self, obj, old, new, by):
-    comment = []
-    # Step 1: replace format
-    result1 = self.replace_format2(obj, old, new)
-    if result1[1]:
-      comment.append(result1[1])
-    
-    # Step 1a: add the By statement
-    result1a = self.add_by(result1[0], by)
-    if result1a[1]:
-      comment.append(result1a[1])
-    
-    # Step 2: Use Step 1a output
-    result2 = self.clean_pagination(result1a[0])
-    if result2[1]:
-      comment.append(result2[1])
-    
-    # Step 3: use Step 2 output
-    result3 = self._update_author_in_edition(result2[0])
-    if result3[1]:
-      comment.append(result3[1])
-
-    # Something changed if comment is not empty
-    if len(comment) != 0:
-      self.ol_save2(obj["key"], result3[0], "; ".join(comment))
-      
-  def _replace_split_formats_clean_pagination(self, obj, old, new, by, sub, ot):
-    comment = []
-    # Step 1: replace format
-    result1 = self.replace_format2(obj, old, new)
-    if result1[1]:
-      comment.append(result1[1])
-    
-    # Step 1a: add the By statement
-    result1a = self.add_by(result1[0], by)
-    if result1a[1]:
-      comment.append(result1a[1])
-      
-    # Step 1b: add the subtitle
-    result1b = self.add_subtitle(result1a[0], sub)
-    if result1b[1]:
-      comment.append(result1b[1])
-      
-    # Step 1c: add the other_titles
-    result1c = self.add_subtitle(result1b[0], ot)
-    if result1c[1]:
-      comment.append(result1c[1])
-    
-    # Step 2: Use Step 1b output
-    result2 = self.clean_pagination(result1b[0])
-    if result2[1]:
-      comment.append(result2[1])
-    
-    # Step 3: use Step 2 output
-    result3 = self._update_author_in_edition(result2[0])
-    if result3[1]:
-      comment.append(result3[1])
+    comment = self.clean_record(obj, [("replace_format2", [old, new]),
+                                      ("clean_pagination", []),
+                                      ("_update_author_in_edition", [])])
+    # Something changed if there is a comment
+    if comment != None:
+      self.ol_save2(obj["key"], obj, comment)
 
-    # Something changed if comment is not empty
-    if len(comment) != 0:
-      self.ol_save2(obj["key"], result3[0], "; ".join(comment))
+  def _replace_split_formats_clean_pagination(self, obj, old, new, by, sub, ot):
+    comment = self.clean_record(obj, [("replace_format2", [old, new]),
+                                      ("add_by", [by]),
+                                      ("add_subtitle", [sub]),
+                                      ("add_other_title", [ot]),
+                                      ("clean_pagination", []),
+                                      ("_update_author_in_edition", [])])
+    # Something changed if there is a comment
+    if comment != None:
+      self.ol_save2(obj["key"], obj, comment)
 
   def add_by(self, obj, by):
     if by != "":
@@ -549,18 +2858,18 @@ class VacuumBot:
           return (obj, "updated By statement")
         elif "notes" in obj.keys(): # and "value" in obj["notes"].keys()
           print self.enc(obj["notes"])
-          if isinstance(obj["notes"], Text):
+          if isinstance(obj["notes"], olapi.Text):
             obj["notes"] = obj["notes"] + "\n\nBy statement found in format: " + by + "\n"
             return (obj, "added By statement to notes, because By statement field was not empty")
           elif isinstance(obj["notes"], dict):
-            d = unmarshal(obj["notes"])
+            d = olapi.unmarshal(obj["notes"])
             obj["notes"] = d + "\n\nBy statement found in format: " + by + "\n"
             return (obj, "added By statement to notes, because By statement field was not empty")
           else:
-            obj["notes"] = Text("By statement found in format: " + by + "\n")
+            obj["notes"] = olapi.Text("By statement found in format: " + by + "\n")
             return (obj, "put By statement in notes")
         else:
-          obj["notes"] = Text("By statement found in format: " + by + "\n")
+          obj["notes"] = olapi.Text("By statement found in format: " + by + "\n")
           return (obj, "put By statement in notes")
       else:
         obj["by_statement"] = by
@@ -593,7 +2902,7 @@ class VacuumBot:
         if isinstance(obj["other_titles"], list):
           obj["other_titles"].append(ot)
           return (obj, "added title to other_titles")
-        elif isinstance(obj["other_titles"], string) or isinstance(obj["other_titles"], unicode):
+        elif isinstance(obj["other_titles"], basestring):
           obj["other_titles"] = [obj["other_titles"], ot]
           return (obj, "changed other_titles from string to list of strings")
         else:
@@ -615,12 +2924,12 @@ class VacuumBot:
         #print obj["works"][0]
         wID = obj["works"][0]
         if wID in self.wocache.keys():
-          print "Work ID found in cache", wID
+          self.metrics.inc("vacuumbot_cache_total", cache="wocache", result="hit")
           workhasauthors = self.wocache[wID]
         else:
           # Get work, see if it has at least one author
+          self.metrics.inc("vacuumbot_cache_total", cache="wocache", result="miss")
           work = self.ol_get(wID)
-          print "Work found and downloaded", wID
           self.wocache[wID] = "authors" in work.keys() and len(work["authors"]) > 0
           workhasauthors = self.wocache[wID]
         
@@ -639,21 +2948,13 @@ class VacuumBot:
       #print sys.exc_info()
   
   def _replace_authors(self, obj):
-    newau = []
-    for auID in obj["authors"]:
-      if auID in self.aucache.keys():
-        # already looked up and stored in cache
-        newau.append(Reference(self.aucache[auID]))
-        print "new ID found in cache"
-      else:
-        # lookup author's new ID
-        newID = self.find_new_author(auID)
-        self.aucache[auID] = newID
-        newau.append(Reference(newID))
-      
-    print obj["authors"]
-    print newau
-    if obj["authors"] != newau:
+    oldIDs = [author_key(a) for a in obj["authors"]]
+    newIDs = self.resolve_authors(oldIDs)
+    # Keep references that could not be resolved
+    newau = [olapi.Reference(newIDs.get(auID, auID)) for auID in oldIDs]
+    
+    # Compare keys, not how the references happen to be represented
+    if oldIDs != [unicode(a) for a in newau]:
       obj["authors"] = newau
       comment = "replaced author(s) in Edition (reference was outdated)"
       return (obj, comment)
@@ -665,26 +2966,29 @@ class VacuumBot:
     
     """
     try:
-      obj = self.ol.get(olid)
-    except OLError as e:
+      obj = self._ol_call("read", "get", olid)
+    except olapi.OLError as e:
       self.save_error(olid, str(e))
       return
     
-    if "physical_format" in obj.keys() and obj["physical_format"] == old:
+    if "physical_format" in obj.keys() and obj["physical_format"] in format_values(old):
+        comment = "Updated format '"+obj["physical_format"]+"' to '"+new+"'"
         obj["physical_format"] = new
         print_log("updating format for "+olid)
-        self.ol_save(obj["key"], obj, "Updated format '"+old+"' to '"+new+"'")
+        self.ol_save(obj["key"], obj, comment)
   
   def replace_format2(self, obj, old, new):
     """Replaces a value from the physical format field.
     
+    old is one value or a tuple of values.
     Returns a tuple (obj, comment). comment is None if nothing changed. obj is updated or unchanged input obj.
     """
     
-    if "physical_format" in obj.keys() and obj["physical_format"] == old:
+    if "physical_format" in obj.keys() and obj["physical_format"] in format_values(old):
+      comment = "Updated format '"+obj["physical_format"]+"' to '"+new+"'"
       obj["physical_format"] = new
       print_log("updating format for "+obj["key"])
-      return (obj, "Updated format '"+old+"' to '"+new+"'")
+      return (obj, comment)
     elif "physical_format" in obj.keys() and obj["physical_format"] == "":
       del obj["physical_format"]
       return (obj, "Deleted empty physical format field")
@@ -726,34 +3030,51 @@ class VacuumBot:
     If the classifications object in the record is empty (because
     removing the deleted list was the only one in it), it is removed 
     as well.
+    
+    Returns a tuple (obj, comment). comment is None if nothing changed.
     """
+    changed = False
     special = ["lc_classifications", "dewey_decimal_class"]
     if type in special and type in obj.keys():
       while value in obj[type]:
         obj[type].remove(value)
+        changed = True
       if len(obj[type]) == 0:
         del obj[type]
+        changed = True
     elif "classifications" in obj.keys() and type in obj["classifications"].keys():
       while value in obj["classifications"][type]:
         obj["classifications"][type].remove(value)
+        changed = True
       if len(obj["classifications"][type]) == 0:
         del obj["classifications"][type]
+        changed = True
         if len(obj["classifications"]) == 0:
           del obj["classifications"]
+    if changed:
+      return (obj, "removed '" + value + "' from " + type)
+    return (obj, None)
    
-  def deduplicate_list(self, li):
-    """Sorts a list and removes duplicate values in place."""
-    
-    a = len(li)
-    c = 0
-    li.sort()
-    while c < a-1:
-      if li[c] == li[c+1]:
-        li.pop(c+1)
-        a = a-1
-      else:
-        c = c+1
+  def deduplicate_list(self, li, normalize=None):
+    """Removes duplicate values from a list in place, keeping the first of each where it was.
     
+    With normalize, values are the same if normalize gives the same result for them (or
+    None for both, then they are left alone).
+    """
+    seen = set()
+    unique = []
+    for value in li:
+      k = normalize(value) if normalize != None else value
+      if k == None and normalize != None:
+        unique.append(value)
+        continue
+      if isinstance(k, (dict, list)):
+        k = simplejson.dumps(olapi.marshal(k), sort_keys=True)
+      if k not in seen:
+        seen.add(k)
+        unique.append(value)
+    li[:] = unique
+  
   def dedup(self, obj):
     """Removes duplicate values from an object.
     
@@ -761,13 +3082,13 @@ class VacuumBot:
     Calls itself on compound objects.
     Does nothing with strings or other types.
     """
-    if isinstance(obj, str):
+    if isinstance(obj, basestring):
       return
     elif isinstance(obj, dict):
       for k in obj:
-        dedup(obj[k])
+        self.dedup(obj[k])
     elif isinstance(obj, list):
-      deduplicate_list(obj) 
+      self.deduplicate_list(obj)
     else:
       return
 
@@ -776,11 +3097,18 @@ class VacuumBot:
     
     Use with caution :)
     """
-    object = ol.get(olid)
-    if key in object:
-      del object[key]
-      self.ol_save(object['key'], object, "Sucked up \"" + key + "\".")
-    
+    object = self.ol_get(olid)
+    if object != None:
+      result = self._remove_key(object, key)
+      if result[1]:
+        self.ol_save(object["key"], result[0], result[1])
+  
+  def _remove_key(self, obj, key):
+    """Removes a key from obj. Returns a tuple (obj, comment), comment is None if obj had no such key."""
+    if key in obj:
+      del obj[key]
+      return (obj, "Sucked up \"" + key + "\".")
+    return (obj, None)
 
   def deduplicate_values(self, olid, key):
     """Removes duplicate values
@@ -788,10 +3116,64 @@ class VacuumBot:
     Reads the values of a key and removes duplicate values,
     leaving 1.
     """
-    object = ol.get(olid)
-    if key in object:
-      dedup(object[key])
+    object = self.ol_get(olid)
+    if object != None:
+      result = self._deduplicate_values(object, key)
+      if result[1]:
+        self.ol_save(object["key"], result[0], result[1])
+  
+  def _deduplicate_values(self, obj, key):
+    """Removes duplicate values from the key of obj. Returns a tuple (obj, comment), comment is None if nothing changed."""
+    if key in obj:
+      before = olapi.marshal(obj[key])
+      self.dedup(obj[key])
+      if olapi.marshal(obj[key]) != before:
+        return (obj, "Removed duplicate values from \"" + key + "\"")
+    return (obj, None)
 
+  def clean_identifiers(self, obj):
+    """Moves ISBNs to the field for their length and removes duplicate identifiers.
+    
+    Identifiers are duplicates if they are the same when normalised, like "0-19-852663-6"
+    and "0198526636"; the first one is kept as it is.
+    Returns a tuple (obj, comment). comment is None if nothing changed.
+    """
+    before = dict((field, olapi.marshal(obj[field])) for field in ["isbn_10", "isbn_13", "lccn", "oclc_numbers"] if field in obj)
+    for field, other, length in [("isbn_10", "isbn_13", 13), ("isbn_13", "isbn_10", 10)]:
+      if field in obj:
+        wrong = [v for v in obj[field] if isinstance(v, basestring) and len(re.sub(r"[^0-9Xx]", "", v)) == length]
+        if len(wrong) > 0:
+          obj[field] = [v for v in obj[field] if v not in wrong]
+          obj[other] = (obj[other] if other in obj else []) + wrong
+    for scheme, fields, normalize in IDENTIFIERS:
+      for field in fields:
+        if field in obj and isinstance(obj[field], list):
+          self.deduplicate_list(obj[field], lambda v: normalize(v) if isinstance(v, basestring) else None)
+    for field in ["isbn_10", "isbn_13"]:
+      if field in obj and len(obj[field]) == 0:
+        del obj[field]
+    after = dict((field, olapi.marshal(obj[field])) for field in ["isbn_10", "isbn_13", "lccn", "oclc_numbers"] if field in obj)
+    if after != before:
+      return (obj, "cleaned up identifiers")
+    return (obj, None)
+  
+  def clean_identifier_fields(self, keys, resume=False, fetchers=1, cleaners=1, writers=1, depth=2):
+    """Cleans up the identifiers of the editions with the given keys, in batches.
+    
+    keys can come from an IdentifierIndex, for example all editions that share an ISBN:
+      [key for scheme, value, keys in index.duplicates("isbn") for key in keys]
+    """
+    sweep = "clean_identifier_fields"
+    self._start_sweep(sweep, resume)
+    
+    def clean(obj):
+      comment = self.clean_record(obj, [("clean_identifiers", [])])
+      if comment != None:
+        self.ol_save2(obj["key"], obj, comment)
+    
+    process = lambda keys: self._sweep(keys, clean, fetchers=fetchers, cleaners=cleaners, writers=writers, depth=depth)
+    self._partition(sweep, "keys", lambda: iter(keys), process, resume)
+  
   def remove_classification(self, obj, classification):
     if "classifications" in obj:
       if classification in obj["classifications"]:
@@ -803,47 +3185,401 @@ class VacuumBot:
     Removes permalink from classifications and adds the LCCN to
     the identifiers, if is isn't there already.
     """
-    object = ol.get(olid)
-    if "classifications" in object.keys():
-      if "lccn_permalink" in object["classifications"].keys():
-        lccnst = []
-        for a in object["classifications"]["lccn_permalink"]:
-          b = a.rsplit("/",1)
-          lccnst.append(b[len(b)])
-        if "lccn" not in object.keys():
-          object["lccn"] = []
-        for l in lccnst:
-          if l not in object["lccn"]:
-            object["lccn"].append(l)
-        remove_classification(object, "lccn_permalink")
-    
-
-  def vacuum(self, filename):
+    object = self.ol_get(olid)
+    if object != None:
+      result = self._clean_lccn_permalink(object)
+      if result[1]:
+        self.ol_save(object["key"], result[0], result[1])
+  
+  def _clean_lccn_permalink(self, obj):
+    """Moves the LCCNs from lccn_permalink classifications to the lccn field.
+    
+    Returns a tuple (obj, comment). comment is None if nothing changed.
+    """
+    if "classifications" in obj.keys() and "lccn_permalink" in obj["classifications"].keys():
+      lccnst = []
+      for a in obj["classifications"]["lccn_permalink"]:
+        lccnst.append(a.rstrip("/").rsplit("/", 1)[-1])
+      if "lccn" not in obj.keys():
+        obj["lccn"] = []
+      for l in lccnst:
+        if l not in obj["lccn"]:
+          obj["lccn"].append(l)
+      self.remove_classification(obj, "lccn_permalink")
+      if len(obj["classifications"]) == 0:
+        del obj["classifications"]
+      return (obj, "moved LCCN permalink to LCCN")
+    return (obj, None)
+    
+
+  def vacuum(self, filename, sort=False, chunksize=1000000, fetchers=1, cleaners=1, writers=1, depth=2):
     """Main execution
     
     Vacuums the Open Library based on commands found in the file.
     
     Commands understood by VacuumBot are:
-    * remove_key
-    
-    Command files are structured as follows: [todo]
+    * remove_key <field>
+    * deduplicate_values <field>
+    * clean_lccn_permalink
+    * every rule that can be used in a Task, like replace_format2 <old> <new> or clean_pagination
     
+    Command files have one command per line: the key of a record, the command and its
+    arguments, tab-separated. Lines starting with # are skipped. All commands for the same
+    record are run together, so the record is fetched once (with get_many, 100 at a time)
+    and saved once (through the save buffer). Commands for a record are grouped when they
+    are on consecutive lines; with sort, the file is sorted by key first, in chunks of
+    chunksize lines on disk, so that a file of any size is read in constant memory.
+    Files are gzipped if their names end in '.gz'.
     """
+    groups = self._command_groups(self._sorted_commands(filename, chunksize) if sort else self._commands(filename))
+    
+    def fetch(batch):
+      records = self.get_many([key for key, steps in batch])
+      for key, steps in batch:
+        if key not in records:
+          self.save_error(key, "Record not found, skipped its commands")
+      return [(LazyRecord(records[key]), steps) for key, steps in batch if key in records]
+    
+    def run(batch):
+      for obj, steps in batch:
+        self._snapshot(obj["key"], obj.raw)
+        self.context.clean = (lambda o, steps=steps: self._run_commands(o, steps), False)
+        self._run_commands(obj, steps)
+    
+    self.savebuffer.start(writers)
+    try:
+      Pipeline(chunks(groups, 100), [(fetch, fetchers), (run, cleaners)], depth).run()
+    finally:
+      self.flush_all()
+  
+  def _run_commands(self, obj, steps):
+    comment = self.clean_record(obj, steps)
+    if comment != None:
+      self.ol_save2(obj["key"], obj, comment)
+  
+  def _commands(self, filename):
+    """Yields the (key, method, args) of the valid commands in a command file, in order."""
     n = 0
-    for line in open(filename):
-      olid, isbn, goodreads_id = line.strip().split()
-      n = n+1
+    for line in open_file(filename):
+      n = n + 1
       if (n % 100000) == 0:
         print_log("(just read line " + str(n) + " from the command file)")
-      is_good = False
-      while (not is_good):
-        try:
-          map_id(olid, isbn, goodreads_id)
-          is_good = True
-        except:
-          print_log("Exception for Goodreads ID \"" + goodreads_id + "\", message: \"" + str(sys.exc_info()[1]) + "\"")
-          sleep(10)
+      fields = line.rstrip("\r\n").decode("utf-8").split("\t")
+      if len(fields) < 2 or fields[0].startswith("#"):
+        continue
+      method = COMMANDS.get(fields[1], fields[1])
+      if method not in RULES:
+        self.save_error(fields[0], "Unknown command on line " + str(n) + ": " + fields[1])
+        continue
+      yield (fields[0], method, fields[2:])
+  
+  def _sorted_commands(self, filename, chunksize):
+    """Yields the commands of a command file ordered by key, and by line within a key.
+    
+    Chunks of the file are sorted in memory and written to temporary files, which are
+    then merged. Set TMPDIR to put the temporary files somewhere with enough room.
+    """
+    runs = []
+    try:
+      for i, chunk in enumerate(chunks(self._commands(filename), chunksize)):
+        fd, run = tempfile.mkstemp(prefix="vacuumbot-sort-", suffix=".gz")
+        os.close(fd)
+        runs.append(run)
+        with gzip.open(run, "wb") as f:
+          # The line number keeps the commands for a key in the order of the file
+          for key, n, method, args in sorted((key, n, method, args) for n, (key, method, args) in enumerate(chunk, i * chunksize)):
+            f.write(simplejson.dumps([key, n, method, args]) + "\n")
+      for key, n, method, args in heapq.merge(*[(simplejson.loads(line) for line in gzip.open(run)) for run in runs]):
+        yield (key, method, args)
+    finally:
+      for run in runs:
+        os.remove(run)
+  
+  def _command_groups(self, commands):
+    """Groups consecutive commands for the same key. Yields (key, steps) tuples."""
+    for key, group in itertools.groupby(commands, lambda c: c[0]):
+      yield (key, [(method, args) for k, method, args in group])
+
+class DumpCleaner(VacuumBot):
+  """A VacuumBot that only cleans records, for the worker processes of process_dump.
+  
+  It opens no databases or log files, starts no threads and leaves the signal handlers
+  alone. It never calls OL, so steps that fetch records (like _update_author_in_edition
+  for an edition whose Work is unknown) fail.
+  """
+  def __init__(self, formatdict=None, formatdistance=0):
+    self.metrics = Metrics()
+    self.pagreg = re.compile(r"[^\s]\s+[:;]$")
+    self.emptypagreg = re.compile(r"[,.:;]+$")
+    self.formatdict = simplejson.load(codecs.open(formatdict or FORMATDICT, "rb", "utf-8"))
+    self.formatindex = FormatIndex(self.formatdict, formatdistance)
+    self.formatcache = None
+    self.enc2 = codecs.getencoder("ascii")
+    self.tasks = {}
+    self.aucache = {}
+    self.wocache = {}
+    self.cache = None
+  
+  def _ol_call(self, kind, method, *args):
+    raise RuntimeError("Dump workers don't call OL, but a step needed " + method)
+
+def _init_dump_worker(steps, formatdict, formatdistance):
+  global _dumpbot, _dumpsteps
+  _dumpbot = DumpCleaner(formatdict, formatdistance)
+  _dumpsteps = steps
+
+def _clean_dump_chunk(lines):
+  """Cleans a chunk of dump lines in a worker process.
+  
+  Returns a tuple of the number of records and the output lines for changed records.
+  """
+  changed = []
+  for line in lines:
+    fields = line.rstrip("\n").split("\t", 4)
+    if len(fields) < 5:
+      continue
+    obj = LazyRecord(simplejson.loads(fields[4]))
+    comment = _dumpbot.clean_record(obj, _dumpsteps)
+    if comment != None:
+      changed.append(fields[1] + "\t" + comment.encode("utf-8") + "\t" + simplejson.dumps(obj.marshal()) + "\n")
+  return (len(lines), changed)
+
+def process_dump(dumpfile, outfile, steps, types=None, processes=None, chunksize=5000, formatdict=None, formatdistance=0):
+  """Runs cleaners over an Open Library dump on all cores and writes the changed records.
+  
+  The dump has one record per line, as type, key, revision, last_modified and JSON,
+  tab-separated. Lines are handed out in chunks of chunksize to a pool of processes,
+  which clean each record of the given types (all types if None) with
+  VacuumBot.clean_record(obj, steps), on a DumpCleaner that finds formats with
+  formatdict and formatdistance like a VacuumBot. Changed records are written to
+  outfile as key, comment and JSON, tab-separated, ready for VacuumBot.save_dump_changes.
+  Both files are gzipped if their names end in '.gz'.
+  """
+  processes = processes or multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(processes, _init_dump_worker, (steps, formatdict, formatdistance))
+  pending = collections.deque()
+  out = open_file(outfile, "wb")
+  total = [0, 0]
+  
+  def collect():
+    n, changed = pending.popleft().get()
+    total[0] = total[0] + n
+    total[1] = total[1] + len(changed)
+    out.writelines(changed)
+  
+  def lines():
+    for line in open_file(dumpfile):
+      if types == None or line[:line.find("\t")] in types:
+        yield line
+  
+  start = time()
+  try:
+    for chunk in chunks(lines(), chunksize):
+      # Keep only a few chunks per process in flight, to bound memory
+      if len(pending) >= 2 * processes:
+        collect()
+      pending.append(pool.apply_async(_clean_dump_chunk, (chunk,)))
+    while len(pending) > 0:
+      collect()
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    out.close()
+  elapsed = time() - start
+  print_log("Cleaned " + str(total[0]) + " records in " + str(round(elapsed, 1)) + " s (" +
+            str(int(total[0] / max(elapsed, 0.001))) + " records/s), " + str(total[1]) + " changed")
+  return total
+
+def index_dump(dumpfile, index, batchsize=10000):
+  """Adds all editions in an Open Library dump to an IdentifierIndex. Returns their number."""
+  n = 0
+  for batch in chunks((line for line in open_file(dumpfile) if line.startswith("/type/edition\t")), batchsize):
+    index.add_many([simplejson.loads(line.rstrip("\n").split("\t", 4)[-1]) for line in batch])
+    n = n + len(batch)
+    print_log("Indexed identifiers of " + str(n) + " editions")
+  return n
+
+def write_duplicates(index, outfile, scheme=None):
+  """Writes every identifier that more than one edition has, with the keys of those editions.
+  
+  The output has scheme, value and the keys separated by spaces, tab-separated, for
+  review or for a merge tool. Returns the number of identifiers written.
+  """
+  n = 0
+  with open_file(outfile, "wb") as out:
+    for scheme, value, keys in index.duplicates(scheme):
+      out.write((scheme + "\t" + value + "\t" + " ".join(keys) + "\n").encode("utf-8"))
+      n = n + 1
+  return n
+
+def classify_dump_formats(dumpfile, outfile, index):
+  """Writes every distinct physical_format value in a dump with its count and replacement.
+  
+  The output has value, count and the normalised format from index (a FormatIndex, empty
+  if there is none), tab-separated, most common values first.
+  """
+  counts = collections.Counter()
+  for line in open_file(dumpfile):
+    if '"physical_format"' in line:
+      value = simplejson.loads(line.rstrip("\n").split("\t", 4)[-1]).get("physical_format")
+      if isinstance(value, basestring):
+        counts[value] = counts[value] + 1
+  replacements = index.classify(counts.keys())
+  with open_file(outfile, "wb") as out:
+    for value, n in counts.most_common():
+      out.write((value + "\t" + str(n) + "\t" + (replacements[value] or "") + "\n").encode("utf-8"))
+  return replacements
+
+# Files the bot keeps its state in, by default in the --dir of the command line
+STATE_FILES = {"redirects": "vacuumbot-redirects.db", "journal": "vacuumbot-journal.db",
+               "deadletter": "vacuumbot-deadletter.jsonl", "cookiefile": "vacuumbot-cookie.json", "logdir": ""}
+
+def read_keys(filename):
+  """Yields the keys in a file, one per line, or on stdin if filename is '-'."""
+  for line in (sys.stdin if filename == "-" else open_file(filename)):
+    line = line.strip()
+    if line != "" and not line.startswith("#"):
+      yield line
+
+def bot_options(config, directory="."):
+  """Turns a JSON config into keyword arguments for VacuumBot.
+  
+  The config has the keyword arguments of VacuumBot, with a dict of keyword arguments
+  for limiter and the file of a Coordinator for coordinator, with run as the run to
+  join ("last" for the last one in the file). Relative file names are taken relative to
+  directory, and the state files that the config doesn't name are put there.
+  """
+  kw = dict((str(k), v) for k, v in config.items())
+  for name, default in STATE_FILES.items():
+    kw[name] = os.path.join(directory, kw.get(name, default))
+  for name in ["identifiers", "formatdict"]:
+    if kw.get(name) != None:
+      kw[name] = os.path.join(directory, kw[name])
+  for name, field, default in [("cache", "filename", "vacuumbot-records.db"), ("dryrun", "prefix", "vacuumbot-patches")]:
+    if kw.get(name) != None:
+      kw[name] = dict((str(k), v) for k, v in kw[name].items())
+      kw[name][field] = os.path.join(directory, kw[name].get(field, default))
+  if kw.get("limiter") != None:
+    kw["limiter"] = RateLimiter(**dict((str(k), v) for k, v in kw["limiter"].items()))
+  run = kw.pop("run", None)
+  if kw.get("coordinator") != None:
+    kw["coordinator"] = Coordinator(os.path.join(directory, kw["coordinator"]))
+    kw["coordinator"].run = kw["coordinator"].last_run() if run == "last" else run
+  return kw
+
+def main(argv=None):
+  """Runs a sweep or a dump job from the command line.
+  
+  The bot is set up from a JSON config file (see bot_options) that also has the
+  username and password of the bot account. The password can be given in
+  $VACUUMBOT_PASSWORD instead. Dump jobs and dry runs don't need an account; clean-dump
+  only takes formatdict and formatdistance from the config.
+  """
+  import argparse
+  parser = argparse.ArgumentParser(prog="vacuumbot", description="Clean up Open Library records.")
+  parser.add_argument("--config", help="JSON file with VacuumBot options, username and password")
+  parser.add_argument("--dir", default=".", help="directory of the databases, logs and login cookie (default: .)")
+  parser.add_argument("--username", help="Open Library bot account")
+  parser.add_argument("--base-url", help="Open Library site to clean")
+  parser.add_argument("--dry-run", metavar="PREFIX", help="write patch files with this prefix instead of saving to OL")
+  parser.add_argument("--run", help="run of a coordinated sweep to join, or 'last' (default: the coordinator's shared run)")
+  commands = parser.add_subparsers(dest="command", metavar="command")
+  
+  def command(name, func, help, online=True, pipeline=False, resume=False):
+    p = commands.add_parser(name, help=help, description=help)
+    p.set_defaults(func=func, online=online)
+    if resume:
+      p.add_argument("--resume", action="store_true", help="continue the last run of this sweep")
+    if pipeline:
+      p.add_argument("--fetchers", type=int, default=1, help="threads that fetch records")
+      p.add_argument("--cleaners", type=int, default=1, help="threads that clean records")
+      p.add_argument("--writers", type=int, default=1, help="threads that save records")
+      p.add_argument("--depth", type=int, default=2, help="batches queued between the stages")
+    return p
+  
+  def stages(o):
+    return {"fetchers": o.fetchers, "cleaners": o.cleaners, "writers": o.writers, "depth": o.depth}
+  
+  command("author-dates", lambda vb, o: vb.clean_author_dates2(o.resume, **stages(o)),
+          "remove the period after the death dates of authors", pipeline=True, resume=True)
+  p = command("formats", lambda vb, o: vb.replace_formats_clean_pagination2(o.old, o.new, o.resume, **stages(o)),
+              "replace physical formats and clean up pagination", pipeline=True, resume=True)
+  p.add_argument("old", nargs="+", help="format to replace")
+  p.add_argument("new", help="format to replace it with")
+  p = command("split-formats", lambda vb, o: vb.replace_split_formats_clean_pagination(o.old, o.new, o.by, o.sub, o.ot, o.resume, **stages(o)),
+              "replace formats that hold a by statement, subtitle and other title", pipeline=True, resume=True)
+  for name in ["old", "new", "by", "sub", "ot"]:
+    p.add_argument(name)
+  p = command("identifiers", lambda vb, o: vb.clean_identifier_fields(read_keys(o.keys), o.resume, **stages(o)),
+              "clean up the identifiers of editions", pipeline=True, resume=True)
+  p.add_argument("keys", help="file with one edition key per line, or - for stdin")
+  p = command("vacuum", lambda vb, o: vb.vacuum(o.filename, o.sort, o.chunksize, **stages(o)),
+              "run the commands in a command file", pipeline=True)
+  p.add_argument("filename", help="file of key, command and arguments, tab-separated")
+  p.add_argument("--sort", action="store_true", help="sort the commands by key first")
+  p.add_argument("--chunksize", type=int, default=1000000, help="commands sorted in memory at once")
+  p = command("replay", lambda vb, o: vb.replay_dead_letters(o.filename), "save the records that OL rejected again")
+  p.add_argument("filename", nargs="?", help="dead letter file (default: the bot's deadletter)")
+  p = command("upload", lambda vb, o: vb.upload_patches(o.prefix, o.writers), "save the patches of a dry run")
+  p.add_argument("prefix")
+  p.add_argument("--writers", type=int, default=1)
+  p = command("save-dump-changes", lambda vb, o: vb.save_dump_changes(o.filename), "save the records changed by clean-dump")
+  p.add_argument("filename")
+  p = command("clean-dump", lambda vb, o: process_dump(o.dumpfile, o.outfile, o.steps, o.types, o.processes, **o.cleaner),
+              "clean the records in a dump and write the changed ones", online=False)
+  p.add_argument("dumpfile")
+  p.add_argument("outfile")
+  p.add_argument("--step", dest="steps", action="append", nargs="+", required=True, metavar=("NAME", "ARG"),
+                 help="cleaner to run with its arguments, like --step replace_format2 pepperbek Paperback (repeat for more)")
+  p.add_argument("--types", nargs="+", help="record types to clean, like /type/edition")
+  p.add_argument("--processes", type=int)
+  p = command("index-dump", lambda vb, o: index_dump(o.dumpfile, IdentifierIndex(os.path.join(o.dir, o.index))),
+              "index the identifiers of the editions in a dump", online=False)
+  p.add_argument("dumpfile")
+  p.add_argument("--index", default="vacuumbot-identifiers.db")
+  p = command("duplicates", lambda vb, o: write_duplicates(IdentifierIndex(os.path.join(o.dir, o.index)), o.outfile, o.scheme),
+              "list the editions that share an identifier", online=False)
+  p.add_argument("outfile")
+  p.add_argument("--index", default="vacuumbot-identifiers.db")
+  p.add_argument("--scheme", choices=[scheme for scheme, fields, normalize in IDENTIFIERS])
+  options = parser.parse_args(argv)
+  
+  config = {}
+  if options.config != None:
+    with open(options.config, "rb") as f:
+      config = simplejson.load(f)
+  if options.command == "clean-dump":
+    # Steps are given like the commands in a command file (see VacuumBot.vacuum)
+    options.steps = [(COMMANDS.get(step[0], step[0]), [arg.decode("utf-8") for arg in step[1:]]) for step in options.steps]
+    for method, args in options.steps:
+      if method not in RULES:
+        parser.error("unknown step " + method)
+    formatdict = config.get("formatdict")
+    options.cleaner = {"formatdict": os.path.join(options.dir, formatdict) if formatdict != None else None,
+                       "formatdistance": config.get("formatdistance", 0)}
+  vb = None
+  if options.online:
+    username = options.username or config.pop("username", None)
+    password = os.environ.get("VACUUMBOT_PASSWORD", config.pop("password", None))
+    config.pop("username", None)
+    if options.base_url != None:
+      config["base_url"] = options.base_url
+    if options.dry_run != None:
+      config["dryrun"] = {"prefix": options.dry_run}
+    if options.run != None:
+      config["run"] = options.run
+    if username == None and config.get("dryrun") == None:
+      parser.error("a username is needed for " + options.command + ", except in a dry run")
+    vb = VacuumBot(username, password, **bot_options(config, options.dir))
+  try:
+    options.func(vb, options)
+  finally:
+    if vb != None:
+      vb.close()
+  return 0
 
-#if __name__ == "__main__":
-#  import sys
-#  vacuum(sys.argv[1])
+if __name__ == "__main__":
+  sys.exit(main())